@@ -1,15 +1,27 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from services.rag import RAGRetriever
-from services.embedding import EmbeddingManager
-from services.chat_memory import ChatMemory
-from services.vectorstore import VectorStore, Metadata
+from services.resources import registry, CHAT_RESOURCES, BOOKING_RESOURCES
+from services.metrics import metrics
+import json
 import uuid
 from typing import Optional
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # load the embedding model and the shared clients once per process, before serving requests.
+    # mysql is left to the first booking turn, the ingestion resources (parser, dedup index) are not used here
+    registry.warm_up(CHAT_RESOURCES)
+    yield
+    await registry.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # api for conversational RAG
 @app.get("/chat/")
-def chat(query: str, sessionid:Optional[str] = None):
+async def chat(query: str, sessionid:Optional[str] = None):
     try:
         # if sessionid is not provided, new id will be generated for each request
         # how to use:
@@ -19,16 +31,74 @@ def chat(query: str, sessionid:Optional[str] = None):
         if not sessionid:
             sessionid = str(uuid.uuid4())
 
-        metadata = Metadata() # for storing booking details 
-        chat_memory = ChatMemory(sessionid = sessionid) # for maintaining chat history
-        embedding_manager = EmbeddingManager() # for creating embeddings for query
-        vector_store = VectorStore() # vector db where context is searched
-        rag_retriever = RAGRetriever(metadata=metadata,chat_memory= chat_memory,embedding_manager=embedding_manager,vector_store=vector_store)
-        response = rag_retriever.ret_aug_gen(query= query)
+        # every stage of the turn is timed under one trace id, returned with the reply
+        with metrics.trace(sessionid=sessionid, name="chat") as trace:
+            # only the chat memory is per session, everything else is shared by the whole process.
+            # mysql (metadata, availability) is only reached on booking turns, rag answers donot depend on it
+            chat_memory = registry.chat_memory(sessionid = sessionid) # for maintaining chat history
+            rag_retriever = RAGRetriever(metadata=lambda: registry.metadata,chat_memory= chat_memory,embedding_manager=registry.embedding_manager,vector_store=registry.vector_store,llm_client=registry.llm_client,semantic_cache=registry.semantic_cache,embedding_batcher=registry.embedding_batcher,context_assembler=registry.context_assembler,lexical_index=registry.lexical_index,intent_router=registry.intent_router,availability=lambda: registry.availability)
+            # async pipeline: the handler doesnot hold a worker thread while waiting on redis or the llm
+            response = await rag_retriever.aret_aug_gen(query= query)
         response['sessionid'] = sessionid
+        response['trace_id'] = trace.trace_id
         return response
     except Exception as e:
         return {"Error":f"{str(e)}"}
-    
+
+# api for conversational RAG, streamed as server sent events
+@app.get("/chat/stream/")
+async def chat_stream(query: str, sessionid:Optional[str] = None):
+    # sessionid works the same way as in /chat/
+    if not sessionid:
+        sessionid = str(uuid.uuid4())
+
+    async def events():
+        # events: session -> route -> token... -> done (same body as /chat/) or error
+        with metrics.trace(sessionid=sessionid, name="chat_stream") as trace:
+            yield f"event: session\ndata: {json.dumps({'sessionid': sessionid, 'trace_id': trace.trace_id})}\n\n"
+            try:
+                chat_memory = registry.chat_memory(sessionid = sessionid)
+                rag_retriever = RAGRetriever(metadata=lambda: registry.metadata,chat_memory= chat_memory,embedding_manager=registry.embedding_manager,vector_store=registry.vector_store,llm_client=registry.llm_client,semantic_cache=registry.semantic_cache,embedding_batcher=registry.embedding_batcher,context_assembler=registry.context_assembler,lexical_index=registry.lexical_index,intent_router=registry.intent_router,availability=lambda: registry.availability)
+                async for event, data in rag_retriever.astream_ret_aug_gen(query= query):
+                    if event == "done":
+                        data['sessionid'] = sessionid
+                        data['trace_id'] = trace.trace_id
+                    yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'Error': str(e)})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# api for cache hit rates, latency saved and query embedding batching
+@app.get("/cache/stats/")
+def cache_stats():
+    return {
+        "semantic_cache": registry.semantic_cache.stats(),
+        "embedding_cache": registry.embedding_manager.cache_stats(),
+        "embedding_batcher": registry.embedding_batcher.stats(),
+    }
+
+# api for the latency histograms of every pipeline stage, in the prometheus text format
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# api for the stage timings of recent requests, e.g of one chat session
+@app.get("/traces/")
+def traces(sessionid:Optional[str] = None, limit:int = 50):
+    return metrics.recent_traces(sessionid=sessionid, limit=limit)
+
+# api for the llm latency per model, hedged requests, fallbacks and parse retries
+@app.get("/llm/stats/")
+def llm_stats():
+    return registry.llm_client.stats()
+
+# api for readiness probe
+@app.get("/ready/")
+def ready():
+    # a mysql outage only affects booking turns, it is reported without failing the probe
+    readiness = registry.readiness(CHAT_RESOURCES, optional=BOOKING_RESOURCES)
+    return JSONResponse(content=readiness, status_code=200 if readiness["ready"] else 503)
+
 
 
@@ -1,40 +1,70 @@
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI, File, UploadFile
-import shutil, os
+from fastapi.responses import JSONResponse, PlainTextResponse
+import asyncio, shutil, os, tempfile
 from services.chunking import Chunk
-from services.embedding import EmbeddingManager
-from services.vectorstore import VectorStore
+from services.ingest import IncrementalIngestor
+from services.jobs import IngestionJobManager
+from services.resources import registry
+from services.metrics import metrics
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # the running ingestion finishes, then the parser process pool and the pooled connections are closed
+    await asyncio.to_thread(jobs.close)
+    await registry.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# only new/modified files are parsed and only new chunks are embedded (near duplicates of stored chunks are collapsed), stale chunks are deleted.
+# the files are parsed on the shared process pool and one ingestion runs at a time in the background
+jobs = IngestionJobManager(ingestor_factory=lambda: IncrementalIngestor(embedding_manager=registry.embedding_manager,vector_store=registry.vector_store,chunk_obj=Chunk(parser=registry.parser),lexical_index=registry.lexical_index,dedup_index=registry.dedup_index))
 
 # api for data ingestion
 @app.post("/uploadfile/")
 def upload_file(chunk_strategy:str,file: UploadFile = File(...)):
     # Save file locally
     try:
+        if chunk_strategy not in ("document", "recursive"):
+            raise Exception(f"{chunk_strategy} chunking strategy not supported!!!!")
         file_name = Path(file.filename)
         supported_filetype = [".pdf",".txt"]
         if file_name.suffix in supported_filetype:
             DIR = f"data/booking_files"
             os.makedirs(DIR,exist_ok=True)
-            with open(os.path.join(DIR,file.filename), "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            path = os.path.join(DIR,file_name.name)
+            # written under a temporary name first, a running ingestion never sees a half written file
+            fd, tmp_path = tempfile.mkstemp(dir=DIR, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as buffer:
+                    shutil.copyfileobj(file.file, buffer)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
             print("Uploaded files saved")
         else:
             raise Exception(f"File type not supported")
+        job = jobs.submit(strategy=chunk_strategy, files=[path])
+    except Exception as e:
+        return {"Success": False,"error":str(e)}
+    return {"Success": True,"job_id":job["job_id"],"status":job["status"]}
 
-        chunk_obj = Chunk()
-        chunks = chunk_obj.create_chunk(strategy= chunk_strategy)
-        print("Chunking completed")
+# api for the progress of an ingestion job
+@app.get("/jobs/{job_id}")
+def job_status(job_id:str):
+    status = jobs.status(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"Success": False, "error": f"job {job_id} not found"})
+    return status
 
-        texts,metadata = chunk_obj.get_text_metadata(chunks=chunks)
-        embedding_manager = EmbeddingManager()
-        embeddings = embedding_manager.generate_embeddings(texts= texts)
+@app.get("/jobs/")
+def list_jobs():
+    return jobs.list_jobs()
 
-        store = VectorStore()
-        store.store(embeddings=embeddings,texts=texts,chunk_metadata=metadata)
-        print("Embeddings saved to vector store and metadata as well to sql db")
-        
-    except Exception as e:
-        return {"Success": False,"error":str(e)} 
-    return {"Success": True}
\ No newline at end of file
+# api for the latency histograms of the ingestion stages, in the prometheus text format
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
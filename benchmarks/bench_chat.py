@@ -0,0 +1,141 @@
+"""
+End to end benchmark of chat turns through the app (api/chat.py) against local stand-ins, at increasing concurrency.
+Every level starts from a fresh scratch directory with the same ingested corpus. The workload mixes new questions,
+repeated questions (semantic cache) and complete booking messages (local router, sql write). /chat/ is called over
+http (in process), /chat/stream/ through its response iterator so that the time to the first token is measured
+
+    python -m benchmarks.bench_chat --concurrency 1,4,16,64 --requests 200 --llm-latency-ms 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import time
+from datetime import date, timedelta
+import httpx
+from api.chat import app, chat_stream
+from api.ingestion import jobs
+from benchmarks.harness import StandinEnvironment, add_standin_arguments, make_corpus, percentiles, write_results
+from services.resources import registry, CHAT_RESOURCES
+
+QUESTIONS = ["What skills does {name} have?", "What is the email of {name}?", "How many years of experience does {name} have?",
+             "Which projects did {name} work on?"]
+
+
+def make_workload(corpus:list, requests:int, repeat_ratio:float, booking_ratio:float, seed:int) -> list[tuple]:
+    """
+    Return:
+        list of (kind, query) with kind = "question", "repeat" or "booking"
+    """
+    rng = random.Random(seed)
+    workload, asked = [], []
+    first_day = date.today() + timedelta(days=1)
+    for n in range(requests):
+        draw = rng.random()
+        if draw < booking_ratio:
+            # a unique slot per booking, so that every booking is written
+            slot_day = (first_day + timedelta(days=n // 16)).isoformat()
+            slot_time = f"{9 + (n % 16) // 2:02d}:{30 * (n % 2):02d}"
+            workload.append(("booking", f"I want to book an interview, my name is Bench User, email bench{n}@example.com, on {slot_day} at {slot_time}"))
+        elif draw < booking_ratio + repeat_ratio and asked:
+            workload.append(("repeat", rng.choice(asked)))
+        else:
+            query = rng.choice(QUESTIONS).format(name=rng.choice(corpus)["name"])
+            asked.append(query)
+            workload.append(("question", query))
+    return workload
+
+
+async def chat_turn(client:httpx.AsyncClient, query:str, sessionid:str) -> tuple:
+    response = await client.get("/chat/", params={"query": query, "sessionid": sessionid})
+    body = response.json()
+    return response.status_code == 200 and "Error" not in body and body.get("assistance") is not None, None
+
+
+async def stream_turn(client:httpx.AsyncClient, query:str, sessionid:str) -> tuple:
+    # the endpoint's own iterator, an in process http transport would buffer the whole stream
+    response = await chat_stream(query=query, sessionid=sessionid)
+    started, first_token, ok = time.perf_counter(), None, False
+    async for event in response.body_iterator:
+        name = event.split("\n", 1)[0][len("event: "):]
+        if name in ("token", "done") and first_token is None:
+            first_token = time.perf_counter() - started
+        if name == "done":
+            ok = json.loads(event.split("data: ", 1)[1]).get("assistance") is not None
+    return ok, first_token
+
+
+async def run(args:argparse.Namespace, concurrency:int, endpoint:str) -> dict:
+    env = StandinEnvironment(args)
+    try:
+        corpus = make_corpus(os.path.join(env.workdir, "corpus"), args.docs, pdf_ratio=args.pdf_ratio, seed=args.seed)
+        os.makedirs("data/booking_files", exist_ok=True)
+        for each in corpus:
+            shutil.copy(each["path"], "data/booking_files")
+        await asyncio.to_thread(registry.warm_up, CHAT_RESOURCES)
+        await asyncio.to_thread(lambda: jobs.ingestor_factory().ingest(strategy="recursive"))
+        workload = make_workload(corpus, args.requests, args.repeat_ratio, args.booking_ratio, args.seed)
+        turn = chat_turn if endpoint == "chat" else stream_turn
+        latencies, first_tokens, errors = {}, [], 0
+        pending = iter(enumerate(workload))
+        llm_requests = env.llm_server.requests
+
+        async def worker(client:httpx.AsyncClient, worker_id:int):
+            nonlocal errors
+            # closed loop: each worker sends its next turn when the previous one is answered. Bookings share the worker's
+            # session, questions open a new one: the semantic cache only shares answers between turns of the same history
+            for n, (kind, query) in pending:
+                sent = time.perf_counter()
+                sessionid = f"bench-{worker_id}" if kind == "booking" else f"bench-{worker_id}-{n}"
+                try:
+                    ok, first_token = await turn(client, query, sessionid)
+                except Exception as e:
+                    print(f"request {n} failed: {e}")
+                    ok, first_token = False, None
+                latencies.setdefault(kind, []).append(time.perf_counter() - sent)
+                errors += not ok
+                if first_token is not None:
+                    first_tokens.append(first_token)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as client:
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(client, i) for i in range(concurrency)))
+            seconds = time.perf_counter() - start
+
+        result = {"concurrency": concurrency, "requests": len(workload), "errors": errors, "seconds": round(seconds, 3),
+                  "requests_per_second": round(len(workload) / seconds, 2),
+                  "latency": percentiles([each for values in latencies.values() for each in values]),
+                  "latency_by_kind": {kind: {"requests": len(values), **percentiles(values)} for kind, values in latencies.items()},
+                  "llm_requests": env.llm_server.requests - llm_requests,
+                  "semantic_cache": registry.semantic_cache.stats()}
+        if first_tokens:
+            result["first_token"] = percentiles(first_tokens)
+        return result
+    finally:
+        await env.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,4,16,64", help="comma separated no. of concurrent chat sessions")
+    parser.add_argument("--endpoints", default="chat,stream", help="comma separated: chat, stream")
+    parser.add_argument("--requests", type=int, default=200, help="chat turns per concurrency level")
+    parser.add_argument("--docs", type=int, default=50, help="documents of the ingested corpus")
+    parser.add_argument("--pdf-ratio", type=float, default=0.5)
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="share of questions asked before")
+    parser.add_argument("--booking-ratio", type=float, default=0.1, help="share of complete booking messages")
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    results = {"config": vars(args), "runs": {}}
+    for endpoint in args.endpoints.split(","):
+        for concurrency in map(int, args.concurrency.split(",")):
+            print(f"{args.requests} turns on {endpoint} at concurrency {concurrency}")
+            results["runs"][f"{endpoint}_c{concurrency}"] = asyncio.run(run(args, concurrency, endpoint))
+    write_results("bench_chat", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
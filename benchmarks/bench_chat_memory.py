@@ -0,0 +1,75 @@
+"""
+Benchmark of a chat turn's redis traffic (read the history, save the turn) against a redis stand-in:
+separate commands (4 round trips) vs pipelined commands (2 round trips)
+
+    python -m benchmarks.bench_chat_memory --turns 500 --latency-ms 2
+"""
+import argparse
+import asyncio
+import json
+import time
+from benchmarks.standins import FakeRedis, AsyncFakeRedis
+from services.chat_memory import ChatMemory
+
+
+def legacy_turn(client:FakeRedis, sessionid:str, hist:dict) -> None:
+    # the redis access before pipelining: lrange+expire and rpush+expire as separate commands
+    key = f"chat:{sessionid}"
+    client.lrange(key, 0, -1)
+    client.expire(key, 500)
+    client.rpush(key, json.dumps(hist))
+    client.expire(key, 500)
+
+
+def pipelined_turn(client:FakeRedis, sessionid:str, hist:dict) -> None:
+    memory = ChatMemory(sessionid=sessionid, redis_client=client)
+    memory.get_chat_history()
+    memory.save_chat_history(history=hist)
+
+
+async def async_turns(latency_ms:float, turns:int, concurrency:int) -> dict:
+    client = AsyncFakeRedis(latency_ms=latency_ms)
+    hist = {"user": "What skills does he have?", "assistance": "Python, SQL and machine learning"}
+
+    async def session(n:int):
+        memory = ChatMemory(sessionid=f"async-{n}", redis_client=FakeRedis(latency_ms=0), async_redis_client=client)
+        for _ in range(turns // concurrency):
+            await memory.aget_chat_history()
+            await memory.asave_chat_history(history=hist)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(n) for n in range(concurrency)))
+    seconds = time.perf_counter() - start
+    done = (turns // concurrency) * concurrency
+    return {"seconds": round(seconds, 3), "turns_per_second": round(done / seconds, 1), "round_trips": client.round_trips}
+
+
+def measure(turn, latency_ms:float, turns:int) -> dict:
+    client = FakeRedis(latency_ms=latency_ms)
+    hist = {"user": "What skills does he have?", "assistance": "Python, SQL and machine learning"}
+    start = time.perf_counter()
+    for n in range(turns):
+        turn(client, f"session-{n % 10}", hist)
+    seconds = time.perf_counter() - start
+    return {"seconds": round(seconds, 3), "turns_per_second": round(turns / seconds, 1), "round_trips": client.round_trips}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent sessions of the async run")
+    args = parser.parse_args()
+
+    results = {
+        "turns": args.turns,
+        "latency_ms": args.latency_ms,
+        "separate_commands": measure(legacy_turn, args.latency_ms, args.turns),
+        "pipelined": measure(pipelined_turn, args.latency_ms, args.turns),
+        "pipelined_async": asyncio.run(async_turns(args.latency_ms, args.turns, args.concurrency)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
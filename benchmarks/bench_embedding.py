@@ -0,0 +1,73 @@
+"""
+Benchmark of the EmbeddingManager cpu backends: sentences/sec and latency for query sized and ingestion sized batches,
+with a parity check of every backend against the fp32 pytorch model
+
+    python -m benchmarks.bench_embedding --backends torch,torch-int8,onnx,onnx-int8 --threads 4
+"""
+import argparse
+import json
+import random
+import string
+import time
+import numpy as np
+from services.embedding import EmbeddingManager
+
+
+def make_texts(count:int, words:int, seed:int) -> list:
+    # chunk like texts of varying length, the lengths matter for the length sorted batching
+    rng = random.Random(seed)
+    return [" ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(rng.randint(words // 2, words)))
+            for _ in range(count)]
+
+
+def run(embedding_manager:EmbeddingManager, batches:list) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for batch in batches:
+        started = time.perf_counter()
+        embedding_manager.generate_embeddings(batch, show_progress_bar=False)
+        latencies.append(time.perf_counter() - started)
+    seconds = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {"batches": len(batches), "sentences_per_second": round(sum(map(len, batches)) / seconds, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2), "p95_ms": round(float(np.percentile(latencies, 95)), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--backends", default="torch,torch-int8,onnx,onnx-int8")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--queries", type=int, default=200, help="no. of single query batches")
+    parser.add_argument("--ingest-batches", type=int, default=8)
+    parser.add_argument("--ingest-batch-size", type=int, default=64)
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    queries = [[text] for text in make_texts(args.queries, words=16, seed=1)]
+    chunks = make_texts(args.ingest_batches * args.ingest_batch_size, words=180, seed=2)
+    ingest = [chunks[i:i+args.ingest_batch_size] for i in range(0, len(chunks), args.ingest_batch_size)]
+    parity_texts = [each[0] for each in queries[:64]] + chunks[:64]
+
+    results = {"config": vars(args)}
+    reference = None
+    for backend in args.backends.split(","):
+        try:
+            # the cache is disabled so that every text is really encoded
+            embedding_manager = EmbeddingManager(model_name=args.model, use_cache=False, backend=backend, threads=args.threads)
+        except Exception as e:
+            results[backend] = {"error": str(e)}
+            continue
+        if reference is None:
+            reference = EmbeddingManager(model_name=args.model, use_cache=False, backend="torch", threads=args.threads)._encode(parity_texts)
+        embedding_manager.generate_embeddings(queries[0], show_progress_bar=False) # warm up
+        results[backend] = {
+            "parity": embedding_manager.check_parity(parity_texts, reference=reference, min_cosine=args.min_cosine),
+            "query": run(embedding_manager, queries),
+            "ingestion": run(embedding_manager, ingest),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
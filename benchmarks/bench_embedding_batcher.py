@@ -0,0 +1,51 @@
+"""
+Benchmark of query embeddings requested by concurrent chats: one forward pass per request vs EmbeddingBatcher
+
+    python -m benchmarks.bench_embedding_batcher --concurrency 32 --requests 512 --max-wait-ms 5
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from services.embedding import EmbeddingManager, EmbeddingBatcher
+
+
+def run(encode, queries:list, concurrency:int) -> dict:
+    latencies = []
+
+    def one(query):
+        start = time.perf_counter()
+        encode(query)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, queries))
+    seconds = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {"seconds": round(seconds, 3), "queries_per_second": round(len(queries) / seconds, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2), "p95_ms": round(float(np.percentile(latencies, 95)), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    # the cache is disabled so that every query is really encoded
+    embedding_manager = EmbeddingManager(use_cache=False)
+    queries = [f"what is the contact number of candidate {i}?" for i in range(args.requests)]
+    results = {"config": vars(args)}
+    results["unbatched"] = run(lambda q: embedding_manager.generate_embeddings([q], show_progress_bar=False), queries, args.concurrency)
+    batcher = EmbeddingBatcher(embedding_manager, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    results["batched"] = run(batcher.encode, queries, args.concurrency)
+    results["batched"]["batcher"] = batcher.stats()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+End to end benchmark of ingestion through the app (api/ingestion.py) against local stand-ins, over synthetic PDF/TXT
+corpora of increasing size. "upload" posts every file to /uploadfile/ (one ingestion job per upload, run one at a time),
+"bulk" ingests the whole corpus in one job
+
+    python -m benchmarks.bench_ingestion --sizes 10,50,200 --pdf-ratio 0.5 --pages 4 --modes upload,bulk
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import time
+import httpx
+from api.ingestion import app, jobs
+from benchmarks.harness import StandinEnvironment, add_standin_arguments, make_corpus, percentiles, write_results
+
+
+async def wait_for_jobs(client:httpx.AsyncClient, job_ids:set, poll_seconds:float = 0.05) -> list[dict]:
+    while True:
+        statuses = [each for each in (await client.get("/jobs/")).json() if each["job_id"] in job_ids]
+        if len(statuses) == len(job_ids) and all(each["status"] in ("completed", "failed") for each in statuses):
+            return statuses
+        await asyncio.sleep(poll_seconds)
+
+
+async def run(args:argparse.Namespace, size:int, mode:str) -> dict:
+    env = StandinEnvironment(args)
+    try:
+        corpus = make_corpus(os.path.join(env.workdir, "corpus"), size, pdf_ratio=args.pdf_ratio, pages=args.pages,
+                             words_per_page=args.words_per_page, seed=args.seed)
+        upload_latencies = []
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as client:
+            start = time.perf_counter()
+            if mode == "upload":
+                job_ids = set()
+                for each in corpus:
+                    sent = time.perf_counter()
+                    with open(each["path"], "rb") as file:
+                        response = await client.post("/uploadfile/", params={"chunk_strategy": args.strategy},
+                                                     files={"file": (os.path.basename(each["path"]), file)})
+                    upload_latencies.append(time.perf_counter() - sent)
+                    body = response.json()
+                    if not body.get("Success"):
+                        raise Exception(f"upload failed: {body}")
+                    job_ids.add(body["job_id"])
+            else:
+                os.makedirs("data/booking_files", exist_ok=True)
+                for each in corpus:
+                    shutil.copy(each["path"], "data/booking_files")
+                job_ids = {jobs.submit(strategy=args.strategy)["job_id"]}
+            finished = await wait_for_jobs(client, job_ids)
+            seconds = time.perf_counter() - start
+
+        summaries = [each["summary"] for each in finished]
+        stage_seconds = {}
+        for summary in summaries:
+            for stage, value in summary.get("stage_seconds", {}).items():
+                stage_seconds[stage] = round(stage_seconds.get(stage, 0.0) + value, 3)
+        chunks = sum(summary.get("chunks_embedded", 0) for summary in summaries)
+        pages = sum(each["pages"] for each in corpus)
+        megabytes = sum(each["bytes"] for each in corpus) / 1e6
+        result = {"docs": size, "pages": pages, "megabytes": round(megabytes, 3), "jobs": len(finished),
+                  "failed_jobs": sum(each["status"] == "failed" for each in finished), "chunks_embedded": chunks,
+                  "chunks_collapsed": sum(summary.get("chunks_collapsed", 0) for summary in summaries),
+                  "seconds": round(seconds, 3), "docs_per_second": round(size / seconds, 2), "pages_per_second": round(pages / seconds, 2),
+                  "megabytes_per_second": round(megabytes / seconds, 3), "chunks_per_second": round(chunks / seconds, 1),
+                  "stage_seconds": stage_seconds}
+        if upload_latencies:
+            result["upload_latency"] = percentiles(upload_latencies)
+        return result
+    finally:
+        await env.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,50,200", help="comma separated no. of documents of the corpora")
+    parser.add_argument("--modes", default="upload,bulk", help="comma separated: upload, bulk")
+    parser.add_argument("--pdf-ratio", type=float, default=0.5)
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument("--words-per-page", type=int, default=350)
+    parser.add_argument("--strategy", choices=["recursive", "document"], default="recursive")
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    results = {"config": vars(args), "runs": {}}
+    for size in map(int, args.sizes.split(",")):
+        for mode in args.modes.split(","):
+            print(f"ingesting {size} documents ({mode})")
+            results["runs"][f"{mode}_{size}"] = asyncio.run(run(args, size, mode))
+    write_results("bench_ingestion", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of the llm client's tail latency controls against the stub llm server with a slow tail and replies that are
+not json: no hedging, hedging on the same model and hedging on a fallback model, with and without parse retries.
+The hedge delay is the p95 of the model, so every run starts with unmeasured warm up requests
+
+    python -m benchmarks.bench_llm --requests 300 --concurrency 8 --tail-ratio 0.05 --tail-ms 3000 --invalid-ratio 0.05
+"""
+import argparse
+import asyncio
+import time
+from benchmarks.harness import percentiles, write_results
+from benchmarks.standins import StubLLMServer
+from services.llm import LLMClient, parse_json_reply
+
+MESSAGES = [{"role": "system", "content": "Reply in json."}, {"role": "user", "content": "Context: candidate profiles\nQuery: who knows python?"}]
+
+# name: client options
+CONFIGS = {
+    "single": {"hedging": False, "parse_retries": 0},
+    "hedged": {"hedging": True, "parse_retries": 0},
+    "hedged_fallback": {"hedging": True, "fallback_model": "stub-fallback", "parse_retries": 0},
+    "hedged_fallback_retry": {"hedging": True, "fallback_model": "stub-fallback"},
+}
+
+
+async def run(args:argparse.Namespace, options:dict) -> dict:
+    server = StubLLMServer(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms, seed=args.seed, tail_ratio=args.tail_ratio,
+                           tail_ms=args.tail_ms, invalid_ratio=args.invalid_ratio,
+                           models={"stub-fallback": {"latency_ms": args.fallback_latency_ms, "tail_ratio": 0.0}}).start()
+    client = LLMClient(url=server.url, model="stub", timeout=args.timeout, attempt_timeout=args.attempt_timeout,
+                       hedge_delay=args.hedge_delay, **{"parse_retries": args.parse_retries, **options})
+    try:
+        latencies, invalid, errors = [], 0, 0
+        queue = iter(range(args.warmup + args.requests))
+
+        async def worker():
+            nonlocal invalid, errors
+            for n in queue:
+                sent = time.perf_counter()
+                try:
+                    content = await client.acomplete_json(MESSAGES)
+                except Exception as e:
+                    print(f"request {n} failed: {e}")
+                    errors += 1
+                    continue
+                if n >= args.warmup:
+                    latencies.append(time.perf_counter() - sent)
+                    invalid += parse_json_reply(content) is None
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        seconds = time.perf_counter() - start
+        total = args.warmup + args.requests
+        stats = client.stats()
+        return {"requests": args.requests, "errors": errors, "invalid_replies": invalid, "seconds": round(seconds, 3),
+                "latency": percentiles(latencies), "llm_attempts": server.requests, "extra_attempts_ratio": round(server.requests / total - 1, 3),
+                "attempts_by_model": dict(server.requests_by_model),
+                "client": {name: stats[name] for name in ("hedges", "hedge_wins", "hedges_skipped", "fallbacks", "parse_retries", "parse_failures")},
+                "hedge_delay_ms": {model: each["hedge_delay_ms"] for model, each in stats["latency"].items()}}
+    finally:
+        await client.aclose()
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", default=",".join(CONFIGS), help=f"comma separated: {', '.join(CONFIGS)}")
+    parser.add_argument("--requests", type=int, default=300, help="measured completions per config")
+    parser.add_argument("--warmup", type=int, default=40, help="completions before measuring, the hedge delay needs 20 latencies")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=60.0)
+    parser.add_argument("--tail-ratio", type=float, default=0.05, help="share of slow completions of the primary model")
+    parser.add_argument("--tail-ms", type=float, default=3000.0)
+    parser.add_argument("--invalid-ratio", type=float, default=0.05, help="share of replies that are not json")
+    parser.add_argument("--fallback-latency-ms", type=float, default=450.0, help="mean latency of the fallback model, which has no tail")
+    parser.add_argument("--timeout", type=float, default=20.0)
+    parser.add_argument("--attempt-timeout", type=float, default=10.0)
+    parser.add_argument("--hedge-delay", type=float, default=1.0, help="hedge delay before the p95 is known")
+    parser.add_argument("--parse-retries", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="results file, benchmarks/results/bench_llm-<commit>.json if not provided")
+    args = parser.parse_args()
+
+    results = {"config": vars(args), "runs": {}}
+    for name in args.configs.split(","):
+        print(f"{args.requests} completions with {name}")
+        results["runs"][name] = asyncio.run(run(args, CONFIGS[name]))
+    write_results("bench_llm", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
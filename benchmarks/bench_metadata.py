@@ -0,0 +1,64 @@
+"""
+Benchmark of Metadata.write against a sqlite stand-in of mysql: a new connection and one INSERT per row vs pooled executemany batches
+
+    python -m benchmarks.bench_metadata --rows 20000 --latency-ms 0.5
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from benchmarks.standins import SQLiteMySQLConnection, create_sqlite_schema
+from services.vectorstore import Metadata
+
+
+def legacy_write(factory, metadata:list) -> None:
+    # the write path before pooling: fresh connection, one execute per row
+    connection = factory()
+    with connection:
+        with connection.cursor() as cursor:
+            for each in metadata:
+                cols_q = ", ".join(each.keys())
+                placeholders = ", ".join(['%s']*len(each))
+                cursor.execute(f"INSERT INTO booking_rag_metadata ({cols_q}) VALUES ({placeholders})", tuple(each.values()))
+        connection.commit()
+
+
+def measure(fn, rows:int) -> dict:
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    return {"seconds": round(seconds, 3), "rows_per_second": round(rows / seconds, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--calls", type=int, default=20, help="no. of write calls the rows are split into")
+    parser.add_argument("--latency-ms", type=float, default=0.5)
+    parser.add_argument("--connect-ms", type=float, default=5.0)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    uploaded_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    results = {"config": vars(args)}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("legacy", "pooled_executemany"):
+            path = os.path.join(tmp, f"{name}.db")
+            create_sqlite_schema(path)
+            factory = lambda: SQLiteMySQLConnection(path, latency_ms=args.latency_ms, connect_ms=args.connect_ms)
+            per_call = args.rows // args.calls
+            calls = [[{"id": f"doc_{c}_{i}", "uploaded_time": uploaded_time, "source": "bench.txt"} for i in range(per_call)]
+                     for c in range(args.calls)]
+            if name == "legacy":
+                run = lambda: [legacy_write(factory, each) for each in calls]
+            else:
+                metadata = Metadata(connection_factory=factory, batch_size=args.batch_size)
+                run = lambda: [metadata.write(each) for each in calls]
+            results[name] = measure(run, per_call * args.calls)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of the compressed LocalVectorStore: recall@k against exact search, bytes per vector and query latency
+for int8 and PQ codes, with and without exact re-scoring
+
+    python -m benchmarks.bench_quantization --vectors 50000 --dim 384 --top-k 10 --rescore 4
+"""
+import argparse
+import json
+import tempfile
+import time
+import numpy as np
+from services.local_index import LocalVectorStore
+
+
+def make_vectors(count:int, dim:int, clusters:int, rng:np.random.Generator, latent_dim:int = 48) -> np.ndarray:
+    # clustered and of low intrinsic dimension like real embeddings, isotropic random vectors
+    # would make every neighbour almost equally far
+    projection = np.random.default_rng(1).normal(size=(latent_dim, dim))
+    centers = np.random.default_rng(2).normal(size=(clusters, latent_dim))
+    latent = centers[rng.integers(0, clusters, size=count)] + 0.5 * rng.normal(size=(count, latent_dim))
+    return (latent @ projection + 0.3 * rng.normal(size=(count, dim))).astype(np.float32)
+
+
+def build(index_dir:str, vectors:np.ndarray, compression:str, rescore:int, pq_m:int) -> LocalVectorStore:
+    store = LocalVectorStore(index_dir=index_dir, ivf_min_vectors=len(vectors) + 1, compression=compression,
+                             compression_min_vectors=len(vectors), rescore=rescore, pq_m=pq_m)
+    for start in range(0, len(vectors), 10000):
+        end = min(start + 10000, len(vectors))
+        store._upsert_vectors(ids=[f"doc_{i}" for i in range(start, end)], embeddings=vectors[start:end],
+                              vector_metadata=[{} for _ in range(start, end)])
+    return store
+
+
+def run(store:LocalVectorStore, queries:np.ndarray, truth:list, top_k:int) -> dict:
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        results = store.query(query, top_k)
+        latencies.append(time.perf_counter() - start)
+        hits += len(expected & {each["id"] for each in results})
+    latencies = np.array(latencies) * 1000
+    code_size = store.quantizer.code_size if store.quantizer is not None else 4 * store.dim
+    return {f"recall@{top_k}": round(hits / (top_k * len(queries)), 4), "bytes_per_vector": code_size,
+            "compression_ratio": round(4 * store.dim / code_size, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2), "p95_ms": round(float(np.percentile(latencies, 95)), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rescore", type=int, default=4)
+    parser.add_argument("--pq-m", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(args.vectors, args.dim, args.clusters, rng)
+    queries = make_vectors(args.queries, args.dim, args.clusters, rng)
+    normalized = LocalVectorStore._normalize(vectors)
+    truth = []
+    for query in LocalVectorStore._normalize(queries):
+        top = np.argpartition(-(normalized @ query), args.top_k - 1)[:args.top_k]
+        truth.append({f"doc_{i}" for i in top})
+
+    results = {"config": vars(args)}
+    for name, compression, rescore in (("exact", None, 0), ("int8", "int8", 0), ("int8_rescored", "int8", args.rescore),
+                                       ("pq", "pq", 0), ("pq_rescored", "pq", args.rescore)):
+        with tempfile.TemporaryDirectory() as index_dir:
+            start = time.perf_counter()
+            store = build(index_dir, vectors, compression, rescore, args.pq_m)
+            build_seconds = time.perf_counter() - start
+            results[name] = {**run(store, queries, truth, args.top_k), "build_seconds": round(build_seconds, 2)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark of VectorStore upserts against the pinecone stand-in: one request with every vector vs size bounded batches sent concurrently
+
+    python -m benchmarks.bench_upsert --vectors 20000 --latency-ms 50 --failure-rate 0.02
+"""
+import argparse
+import json
+import time
+import numpy as np
+from benchmarks.standins import FakePineconeIndex
+from services.vectorstore import VectorStore
+
+
+def run(store:VectorStore, ids:list, embeddings:np.ndarray, vector_metadata:list) -> dict:
+    start = time.perf_counter()
+    try:
+        store._upsert_vectors(ids=ids, embeddings=embeddings, vector_metadata=vector_metadata)
+        error = None
+    except Exception as e:
+        error = str(e)
+    seconds = time.perf_counter() - start
+    index = store.pinecone_index
+    return {"seconds": round(seconds, 3), "vectors_per_second": round(len(index.vectors) / seconds, 1),
+            "stored": len(index.vectors), "requests": index.requests, "failed_requests": index.failures, "error": error}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--text-chars", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(args.vectors, args.dim)).astype(np.float32)
+    ids = [f"doc_{i}" for i in range(args.vectors)]
+    vector_metadata = [{"text": "x" * args.text_chars, "source": "data/booking_files/bench.txt"} for _ in ids]
+
+    results = {"config": vars(args)}
+    single = VectorStore(pinecone_index=FakePineconeIndex(args.latency_ms, failure_rate=args.failure_rate),
+                         batch_size=args.vectors, max_batch_bytes=float("inf"), max_workers=1, max_retries=0)
+    results["single_request"] = run(single, ids, embeddings, vector_metadata)
+    batched = VectorStore(pinecone_index=FakePineconeIndex(args.latency_ms, failure_rate=args.failure_rate),
+                          batch_size=args.batch_size, max_workers=args.workers)
+    results["batched_parallel"] = run(batched, ids, embeddings, vector_metadata)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compares two results files of the same benchmark (e.g, of two commits) metric by metric
+
+    python -m benchmarks.compare benchmarks/results/bench_chat-<base>.json benchmarks/results/bench_chat-<head>.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+# metrics where a larger value is better, every other timing metric is better when smaller
+_HIGHER_IS_BETTER = ("per_second", "recall", "hits", "hit_rate", "compression_ratio")
+_LOWER_IS_BETTER = ("_ms", "seconds", "errors", "failed", "invalid", "extra_attempts")
+
+
+def flatten(results:dict, prefix:str = "") -> dict:
+    """
+    Return:
+        {"runs.chat_c4.latency.p95_ms": value} for every numeric leaf (the config and meta sections are skipped)
+    """
+    flat = {}
+    for key, value in results.items():
+        if not prefix and key in ("meta", "config"):
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def direction(metric:str) -> int:
+    """
+    Return:
+        1 if larger is better, -1 if smaller is better, 0 if the metric is not scored
+    """
+    leaf = metric.rsplit(".", 1)[-1]
+    if any(each in leaf for each in _HIGHER_IS_BETTER):
+        return 1
+    if any(each in leaf for each in _LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base", help="results file of the baseline")
+    parser.add_argument("head", help="results file to compare with the baseline")
+    parser.add_argument("--threshold", type=float, default=10.0, help="change in percent reported as a regression or an improvement")
+    parser.add_argument("--all", action="store_true", help="also list the metrics within the threshold")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if a metric regressed")
+    args = parser.parse_args()
+
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.head) as file:
+        head = json.load(file)
+    if base.get("meta", {}).get("benchmark") != head.get("meta", {}).get("benchmark"):
+        print(f"warning: comparing {base.get('meta', {}).get('benchmark')} with {head.get('meta', {}).get('benchmark')}")
+    if base.get("config") != head.get("config"):
+        print("warning: the benchmark configs differ")
+    print(f"base {base.get('meta', {}).get('commit', '?')[:10]}  head {head.get('meta', {}).get('commit', '?')[:10]}")
+
+    base_metrics, head_metrics = flatten(base), flatten(head)
+    regressions = 0
+    print(f"{'metric':<60} {'base':>12} {'head':>12} {'change':>9}")
+    for metric in sorted(base_metrics.keys() & head_metrics.keys()):
+        old, new = base_metrics[metric], head_metrics[metric]
+        change = (new - old) / abs(old) * 100 if old else (0.0 if new == old else float("inf"))
+        score = direction(metric) * change
+        verdict = ""
+        if score <= -args.threshold:
+            verdict, regressions = "REGRESSION", regressions + 1
+        elif score >= args.threshold:
+            verdict = "improved"
+        if verdict or args.all:
+            print(f"{metric:<60} {old:>12.4g} {new:>12.4g} {change:>8.1f}% {verdict}")
+    for metric in sorted(base_metrics.keys() ^ head_metrics.keys()):
+        print(f"{metric:<60} only in {'base' if metric in base_metrics else 'head'}")
+    print(f"{regressions} regression(s) beyond {args.threshold}%")
+    if args.fail_on_regression and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Shared setup of the end to end benchmarks: the app's resource registry wired to local stand-ins (local vector index or
+pinecone stand-in, fake redis, sqlite for mysql, stub llm server) in a scratch directory, synthetic corpora, latency
+percentiles and machine readable results
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import pymupdf
+from benchmarks.standins import (FakePineconeIndex, SQLiteMySQLConnection, create_sqlite_schema, FakeRedis, AsyncFakeRedis,
+                                 HashingEmbeddingManager, StubLLMServer)
+from services.availability import AvailabilityCache
+from services.llm import LLMClient
+from services.resources import registry
+from services.vectorstore import Metadata, VectorStore
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+_SKILLS = ["python", "sql", "docker", "kubernetes", "react", "java", "golang", "pytorch", "tensorflow", "spark", "kafka",
+           "postgres", "redis", "aws", "azure", "terraform", "fastapi", "django", "pandas", "airflow"]
+_SYLLABLES = ["ka", "ri", "to", "me", "na", "lo", "sa", "vi", "du", "pe", "ra", "ni", "ko", "ta", "mi", "ha", "ze", "bu"]
+
+
+def add_standin_arguments(parser:argparse.ArgumentParser) -> None:
+    """
+    Description:
+        Adds the options of the stand-ins and of the results file to a benchmark's argument parser
+    """
+    group = parser.add_argument_group("stand-ins")
+    group.add_argument("--embedding", choices=["hashing", "model"], default="hashing",
+                       help="hashing: no model download, model: the real sentence-transformers model")
+    group.add_argument("--embed-ms-per-text", type=float, default=2.0, help="cpu time per text of the hashing embedding")
+    group.add_argument("--vector-store", choices=["local", "pinecone"], default="local", help="pinecone: the pinecone stand-in")
+    group.add_argument("--pinecone-latency-ms", type=float, default=50.0)
+    group.add_argument("--redis-latency-ms", type=float, default=1.0)
+    group.add_argument("--sql-latency-ms", type=float, default=0.5)
+    group.add_argument("--llm-latency-ms", type=float, default=300.0)
+    group.add_argument("--llm-jitter-ms", type=float, default=100.0)
+    group.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="results file, benchmarks/results/<benchmark>-<commit>.json if not provided")
+
+
+class StandinEnvironment:
+    """
+    Scratch directory (the app's data/ directory lives there) and registry resources backed by the stand-ins.
+    Create one per measured run so that runs donot share indexes or caches, and close it with aclose()
+    """
+    def __init__(self, args:argparse.Namespace):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="rag-bench-")
+        self._previous_dir = os.getcwd()
+        os.chdir(self.workdir) # every data/ path of the app is relative
+        self.llm_server = StubLLMServer(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms, seed=args.seed).start()
+        self.sqlite_path = os.path.join(self.workdir, "rag_metadata.sqlite")
+        create_sqlite_schema(self.sqlite_path)
+        redis_store = {"data": {}, "expiry": {}, "lock": threading.Lock()}
+
+        registry.reset()
+        registry.register("embedding_manager", self._create_embedding_manager)
+        registry.register("metadata", lambda: Metadata(connection_factory=lambda: SQLiteMySQLConnection(
+            self.sqlite_path, latency_ms=args.sql_latency_ms, connect_ms=5 * args.sql_latency_ms)))
+        registry.register("redis_client", lambda: FakeRedis(latency_ms=args.redis_latency_ms, store=redis_store))
+        registry.register("async_redis_client", lambda: AsyncFakeRedis(latency_ms=args.redis_latency_ms, store=redis_store))
+        registry.register("llm_client", lambda: LLMClient(url=self.llm_server.url, model="stub"))
+        registry.register("vector_store", self._create_vector_store)
+        registry.register("availability", lambda: AvailabilityCache(metadata=registry.get("metadata")))
+
+    def _create_embedding_manager(self):
+        if self.args.embedding == "model":
+            from services.embedding import EmbeddingManager
+            return EmbeddingManager()
+        return HashingEmbeddingManager(ms_per_text=self.args.embed_ms_per_text)
+
+    def _create_vector_store(self):
+        if self.args.vector_store == "pinecone":
+            store = VectorStore(pinecone_index=FakePineconeIndex(latency_ms=self.args.pinecone_latency_ms, seed=self.args.seed),
+                                docstore=registry.get("docstore"))
+        else:
+            from services.local_index import LocalVectorStore
+            store = LocalVectorStore(docstore=registry.get("docstore"))
+        store.sql_metadata = registry.get("metadata")
+        return store
+
+    async def aclose(self) -> None:
+        await registry.aclose()
+        registry.reset()
+        self.llm_server.stop()
+        os.chdir(self._previous_dir)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def _word(rng:random.Random) -> str:
+    return "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def make_corpus(directory:str, docs:int, pdf_ratio:float = 0.5, pages:int = 4, words_per_page:int = 350, seed:int = 0) -> list[dict]:
+    """
+    Description:
+        Writes synthetic candidate profiles as PDF and TXT files
+    Arguments:
+        directory: where the files are written
+        docs: no. of files
+        pdf_ratio: share of PDF files
+        pages: pages per file (TXT files have the same amount of text)
+        words_per_page: filler words per page, around the facts of the candidate
+        seed: seed of the generated text
+    Return:
+        list of {"path", "pages", "bytes", "name", "email", "skills"} per file
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(docs):
+        name = f"{_word(rng).capitalize()} {_word(rng).capitalize()}"
+        email = f"{name.replace(' ', '.').lower()}{i}@example.com"
+        skills = rng.sample(_SKILLS, 4)
+        page_texts = []
+        for page in range(pages):
+            filler = " ".join(_word(rng) for _ in range(words_per_page))
+            facts = (f"{name} is a candidate with {rng.randint(1, 15)} years of experience. Email: {email}. "
+                     f"Skills: {', '.join(skills)}." if page == 0 else f"{name} worked on project {_word(rng)} using {rng.choice(skills)}.")
+            page_texts.append(f"{facts}\n{filler}")
+        is_pdf = rng.random() < pdf_ratio
+        path = os.path.join(directory, f"candidate_{seed}_{i}.{'pdf' if is_pdf else 'txt'}")
+        if is_pdf:
+            document = pymupdf.open()
+            for text in page_texts:
+                document.new_page().insert_textbox(pymupdf.Rect(40, 40, 555, 800), text, fontsize=8)
+            document.save(path)
+            document.close()
+        else:
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("\n\n".join(page_texts))
+        corpus.append({"path": path, "pages": pages, "bytes": os.path.getsize(path), "name": name, "email": email, "skills": skills})
+    return corpus
+
+
+def percentiles(seconds:list) -> dict:
+    """
+    Return:
+        latency summary in milliseconds
+    """
+    if not seconds:
+        return {}
+    latencies = np.array(seconds) * 1000
+    summary = {f"p{q}_ms": round(float(np.percentile(latencies, q)), 2) for q in (50, 90, 95, 99)}
+    summary.update({"mean_ms": round(float(latencies.mean()), 2), "max_ms": round(float(latencies.max()), 2)})
+    return summary
+
+
+def _git(*args) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True, timeout=30).stdout.strip()
+    except Exception:
+        return ""
+
+
+def write_results(benchmark:str, results:dict, output:str = None) -> str:
+    """
+    Description:
+        Prints the results and writes them as json, with the commit and the machine they were measured on,
+        so that runs of different commits can be compared with benchmarks/compare.py
+    Return:
+        path of the results file
+    """
+    commit = _git("rev-parse", "HEAD") or "unknown"
+    results = {"meta": {"benchmark": benchmark, "commit": commit, "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+                        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"), "python": platform.python_version(),
+                        "platform": platform.platform(), "cpu_count": os.cpu_count()},
+               **results}
+    path = Path(output) if output else REPO_DIR / "benchmarks" / "results" / f"{benchmark}-{commit[:10]}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(results, indent=2))
+    print(json.dumps(results, indent=2))
+    print(f"results written to {path}")
+    return str(path)
@@ -0,0 +1,545 @@
+"""
+Local stand-ins of the remote services, used by the benchmarks so that they run without network access or credentials
+"""
+import asyncio
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pymysql
+
+
+class FakePineconeIndex:
+    """
+    Mimics the upsert/update/delete/query/fetch api of pinecone.Index, including its request limits, with configurable latency and failures
+    """
+    MAX_VECTORS_PER_REQUEST = 1000
+    MAX_REQUEST_BYTES = 2 * 1024 * 1024
+
+    def __init__(self, latency_ms:float = 50.0, bytes_per_ms:float = 20000.0, failure_rate:float = 0.0, seed:int = 0):
+        """
+        Description:
+            Constructor of the stand-in
+        Arguments:
+            latency_ms: fixed round trip time of each request
+            bytes_per_ms: simulated upload bandwidth, larger payloads take longer
+            failure_rate: probability that a request fails with a transient error
+            seed: random seed of the failures
+        """
+        self.latency_ms = latency_ms
+        self.bytes_per_ms = bytes_per_ms
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.vectors = {}
+        self.requests = 0
+        self.failures = 0
+
+    def upsert(self, vectors:list):
+        size = sum(12*len(each["values"]) + len(each["id"]) + len(str(each.get("metadata", ""))) for each in vectors)
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.failure_rate
+        if len(vectors) > self.MAX_VECTORS_PER_REQUEST or size > self.MAX_REQUEST_BYTES:
+            raise Exception(f"Request too large: {len(vectors)} vectors, {size} bytes")
+        time.sleep((self.latency_ms + size / self.bytes_per_ms) / 1000)
+        if fail:
+            with self._lock:
+                self.failures += 1
+            raise Exception("503 Service Unavailable")
+        with self._lock:
+            for each in vectors:
+                self.vectors[each["id"]] = each
+        return {"upserted_count": len(vectors)}
+
+    def update(self, id:str, set_metadata:dict = None):
+        time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            if id in self.vectors:
+                self.vectors[id]["metadata"] = {**self.vectors[id].get("metadata", {}), **(set_metadata or {})}
+
+    def delete(self, ids:list = None, delete_all:bool = False):
+        time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            if delete_all:
+                self.vectors.clear()
+            for each in ids or []:
+                self.vectors.pop(each, None)
+
+    def query(self, vector:list, top_k:int, include_metadata:bool = False, include_values:bool = False):
+        time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            vectors = list(self.vectors.values())
+        query = np.asarray(vector, dtype=np.float32)
+        scored = sorted(((float(np.dot(query, each["values"])), each) for each in vectors), key=lambda pair: -pair[0])[:top_k]
+        return {"matches": [{"id": each["id"], "score": score, **({"metadata": each.get("metadata", {})} if include_metadata else {})}
+                            for score, each in scored]}
+
+    def fetch(self, ids:list):
+        time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            return {"vectors": {each: self.vectors[each] for each in ids if each in self.vectors}}
+
+
+class SQLiteMySQLConnection:
+    """
+    pymysql compatible connection backed by sqlite. Every round trip (execute, executemany, commit, ping)
+    sleeps for the configured latency so that batching and connection reuse show up as they do against mysql
+    """
+    def __init__(self, path:str, latency_ms:float = 0.5, connect_ms:float = 5.0):
+        time.sleep(connect_ms / 1000) # tcp + mysql handshake
+        self.latency_ms = latency_ms
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+
+    def _round_trip(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def cursor(self):
+        return _SQLiteCursor(self)
+
+    def commit(self):
+        self._round_trip()
+        self._conn.commit()
+
+    def rollback(self):
+        self._round_trip()
+        self._conn.rollback()
+
+    def ping(self, reconnect:bool = True):
+        self._round_trip()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# columns of the unique constraints of create_sqlite_schema -> name of the mysql index
+_SQLITE_UNIQUE_KEYS = {"booking_details.email": "uq_booking_email", "booking_details.date, booking_details.time": "uq_booking_slot"}
+
+
+class _SQLiteCursor:
+    def __init__(self, connection:SQLiteMySQLConnection):
+        self.connection = connection
+        self._cursor = connection._conn.cursor()
+        self._rows = []
+        self.rowcount = -1
+
+    @staticmethod
+    def _translate(query:str) -> str:
+        query = query.replace("%s", "?")
+        return re.sub(r"^\s*TRUNCATE TABLE", "DELETE FROM", query, flags=re.IGNORECASE)
+
+    @staticmethod
+    def _mysql_error(error:sqlite3.IntegrityError) -> pymysql.err.IntegrityError:
+        # "UNIQUE constraint failed: booking_details.date, booking_details.time" -> mysql's duplicate entry error naming the index
+        message = str(error)
+        if message.startswith("UNIQUE constraint failed: "):
+            columns = message[len("UNIQUE constraint failed: "):]
+            table = columns.split(".", 1)[0]
+            key = _SQLITE_UNIQUE_KEYS.get(columns, "PRIMARY")
+            return pymysql.err.IntegrityError(1062, f"Duplicate entry for key '{table}.{key}'")
+        return pymysql.err.IntegrityError(1048, message) # NOT NULL and the other constraints
+
+    def execute(self, query:str, args=None):
+        self.connection._round_trip()
+        try:
+            self._cursor.execute(self._translate(query), tuple(args or ()))
+        except sqlite3.IntegrityError as e:
+            raise self._mysql_error(e)
+        if self._cursor.description is not None:
+            self._rows = [dict(row) for row in self._cursor.fetchall()]
+            self.rowcount = len(self._rows) # pymysql reports the no. of selected rows
+        else:
+            self._rows = []
+            self.rowcount = self._cursor.rowcount
+        return self.rowcount
+
+    def executemany(self, query:str, args):
+        self.connection._round_trip() # pymysql sends one multi row statement
+        self._cursor.executemany(self._translate(query), [tuple(each) for each in args])
+        self.rowcount = self._cursor.rowcount
+        return self.rowcount
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._cursor.close()
+
+
+def create_sqlite_schema(path:str) -> None:
+    """
+    Description:
+        Creates the tables used by services.vectorstore.Metadata in a sqlite database
+    """
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS booking_rag_metadata (id VARCHAR(64) PRIMARY KEY, uploaded_time VARCHAR(32), source TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS booking_details (name TEXT, email VARCHAR(255), date VARCHAR(10), time VARCHAR(5), "
+                     "CONSTRAINT uq_booking_email UNIQUE (email), CONSTRAINT uq_booking_slot UNIQUE (date, time))")
+        conn.commit()
+
+
+class FakeRedis:
+    """
+    In process stand-in of a redis client for the list, string and key commands used by the app.
+    Every command, and every pipeline execute, is one round trip that sleeps for the configured latency
+    """
+    def __init__(self, latency_ms:float = 1.0, store:dict = None):
+        """
+        Description:
+            Constructor of the stand-in
+        Arguments:
+            latency_ms: round trip time to the server
+            store: data shared with other stand-in clients (e.g, an AsyncFakeRedis), a new one if not provided
+        """
+        self.latency_ms = latency_ms
+        self.store = store if store is not None else {"data": {}, "expiry": {}, "lock": threading.Lock()}
+        self.round_trips = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def _value(self, key, default=None):
+        expiry = self.store["expiry"].get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self.store["data"].pop(key, None)
+            self.store["expiry"].pop(key, None)
+        return self.store["data"].get(key, default)
+
+    @staticmethod
+    def _bounds(size:int, start:int, end:int) -> tuple:
+        # redis ranges are inclusive and accept negative indexes
+        start = max(size + start, 0) if start < 0 else start
+        end = size + end if end < 0 else end
+        return start, end + 1
+
+    def _apply(self, command:str, *args):
+        with self.store["lock"]:
+            data = self.store["data"]
+            if command == "lrange":
+                key, start, end = args
+                values = self._value(key, [])
+                start, stop = self._bounds(len(values), start, end)
+                return list(values[start:stop])
+            if command == "rpush":
+                key, *values = args
+                if self._value(key) is None:
+                    data[key] = []
+                data[key].extend(values)
+                return len(data[key])
+            if command == "ltrim":
+                key, start, end = args
+                values = self._value(key, [])
+                start, stop = self._bounds(len(values), start, end)
+                if key in data:
+                    data[key] = values[start:stop]
+                return True
+            if command == "expire":
+                key, seconds = args
+                if self._value(key) is None:
+                    return False
+                self.store["expiry"][key] = time.monotonic() + seconds
+                return True
+            if command == "get":
+                return self._value(args[0])
+            if command == "set":
+                key, value = args[0], args[1]
+                data[key] = value
+                self.store["expiry"].pop(key, None)
+                if len(args) > 2 and args[2]:
+                    self.store["expiry"][key] = time.monotonic() + args[2]
+                return True
+            if command == "delete":
+                removed = 0
+                for key in args:
+                    removed += self._value(key) is not None
+                    data.pop(key, None)
+                    self.store["expiry"].pop(key, None)
+                return removed
+            raise Exception(f"{command} not supported by the stand-in")
+
+    def _command(self, command:str, *args):
+        self._round_trip()
+        return self._apply(command, *args)
+
+    def lrange(self, key, start, end):
+        return self._command("lrange", key, start, end)
+
+    def rpush(self, key, *values):
+        return self._command("rpush", key, *values)
+
+    def ltrim(self, key, start, end):
+        return self._command("ltrim", key, start, end)
+
+    def expire(self, key, seconds):
+        return self._command("expire", key, seconds)
+
+    def get(self, key):
+        return self._command("get", key)
+
+    def set(self, key, value, ex=None):
+        return self._command("set", key, value, ex)
+
+    def delete(self, *keys):
+        return self._command("delete", *keys)
+
+    def ping(self):
+        self._round_trip()
+        return True
+
+    def pipeline(self, transaction:bool = True):
+        return _FakePipeline(self)
+
+    def close(self):
+        pass
+
+
+class _FakePipeline:
+    """
+    Queues the commands and runs them in one round trip on execute
+    """
+    def __init__(self, client:FakeRedis):
+        self._client = client
+        self._commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._commands = []
+
+    def __getattr__(self, command:str):
+        def queue(*args):
+            self._commands.append((command, args))
+            return self
+        return queue
+
+    def execute(self) -> list:
+        self._client._round_trip()
+        results = [self._client._apply(command, *args) for command, args in self._commands]
+        self._commands = []
+        return results
+
+
+class AsyncFakeRedis:
+    """
+    asyncio version of FakeRedis, sharing its store when one is given
+    """
+    def __init__(self, latency_ms:float = 1.0, store:dict = None):
+        self._client = FakeRedis(latency_ms=0, store=store)
+        self.store = self._client.store
+        self.latency_ms = latency_ms
+        self.round_trips = 0
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+    def __getattr__(self, command:str):
+        async def run(*args, **kwargs):
+            await self._round_trip()
+            return getattr(self._client, command)(*args, **kwargs)
+        return run
+
+    def pipeline(self, transaction:bool = True):
+        return _AsyncFakePipeline(self)
+
+    async def aclose(self):
+        pass
+
+
+class _AsyncFakePipeline:
+    def __init__(self, client:AsyncFakeRedis):
+        self._client = client
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._commands = []
+
+    def __getattr__(self, command:str):
+        def queue(*args):
+            self._commands.append((command, args))
+            return self
+        return queue
+
+    async def execute(self) -> list:
+        await self._client._round_trip()
+        results = [self._client._client._apply(command, *args) for command, args in self._commands]
+        self._commands = []
+        return results
+
+
+class HashingEmbeddingManager:
+    """
+    Stand-in of EmbeddingManager without a model download: a text is embedded as its hashed (signed) bag of words,
+    so texts sharing words are close. ms_per_text of busy cpu time per text stands in for the model's forward pass
+    """
+    def __init__(self, dim:int = 384, ms_per_text:float = 0.0):
+        self.dim = dim
+        self.ms_per_text = ms_per_text
+        self.model_name = f"hashing-{dim}"
+        self.texts = 0
+
+    def _embed(self, text:str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            code = zlib.crc32(word.encode("utf-8"))
+            vector[code % self.dim] += 1.0 if code & 0x80000000 else -1.0
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def generate_embeddings(self, texts:list, show_progress_bar:bool = True) -> np.ndarray:
+        if self.ms_per_text:
+            deadline = time.perf_counter() + self.ms_per_text * len(texts) / 1000
+            while time.perf_counter() < deadline: # busy, like a forward pass holding the cpu
+                pass
+        self.texts += len(texts)
+        return np.stack([self._embed(text) for text in texts]) if texts else np.zeros((0, self.dim), dtype=np.float32)
+
+    async def agenerate_embeddings(self, texts:list) -> np.ndarray:
+        return await asyncio.to_thread(self.generate_embeddings, texts, False)
+
+    def cache_stats(self) -> dict:
+        return {"texts_encoded": self.texts}
+
+
+class StubLLMServer:
+    """
+    Local http server answering OpenRouter chat completion requests (plain and streamed) after a configurable latency.
+    The answer is a "rag" reply quoting the start of the retrieved context, in the json format asked by the system prompt.
+    A share of the requests can be slow (the tail) or answered with text that is not json, per model
+    """
+    def __init__(self, latency_ms:float = 300.0, jitter_ms:float = 100.0, stream_chunks:int = 20, seed:int = 0,
+                 tail_ratio:float = 0.0, tail_ms:float = 5000.0, invalid_ratio:float = 0.0, models:dict = None):
+        """
+        Description:
+            Constructor of the stand-in, call start() to serve
+        Arguments:
+            latency_ms: mean time to the complete answer (and to the last chunk of a streamed answer)
+            jitter_ms: standard deviation of the latency
+            stream_chunks: no. of chunks of a streamed answer, the first one arrives after latency_ms / stream_chunks
+            tail_ratio: share of the requests answered after tail_ms instead
+            tail_ms: latency of the slow requests
+            invalid_ratio: share of the answers that are not json
+            models: {model name: {"latency_ms", "jitter_ms", "tail_ratio", "tail_ms", "invalid_ratio"}} overriding the above per model
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.stream_chunks = stream_chunks
+        self.tail_ratio = tail_ratio
+        self.tail_ms = tail_ms
+        self.invalid_ratio = invalid_ratio
+        self.models = models or {}
+        self.requests = 0
+        self.requests_by_model = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api/v1/chat/completions"
+
+    def _setting(self, model:str, name:str):
+        return self.models.get(model, {}).get(name, getattr(self, name))
+
+    def _behaviour(self, model:str) -> tuple:
+        """
+        Return:
+            (latency in seconds, whether the answer is valid json) of the next request to the model
+        """
+        with self._lock:
+            self.requests += 1
+            self.requests_by_model[model] = self.requests_by_model.get(model, 0) + 1
+            if self._random.random() < self._setting(model, "tail_ratio"):
+                latency = self._setting(model, "tail_ms")
+            else:
+                latency = max(self._random.gauss(self._setting(model, "latency_ms"), self._setting(model, "jitter_ms")), 0.0)
+            return latency / 1000, self._random.random() >= self._setting(model, "invalid_ratio")
+
+    @staticmethod
+    def _answer(payload:dict, valid:bool = True) -> str:
+        prompt = next((each["content"] for each in reversed(payload.get("messages", [])) if each.get("role") == "user"), "")
+        context = prompt.split("Context:", 1)[-1].split("Query:", 1)[0]
+        reply = " ".join(context.split()[:30]) or "No context was provided."
+        if not valid:
+            return f"Sure! Here is the answer: {reply}"
+        return json.dumps({"route": "rag", "booking": None, "reply": reply})
+
+    def start(self) -> "StubLLMServer":
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like the real endpoint
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                try:
+                    self._answer_request()
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True # the client cancelled the request, e.g the losing hedge
+
+            def _answer_request(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                latency, valid = stub._behaviour(payload.get("model"))
+                answer = stub._answer(payload, valid)
+                if not payload.get("stream"):
+                    time.sleep(latency)
+                    body = json.dumps({"choices": [{"message": {"role": "assistant", "content": answer}}]}).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                size = -(-len(answer) // stub.stream_chunks)
+                pieces = [answer[start:start+size] for start in range(0, len(answer), size)]
+                events = [f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n" for piece in pieces] + ["data: [DONE]\n\n"]
+                for event in events:
+                    time.sleep(latency / (len(events)))
+                    data = event.encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="stub-llm", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from services.vectorstore import Metadata
+
+
+class AvailabilityCache:
+    """
+    In memory view of the booked interview slots, so that the chat can check a slot and suggest free ones without
+    querying mysql every turn. It is read from the database when it is older than ttl_seconds, and updated by the
+    booking writes of this process (the unique indexes of the table still decide the conflicts)
+    """
+    def __init__(self,metadata:Metadata,ttl_seconds:float = None,slot_minutes:int = None,day_start:str = None,day_end:str = None,
+                 weekends:bool = False):
+        """
+        Description:
+            Constructor to initialize the cache. Nothing is read until the first lookup
+        Arguments:
+            metadata: Metadata object of the booking table
+            ttl_seconds: age after which the booked slots are read again, AVAILABILITY_TTL_SECONDS variable or 60 if not provided
+            slot_minutes: length of an interview slot, BOOKING_SLOT_MINUTES variable or 30 if not provided
+            day_start: first slot of a day (HH:MM), BOOKING_DAY_START variable or 09:00 if not provided
+            day_end: end of the last slot of a day (HH:MM), BOOKING_DAY_END variable or 17:00 if not provided
+            weekends: whether saturdays and sundays are suggested
+        """
+        self.metadata = metadata
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("AVAILABILITY_TTL_SECONDS", "60"))
+        self.slot_minutes = slot_minutes or int(os.getenv("BOOKING_SLOT_MINUTES", "30"))
+        self.day_start = day_start or os.getenv("BOOKING_DAY_START", "09:00")
+        self.day_end = day_end or os.getenv("BOOKING_DAY_END", "17:00")
+        self.weekends = weekends
+        self._lock = threading.Lock()
+        self._booked = set()
+        self._loaded_at = None
+
+    def refresh(self) -> None:
+        """
+        Description:
+            Method to read the booked slots from today on
+        """
+        booked = self.metadata.read_booked_slots(from_date=date.today().isoformat())
+        with self._lock:
+            self._booked = booked
+            self._loaded_at = time.monotonic()
+
+    def booked(self) -> set:
+        """
+        Return:
+            set of booked (date, time) slots, read again when the view is stale
+        """
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl_seconds:
+            self.refresh()
+        with self._lock:
+            return set(self._booked)
+
+    def is_free(self,booking_date:str,booking_time:str) -> bool:
+        return (booking_date, booking_time) not in self.booked()
+
+    def mark_booked(self,booking_date:str,booking_time:str) -> None:
+        """
+        Description:
+            Method to add a slot booked by this process, without reading the database
+        """
+        with self._lock:
+            self._booked.add((booking_date, booking_time))
+
+    def _day_slots(self) -> list:
+        start = datetime.strptime(self.day_start, "%H:%M")
+        end = datetime.strptime(self.day_end, "%H:%M")
+        slots = []
+        while start + timedelta(minutes=self.slot_minutes) <= end:
+            slots.append(start.strftime("%H:%M"))
+            start += timedelta(minutes=self.slot_minutes)
+        return slots
+
+    def suggest_free_slots(self,preferred_date:str = None,count:int = 3,days:int = 14,now:datetime = None) -> list:
+        """
+        Description:
+            Method to list the next free slots
+        Arguments:
+            preferred_date: day (YYYY-MM-DD) searched first, the following days are searched after it. From now if not provided
+                or not a YYYY-MM-DD date
+            count: maximum no. of slots returned
+            days: no. of days searched
+            now: reference time, slots before it are skipped. The current time if not provided
+        Return:
+            list of (date, time) tuples
+        """
+        now = now or datetime.now()
+        booked = self.booked()
+        day = now.date()
+        if preferred_date:
+            try:
+                day = max(date.fromisoformat(preferred_date), day)
+            except ValueError:
+                pass # the date of the draft comes from the llm or the extractor, e.g "March 5", search from today
+        day_slots = self._day_slots()
+        free = []
+        for _ in range(days):
+            if self.weekends or day.weekday() < 5:
+                for slot in day_slots:
+                    if day == now.date() and slot <= now.strftime("%H:%M"):
+                        continue
+                    if (day.isoformat(), slot) not in booked:
+                        free.append((day.isoformat(), slot))
+                        if len(free) == count:
+                            return free
+            day += timedelta(days=1)
+        return free
@@ -1,59 +1,219 @@
 import redis
+import redis.asyncio
 import json
+import threading
 from dotenv import load_dotenv
 import os
+from services.metrics import metrics
 
 load_dotenv() # Loads variables from .env into os.environ
 
 class ChatMemory:
-    def __init__(self, sessionid:str):
+    # connection pool shared by every sync client of the process
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, sessionid:str, redis_client:redis.Redis = None, async_redis_client:redis.asyncio.Redis = None):
         """
         Description:
             Constructor to initialize the chat memory
+        Arguments:
+            sessionid: id of the chat session
+            redis_client: already connected (shared) redis client, e.g a local stand-in. A client on the shared pool is used when it is not provided
+            async_redis_client: shared asyncio redis client used by the async methods
         """
         self.REDIS_DB_USERNAME = os.getenv("REDIS_DB_USERNAME") # access variables
         self.REDIS_DB_PASSWORD = os.getenv("REDIS_DB_PASSWORD") # access variables
         self.SESSION_TTL_SECONDS = 500 # in seconds
-        self.redis_client = self.create_connection()
+        self.MAX_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_MAX_TURNS", "20")) # older turns are trimmed by redis
+        self.redis_client = redis_client if redis_client is not None else self.create_connection()
+        self.async_redis_client = async_redis_client
         self.SESSIONID = sessionid
 
-    def create_connection(self) -> redis.Redis:
+    @classmethod
+    def _connection_settings(cls) -> dict:
+        """
+        Description:
+            Connection settings of redis. REDIS_URL (e.g, redis://localhost:6379/0 for a local redis) takes precedence
+            over REDIS_HOST/REDIS_PORT, which default to the redis cloud database
+        """
+        url = os.getenv("REDIS_URL")
+        if url:
+            return {"url": url}
+        return {
+            "host": os.getenv("REDIS_HOST", "redis-12530.c257.us-east-1-3.ec2.cloud.redislabs.com"),
+            "port": int(os.getenv("REDIS_PORT", "12530")),
+            "username": os.getenv("REDIS_DB_USERNAME"),
+            "password": os.getenv("REDIS_DB_PASSWORD"),
+        }
+
+    @classmethod
+    def create_connection(cls) -> redis.Redis:
         """"
         Description:
-            Method to create connection with redis 
+            Method to create a redis client on the process wide connection pool. The pool is bounded by REDIS_POOL_SIZE,
+            a caller waits up to REDIS_POOL_TIMEOUT seconds for a free connection
         Return:
             Redis client object
         """
         try:
-            redis_client = redis.Redis(
-                host='redis-12530.c257.us-east-1-3.ec2.cloud.redislabs.com',
-                port=12530,
-                decode_responses=True,
-                username=self.REDIS_DB_USERNAME,
-                password=self.REDIS_DB_PASSWORD,)
-            return redis_client
+            with cls._pool_lock:
+                if cls._pool is None:
+                    settings = cls._connection_settings()
+                    options = {"decode_responses": True,
+                               "max_connections": int(os.getenv("REDIS_POOL_SIZE", "50")),
+                               "timeout": float(os.getenv("REDIS_POOL_TIMEOUT", "10"))}
+                    if "url" in settings:
+                        cls._pool = redis.BlockingConnectionPool.from_url(settings["url"], **options)
+                    else:
+                        cls._pool = redis.BlockingConnectionPool(**settings, **options)
+            return redis.Redis(connection_pool=cls._pool)
+        except Exception as e:
+            raise Exception(f"Error in creating connection with redis: {e}")
+
+    @classmethod
+    def create_async_connection(cls, max_connections:int = 200) -> redis.asyncio.Redis:
+        """"
+        Description:
+            Method to create the asyncio redis client used by the async chat pipeline
+        Arguments:
+            max_connections: size of the client's connection pool
+        Return:
+            asyncio Redis client object
+        """
+        try:
+            settings = cls._connection_settings()
+            if "url" in settings:
+                return redis.asyncio.Redis.from_url(settings["url"], decode_responses=True, max_connections=max_connections)
+            return redis.asyncio.Redis(**settings, decode_responses=True, max_connections=max_connections)
         except Exception as e:
             raise Exception(f"Error in creating connection with redis: {e}")
 
+    @classmethod
+    def close_pool(cls) -> None:
+        """
+        Description:
+            Method to disconnect the process wide connection pool of the sync clients at shutdown
+        """
+        with cls._pool_lock:
+            if cls._pool is not None:
+                cls._pool.disconnect()
+                cls._pool = None
+
     def get_chat_history(self) -> list:
         """
         Docstring for get_chat_history
+        The read and the ttl refresh are sent in one pipelined round trip
         Return:
             list of chat histories
         """
         key = f"chat:{self.SESSIONID}"
-        data = self.redis_client.lrange(key,0,-1)
-        self.redis_client.expire(key, self.SESSION_TTL_SECONDS) # sets/refreshes time to live period of the specified key
+        with self.redis_client.pipeline() as pipe:
+            pipe.lrange(key,0,-1)
+            pipe.expire(key, self.SESSION_TTL_SECONDS) # sets/refreshes time to live period of the specified key
+            with metrics.span("history_read"):
+                data, _ = pipe.execute()
         return data if data else []
 
     def save_chat_history(self,history: dict) -> None:
         """
         Docstring for save_chat_history
+        The append, trim and ttl refresh are sent in one pipelined (MULTI/EXEC) round trip
 
         Arguments:
             history: history to save
 
         """
         key = f"chat:{self.SESSIONID}"
-        self.redis_client.rpush(key, json.dumps(history)) # pushes the additional history at the end of the list
-        self.redis_client.expire(key, self.SESSION_TTL_SECONDS) # sets/refreshes time to live period of the specified key
+        with self.redis_client.pipeline() as pipe:
+            pipe.rpush(key, json.dumps(history)) # pushes the additional history at the end of the list
+            pipe.ltrim(key, -self.MAX_HISTORY_TURNS, -1) # keeps only the latest turns
+            pipe.expire(key, self.SESSION_TTL_SECONDS) # sets/refreshes time to live period of the specified key
+            with metrics.span("history_write"):
+                pipe.execute()
+
+    def get_session(self) -> tuple:
+        """
+        Description:
+            Reads the chat history and the booking draft of the session in one pipelined round trip
+        Return:
+            tuple of (list of chat histories, booking draft dictionary or None)
+        """
+        key, draft_key = f"chat:{self.SESSIONID}", f"booking:{self.SESSIONID}"
+        with self.redis_client.pipeline() as pipe:
+            pipe.lrange(key,0,-1)
+            pipe.expire(key, self.SESSION_TTL_SECONDS)
+            pipe.get(draft_key)
+            with metrics.span("history_read"):
+                data, _, draft = pipe.execute()
+        return (data if data else []), (json.loads(draft) if draft else None)
+
+    def save_booking_draft(self,draft:dict | None) -> None:
+        """
+        Description:
+            Saves the booking fields collected so far, it expires with the session
+        Arguments:
+            draft: booking fields, None to delete the draft
+        """
+        draft_key = f"booking:{self.SESSIONID}"
+        with metrics.span("history_write"):
+            if draft is None:
+                self.redis_client.delete(draft_key)
+            else:
+                self.redis_client.set(draft_key, json.dumps(draft), ex=self.SESSION_TTL_SECONDS)
+
+    async def aget_session(self) -> tuple:
+        """
+        Async version of get_session
+        """
+        if self.async_redis_client is None:
+            self.async_redis_client = self.create_async_connection()
+        key, draft_key = f"chat:{self.SESSIONID}", f"booking:{self.SESSIONID}"
+        async with self.async_redis_client.pipeline() as pipe:
+            pipe.lrange(key,0,-1)
+            pipe.expire(key, self.SESSION_TTL_SECONDS)
+            pipe.get(draft_key)
+            with metrics.span("history_read"):
+                data, _, draft = await pipe.execute()
+        return (data if data else []), (json.loads(draft) if draft else None)
+
+    async def asave_booking_draft(self,draft:dict | None) -> None:
+        """
+        Async version of save_booking_draft
+        """
+        if self.async_redis_client is None:
+            self.async_redis_client = self.create_async_connection()
+        draft_key = f"booking:{self.SESSIONID}"
+        with metrics.span("history_write"):
+            if draft is None:
+                await self.async_redis_client.delete(draft_key)
+            else:
+                await self.async_redis_client.set(draft_key, json.dumps(draft), ex=self.SESSION_TTL_SECONDS)
+
+    async def aget_chat_history(self) -> list:
+        """
+        Async version of get_chat_history
+        """
+        if self.async_redis_client is None:
+            self.async_redis_client = self.create_async_connection()
+        key = f"chat:{self.SESSIONID}"
+        async with self.async_redis_client.pipeline() as pipe:
+            pipe.lrange(key,0,-1)
+            pipe.expire(key, self.SESSION_TTL_SECONDS)
+            with metrics.span("history_read"):
+                data, _ = await pipe.execute()
+        return data if data else []
+
+    async def asave_chat_history(self,history: dict) -> None:
+        """
+        Async version of save_chat_history
+        """
+        if self.async_redis_client is None:
+            self.async_redis_client = self.create_async_connection()
+        key = f"chat:{self.SESSIONID}"
+        async with self.async_redis_client.pipeline() as pipe:
+            pipe.rpush(key, json.dumps(history))
+            pipe.ltrim(key, -self.MAX_HISTORY_TURNS, -1)
+            pipe.expire(key, self.SESSION_TTL_SECONDS)
+            with metrics.span("history_write"):
+                await pipe.execute()
@@ -1,76 +1,127 @@
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import DirectoryLoader, PyMuPDFLoader, TextLoader
+from pathlib import Path
+from typing import Iterable, Iterator
+from services.parsing import ParallelParser
 # import os
 
 class Chunk:
-    def __init__(self):
+    def __init__(self, parser:ParallelParser = None):
+        """
+        Description:
+            Constructor to initialize the chunker
+        Arguments:
+            parser: ParallelParser object parsing the files, a default one is created if not provided
+        """
         self.doc_dir = f"data/booking_files"
-        
-    def create_chunk(self,strategy:str) -> list[Document] | str:# the type annotations doesnot force to be followed
+        self.supported_filetype = [".pdf",".txt"]
+        self.parser = parser if parser is not None else ParallelParser()
+        self.failed_files = {} # path -> error of the files that could not be parsed
+
+    def list_files(self) -> list[str]:
         """
         Description:
-            Chunking based on user preference
+            Lists the supported files of the document directory
+        Return:
+            sorted list of file paths
+        """
+        doc_dir = Path(self.doc_dir)
+        if not doc_dir.exists():
+            return []
+        return sorted(str(path) for path in doc_dir.glob("**/*") if path.is_file() and path.suffix in self.supported_filetype)
+
+    def parse_files(self, files:list[str] = None) -> Iterator[tuple]:
+        """
+        Description:
+            Parses the given files in parallel
+        Arguments:
+            files: paths of the files to parse. Every supported file of the document directory is parsed if not provided
+        Return:
+            generator of (path, documents, error) in the order of files. documents is None and error is the message when the file failed
+        """
+        files = self.list_files() if files is None else files
+        return self.parser.parse(files)
+
+    def iter_documents(self, files:list[str] = None) -> Iterator[Document]:
+        """
+        Description:
+            Loads the given files as documents (one document per pdf page, one per txt file), one page at a time.
+            Files that cannot be parsed are skipped and recorded in failed_files, the pages of a file read before its failure are kept
+        Arguments:
+            files: paths of the files to load. Every supported file of the document directory is loaded if not provided
+        Return:
+            generator of documents
+        """
+        for path, docs, error in self.parse_files(files):
+            if error is None:
+                try:
+                    yield from docs
+                    continue
+                except Exception as e:
+                    error = str(e)
+            print(f"Error in parsing {path}: {error}")
+            self.failed_files[path] = error
+
+    def load_documents(self, files:list[str] = None) -> list[Document]:
+        """
+        Description:
+            Loads the given files as documents (one document per pdf page, one per txt file)
+        Arguments:
+            files: paths of the files to load. Every supported file of the document directory is loaded if not provided
+        Return:
+            list of documents
+        """
+        return list(self.iter_documents(files))
+
+    def iter_chunks(self, strategy:str, docs:Iterable[Document]) -> Iterator[Document]:
+        """
+        Description:
+            Lazily chunks the documents one at a time
         Arguments:
             strategy: name of the chunking strategy. Supported strategies = "document","recursive"
+            docs: documents to chunk
         Return:
-            list of documents/chunks or, string
+            generator of documents/chunks
         """
         if strategy == "document":
             # document chunking method
-            pdf_loader = DirectoryLoader(
-                                    self.doc_dir,
-                                    glob="**/*.pdf", # filename pattern 
-                                    loader_cls=PyMuPDFLoader, # loader class to use
-                                    )
-            docs = pdf_loader.load()
-            txt_loader = DirectoryLoader(
-                                    self.doc_dir,
-                                    glob="**/*.txt", # filename pattern 
-                                    loader_kwargs={"encoding": "utf-8"},
-                                    loader_cls=TextLoader, # loader class to use
-                                    )
-            docs.extend(txt_loader.load())
-            
-            print(f"Chunks created: {len(docs)}")
-            return docs
-
+            yield from docs
         elif strategy == "recursive":
             # recursive character chunking method
-            pdf_loader = DirectoryLoader(
-                                    self.doc_dir,
-                                    glob="**/*.pdf", # filename pattern 
-                                    loader_cls=PyMuPDFLoader, # loader class to use
-                                    )
-            docs = pdf_loader.load()
-            txt_loader = DirectoryLoader(
-                                    self.doc_dir,
-                                    glob="**/*.txt", # filename pattern 
-                                    loader_kwargs={"encoding": "utf-8"},
-                                    loader_cls=TextLoader, # loader class to use
-                                    )
-            docs.extend(txt_loader.load())
             text_splitter = RecursiveCharacterTextSplitter(
                 chunk_size=1000,        # characters per chunk
                 chunk_overlap=200,      # overlap to preserve context
                 separators=["\n\n", "\n", " ", ""]
             )
-
-            chunks = text_splitter.split_documents(docs)
-            print(f"Chunks created: {len(chunks)}")
-            return chunks
-    
+            for doc in docs:
+                yield from text_splitter.split_documents([doc])
         else:
             # return f"chunking strategy not supported!!!!"
             raise Exception(f"{strategy} chunking strategy not supported!!!!")
 
+    def create_chunk(self,strategy:str,files:list[str] = None) -> list[Document] | str:# the type annotations doesnot force to be followed
+        """
+        Description:
+            Chunking based on user preference
+        Arguments:
+            strategy: name of the chunking strategy. Supported strategies = "document","recursive"
+            files: paths of the files to chunk. Every supported file of the document directory is chunked if not provided
+        Return:
+            list of documents/chunks or, string
+        """
+        if strategy not in ("document", "recursive"):
+            raise Exception(f"{strategy} chunking strategy not supported!!!!")
+        chunks = list(self.iter_chunks(strategy, self.iter_documents(files)))
+        print(f"Chunks created: {len(chunks)}")
+        return chunks
+
     def get_text_metadata(self,chunks:list[Document]) -> tuple:
         """
         Docstring for get_text_metadata
-        
+
         Arguments:
             chunks: list of documents/chunks
-        Return: 
+        Return:
             tuple of texts(list) and chunk's metadata(list)
         """
         texts = []
@@ -86,7 +137,7 @@ class Chunk:
         return (texts,chunk_metadata)
 
 # if __name__ == "__main__":
-#     chunks = Chunk().create_chunk(strategy="recursive") 
+#     chunks = Chunk().create_chunk(strategy="recursive")
 #     print(len(chunks))
 #     for each in chunks:
-#         print(each,"\n\n")
\ No newline at end of file
+#         print(each,"\n\n")
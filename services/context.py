@@ -0,0 +1,139 @@
+import json
+from collections import OrderedDict
+
+
+def estimate_tokens(text:str) -> int:
+    """
+    Description:
+        Cheap token count estimate (about 4 characters per token for english text)
+    """
+    return len(text) // 4 + 1
+
+
+class ContextAssembler:
+    """
+    Builds the history and context parts of the prompt within a token budget.
+    The last turns of the conversation are kept verbatim and the older ones are shortened,
+    retrieved chunks of the same source that overlap (the splitter uses a 200 character overlap) are merged
+    """
+    def __init__(self,max_tokens:int = 3000,recent_turns:int = 4,history_share:float = 0.35,compact_chars:int = 120,min_overlap:int = 20):
+        """
+        Description:
+            Constructor to initialize the assembler
+        Arguments:
+            max_tokens: token budget of history + context + query
+            recent_turns: no. of latest turns kept verbatim
+            history_share: maximum share of the budget used by the history
+            compact_chars: characters kept of each message of the older turns
+            min_overlap: minimum no. of characters for two chunks to be considered overlapping
+        """
+        self.max_tokens = max_tokens
+        self.recent_turns = recent_turns
+        self.history_share = history_share
+        self.compact_chars = compact_chars
+        self.min_overlap = min_overlap
+
+    def _shorten(self, text:str, chars:int) -> str:
+        text = " ".join(str(text).split())
+        return text if len(text) <= chars else text[:chars].rstrip() + "..."
+
+    def format_history(self, history:list, budget:int) -> str:
+        """
+        Description:
+            Method to format the chat history (json entries from redis) within budget tokens
+        Arguments:
+            history: chat history, oldest first
+            budget: maximum no. of tokens
+        Return:
+            history text
+        """
+        turns = []
+        for each in history:
+            try:
+                turn = json.loads(each) if isinstance(each, str) else each
+                turns.append((turn.get("user"), turn.get("assistance")))
+            except (ValueError, AttributeError):
+                continue
+        lines = []
+        recent_start = max(0, len(turns) - self.recent_turns)
+        for i, (user, assistant) in enumerate(turns):
+            if i < recent_start: # older turns are compacted
+                user = self._shorten(user, self.compact_chars)
+                assistant = self._shorten(assistant, self.compact_chars)
+            lines.append(f"User: {user}\nAssistant: {assistant}")
+        # drop the oldest turns until the history fits
+        while lines and estimate_tokens("\n".join(lines)) > budget:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def _overlap(self, first:str, second:str) -> int:
+        """
+        Description:
+            Length of the longest suffix of first that is a prefix of second
+        """
+        longest = min(len(first), len(second))
+        for size in range(longest, self.min_overlap - 1, -1):
+            if first.endswith(second[:size]):
+                return size
+        return 0
+
+    def merge_chunks(self, results:list) -> list[str]:
+        """
+        Description:
+            Method to merge the overlapping or repeated chunks of the same source
+        Arguments:
+            results: retrieved matches ("metadata" has "text" and "source"), best first
+        Return:
+            list of texts, best first
+        """
+        groups = OrderedDict() # source -> merged texts, in order of the best match of the source
+        for each in results:
+            metadata = each.get("metadata") or {}
+            text = metadata.get("text") or ""
+            if not text:
+                continue
+            texts = groups.setdefault(metadata.get("source"), [])
+            merged = False
+            for i, existing in enumerate(texts):
+                if text in existing:
+                    merged = True
+                elif existing in text:
+                    texts[i] = text
+                    merged = True
+                else:
+                    after = self._overlap(existing, text)
+                    before = self._overlap(text, existing)
+                    if after or before:
+                        texts[i] = existing + text[after:] if after >= before else text + existing[before:]
+                        merged = True
+                if merged:
+                    break
+            if not merged:
+                texts.append(text)
+        return [text for texts in groups.values() for text in texts]
+
+    def assemble(self, query:str, results:list, history:list, reserved_tokens:int = 0) -> tuple:
+        """
+        Description:
+            Method to build the history and context texts of the prompt
+        Arguments:
+            query: the user query
+            results: retrieved matches, best first
+            history: chat history, oldest first
+            reserved_tokens: tokens already used by the rest of the prompt (e.g, the system prompt)
+        Return:
+            tuple of (history text, context text)
+        """
+        budget = max(0, self.max_tokens - reserved_tokens - estimate_tokens(query))
+        history_text = self.format_history(history, int(budget * self.history_share))
+        remaining = budget - estimate_tokens(history_text)
+        parts = []
+        for text in self.merge_chunks(results):
+            tokens = estimate_tokens(text)
+            if tokens > remaining:
+                if remaining > 50: # keep the beginning of the chunk that doesnot fit
+                    parts.append(text[:remaining * 4])
+                break
+            parts.append(text)
+            remaining -= tokens
+        return history_text, "\n\n".join(parts)
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections. Idle connections are reused (last in first out) and
+    checked with ping() before reuse when they have been idle for longer than the health check interval
+    """
+    def __init__(self, factory:Callable, max_size:int = 5, timeout:float = 10.0, health_check_interval:float = 30.0):
+        """
+        Description:
+            Constructor to initialize the pool. Connections are opened lazily
+        Arguments:
+            factory: function returning a new connection
+            max_size: maximum no. of open connections
+            timeout: seconds to wait for a free connection before failing
+            health_check_interval: idle seconds after which a connection is pinged before reuse
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue() # (connection, time it was returned)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.created = 0
+        self.discarded = 0
+        self._closed = False # once closed, the connections are not kept after use
+
+    def _healthy(self, connection, idle_since:float) -> bool:
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            connection.ping(reconnect=True)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection) -> None:
+        self.discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Description:
+            Borrows a connection for the duration of the with block. The transaction is rolled back and
+            the connection is dropped if the block raises, otherwise it goes back to the pool
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Exception(f"No database connection available after {self.timeout} seconds (pool size = {self.max_size})")
+        connection = None
+        try:
+            while connection is None:
+                try:
+                    connection, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    connection = self.factory()
+                    self.created += 1
+                    break
+                if not self._healthy(connection, idle_since):
+                    self._discard(connection)
+                    connection = None
+            try:
+                yield connection
+            except Exception:
+                self._discard(connection)
+                connection = None
+                raise
+        finally:
+            if connection is not None:
+                if self._closed:
+                    self._discard(connection)
+                else:
+                    self._idle.put((connection, time.monotonic()))
+            self._slots.release()
+
+    def close(self) -> None:
+        """
+        Description:
+            Closes every idle connection, the borrowed ones are closed when they are returned
+        """
+        self._closed = True
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+    def stats(self) -> dict:
+        return {"max_size": self.max_size, "idle": self._idle.qsize(), "created": self.created, "discarded": self.discarded}
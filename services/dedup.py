@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import threading
+import zlib
+from collections import defaultdict
+import numpy as np
+
+_WORD = re.compile(r"\w+")
+_PRIME = (1 << 61) - 1 # mersenne prime of the universal hash family
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts over word shingles. The share of equal signature values of two texts
+    estimates the Jaccard similarity of their shingle sets
+    """
+    def __init__(self,num_perm:int = 64,shingle_size:int = 3,seed:int = 1):
+        """
+        Description:
+            Constructor to initialize the hash functions
+        Arguments:
+            num_perm: no. of hash functions, i.e length of a signature
+            shingle_size: no. of words per shingle
+            seed: random seed of the hash functions, signatures are only comparable with the same seed
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # a*x + b stays below 2**64 for 32 bit a, b and x
+        self._a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text:str) -> np.ndarray:
+        """
+        Description:
+            Method to compute the signature of a text
+        Return:
+            uint32 array of num_perm values
+        """
+        words = _WORD.findall(text.lower())
+        size = self.shingle_size
+        shingles = {" ".join(words[i:i+size]) for i in range(max(1, len(words) - size + 1))}
+        hashes = np.fromiter((zlib.crc32(each.encode("utf-8")) for each in shingles), dtype=np.uint64, count=len(shingles))
+        values = (hashes[:, None] * self._a + self._b) % _PRIME
+        return (values.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+
+class DedupIndex:
+    """
+    Persistent index of the stored (canonical) chunks for near duplicate detection. MinHash signatures are bucketed
+    with LSH (bands of the signature), so a new chunk is only compared with the chunks sharing a band.
+    Every canonical chunk records the source files of the chunks that were collapsed into it
+    """
+    def __init__(self,index_dir:str = "data/dedup_index",threshold:float = 0.9,num_perm:int = 64,bands:int = 16):
+        """
+        Description:
+            Constructor to load (or create) the index
+        Arguments:
+            index_dir: directory of the index files
+            threshold: minimum estimated Jaccard similarity of two chunks to be duplicates
+            num_perm: length of the MinHash signatures
+            bands: no. of LSH bands, more bands find less similar candidates
+        """
+        if num_perm % bands:
+            raise Exception(f"num_perm {num_perm} is not a multiple of bands {bands}")
+        self.index_dir = index_dir
+        self.threshold = threshold
+        self.bands = bands
+        self.hasher = MinHasher(num_perm=num_perm)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._index_path = os.path.join(self.index_dir, "index.npz")
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self) -> None:
+        self.ids = []
+        self.sources = {} # canonical chunk id -> its source files, the first one is the original
+        signatures = np.zeros((0, self.hasher.num_perm), dtype=np.uint32)
+        if os.path.exists(self._index_path):
+            with np.load(self._index_path) as state:
+                self.ids = [str(each) for each in state["ids"]]
+                self.sources = json.loads(str(state["sources"]))
+                signatures = state["signatures"]
+        self._signatures = list(signatures)
+        self._rows = {each: row for row, each in enumerate(self.ids)}
+        self._buckets = defaultdict(list) # (band, band values) -> rows
+        for row, signature in enumerate(self._signatures):
+            self._bucket(row, signature)
+
+    def _band_keys(self, signature:np.ndarray) -> list:
+        rows = len(signature) // self.bands
+        return [(band, signature[band*rows:(band+1)*rows].tobytes()) for band in range(self.bands)]
+
+    def _bucket(self, row:int, signature:np.ndarray) -> None:
+        for key in self._band_keys(signature):
+            self._buckets[key].append(row)
+
+    def find(self, signature:np.ndarray) -> str | None:
+        """
+        Description:
+            Method to find a stored chunk that is a near duplicate of the signature's chunk
+        Return:
+            id of the most similar canonical chunk above the threshold, None if there is none
+        """
+        with self._lock:
+            candidates = {row for key in self._band_keys(signature) for row in self._buckets.get(key, [])}
+            candidates = [row for row in candidates if self.ids[row] is not None]
+            if not candidates:
+                return None
+            similarity = (np.stack([self._signatures[row] for row in candidates]) == signature).mean(axis=1)
+            best = int(np.argmax(similarity))
+            return self.ids[candidates[best]] if similarity[best] >= self.threshold else None
+
+    def add(self, chunk_id:str, signature:np.ndarray, source:str) -> None:
+        """
+        Description:
+            Method to register a stored chunk as canonical
+        """
+        with self._lock:
+            if chunk_id in self._rows:
+                return
+            row = len(self.ids)
+            self.ids.append(chunk_id)
+            self._signatures.append(signature)
+            self._rows[chunk_id] = row
+            self.sources[chunk_id] = [source]
+            self._bucket(row, signature)
+
+    def add_source(self, chunk_id:str, source:str) -> list[str]:
+        """
+        Description:
+            Method to record that a chunk of source was collapsed into the canonical chunk
+        Return:
+            all the sources of the canonical chunk
+        """
+        with self._lock:
+            sources = self.sources.setdefault(chunk_id, [])
+            if source not in sources:
+                sources.append(source)
+            return list(sources)
+
+    def remove_source(self, chunk_id:str, source:str) -> list[str]:
+        """
+        Description:
+            Method to forget a source of a canonical chunk, e.g when the file is deleted or changed
+        Return:
+            remaining sources of the canonical chunk
+        """
+        with self._lock:
+            sources = self.sources.get(chunk_id, [])
+            if source in sources:
+                sources.remove(source)
+            return list(sources)
+
+    def delete(self, ids:list) -> None:
+        """
+        Description:
+            Method to forget deleted chunks. Their rows are tombstoned and dropped on the next save
+        """
+        with self._lock:
+            for chunk_id in ids:
+                row = self._rows.pop(chunk_id, None)
+                if row is not None:
+                    self.ids[row] = None
+                self.sources.pop(chunk_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.ids = []
+            self.sources = {}
+            self._signatures = []
+            self._rows = {}
+            self._buckets = defaultdict(list)
+
+    def save(self) -> None:
+        """
+        Description:
+            Method to write the index to disk, dropping the deleted rows
+        """
+        with self._lock:
+            kept = [row for row, each in enumerate(self.ids) if each is not None]
+            signatures = np.stack([self._signatures[row] for row in kept]) if kept else np.zeros((0, self.hasher.num_perm), dtype=np.uint32)
+            ids = [self.ids[row] for row in kept]
+            sources = json.dumps({each: self.sources.get(each, []) for each in ids})
+            # one file replaced atomically, the signatures and the ids always match
+            tmp_path = f"{self._index_path}.tmp.npz"
+            np.savez(tmp_path, signatures=signatures, ids=np.array(ids, dtype=str), sources=np.array(sources))
+            os.replace(tmp_path, self._index_path)
+            if len(kept) != len(self.ids):
+                self._load()
@@ -0,0 +1,225 @@
+import json
+import mmap
+import os
+import threading
+
+
+class DocStore:
+    """
+    Local store of the chunk texts keyed by chunk id, so that the vector and lexical indexes only keep ids and small metadata.
+    Texts are appended to a blob file that is memory mapped for reading, and an append-only log of json lines maps every
+    id to the offset and length of its text (the last line of an id wins, deleted ids get a tombstone line).
+    The first line of the log names its blob, compaction writes a new blob and swaps the log atomically.
+    Other processes pick up the new lines of the log on their next lookup
+    """
+    def __init__(self,store_dir:str = "data/docstore",compact_ratio:float = 0.5):
+        """
+        Description:
+            Constructor to load (or create) the docstore
+        Arguments:
+            store_dir: directory of the blob and log files
+            compact_ratio: share of unused bytes in the blob from which delete() compacts the files
+        """
+        self.store_dir = store_dir
+        self.compact_ratio = compact_ratio
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._log_path = os.path.join(self.store_dir, "index.log")
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self._log_path) or os.path.getsize(self._log_path) == 0:
+            self._write_log("texts_0.bin", [])
+        with open(self._log_path, "rb") as file:
+            header = file.readline()
+        self._blob_path = os.path.join(self.store_dir, json.loads(header)["blob"])
+        if not os.path.exists(self._blob_path):
+            open(self._blob_path, "ab").close()
+        self._entries = {} # chunk id -> (offset, length, metadata)
+        self._log_size = len(header)
+        self._log_inode = os.stat(self._log_path).st_ino
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+        self._map = None
+        self._map_size = 0
+        self._refresh()
+
+    def _write_log(self, blob_name:str, entries:list) -> None:
+        """
+        Description:
+            Atomically replaces the log with a new one naming blob_name
+        """
+        tmp_path = f"{self._log_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(json.dumps({"blob": blob_name}).encode("utf-8") + b"\n")
+            for each in entries:
+                file.write(json.dumps(each, separators=(",", ":")).encode("utf-8") + b"\n")
+        os.replace(tmp_path, self._log_path)
+
+    def _next_blob(self) -> str:
+        generation = int(os.path.basename(self._blob_path)[len("texts_"):-len(".bin")]) + 1
+        return f"texts_{generation}.bin"
+
+    def _refresh(self) -> None:
+        """
+        Description:
+            Reads the log lines appended since the last call, reloads everything if the files were replaced (compacted or cleared)
+        """
+        stat = os.stat(self._log_path)
+        if stat.st_ino != self._log_inode:
+            self._load()
+            return
+        if stat.st_size == self._log_size:
+            return
+        with open(self._log_path, "rb") as file:
+            file.seek(self._log_size)
+            tail = file.read(stat.st_size - self._log_size)
+        complete = tail.rfind(b"\n") + 1 # a line being written by another process is read next time
+        for line in tail[:complete].splitlines():
+            entry = json.loads(line)
+            if entry.get("deleted"):
+                self._entries.pop(entry["id"], None)
+            else:
+                self._entries[entry["id"]] = (entry["offset"], entry["length"], entry.get("metadata", {}))
+        self._log_size += complete
+
+    def _blob(self) -> mmap.mmap | None:
+        size = os.path.getsize(self._blob_path)
+        if size == 0:
+            return None
+        if self._map is None or size != self._map_size:
+            if self._map is not None:
+                self._map.close()
+            with open(self._blob_path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_size = size
+        return self._map
+
+    def _append_log(self, entries:list) -> None:
+        lines = b"".join(json.dumps(each, separators=(",", ":")).encode("utf-8") + b"\n" for each in entries)
+        with open(self._log_path, "ab") as file:
+            file.write(lines)
+        self._refresh()
+
+    def put(self, ids:list, texts:list, metadata:list = None) -> None:
+        """
+        Description:
+            Method to store the texts of chunks. Chunk ids are content hashes, so ids already stored are skipped
+        Arguments:
+            ids: chunk ids
+            texts: texts of the chunks
+            metadata: small metadata of the chunks (e.g source), returned with the texts
+        """
+        with self._lock:
+            self._refresh()
+            metadata = metadata or [{} for _ in ids]
+            new = [(each, text.encode("utf-8"), meta) for each, text, meta in zip(ids, texts, metadata) if each not in self._entries]
+            if not new:
+                return
+            # the texts are written before the log lines pointing to them
+            with open(self._blob_path, "ab") as file:
+                offset = file.tell()
+                file.write(b"".join(data for _, data, _ in new))
+            entries = []
+            for chunk_id, data, meta in new:
+                entries.append({"id": chunk_id, "offset": offset, "length": len(data), "metadata": meta})
+                offset += len(data)
+            self._append_log(entries)
+
+    def update_metadata(self, ids:list, metadata:list) -> None:
+        """
+        Description:
+            Method to change some metadata fields of stored chunks, the other fields are kept
+        """
+        with self._lock:
+            self._refresh()
+            entries = []
+            for chunk_id, each in zip(ids, metadata):
+                if chunk_id in self._entries:
+                    offset, length, current = self._entries[chunk_id]
+                    entries.append({"id": chunk_id, "offset": offset, "length": length, "metadata": {**current, **each}})
+            if entries:
+                self._append_log(entries)
+
+    def get(self, ids:list) -> list[dict | None]:
+        """
+        Description:
+            Method to look up chunks in one batch
+        Arguments:
+            ids: chunk ids
+        Return:
+            list of {"text", **metadata} in the order of ids, None for the unknown ids
+        """
+        with self._lock:
+            self._refresh()
+            blob = self._blob()
+            results = []
+            for chunk_id in ids:
+                entry = self._entries.get(chunk_id)
+                if entry is None or blob is None:
+                    results.append(None)
+                    continue
+                offset, length, metadata = entry
+                results.append({**metadata, "text": blob[offset:offset+length].decode("utf-8")})
+            return results
+
+    def resolve(self, results:list[dict]) -> list[dict]:
+        """
+        Description:
+            Method to fill the metadata of search results ({"id","score","metadata"}) with the stored texts
+        """
+        docs = self.get([each["id"] for each in results])
+        return [{**each, "metadata": {**each.get("metadata", {}), **doc}} if doc is not None else each
+                for each, doc in zip(results, docs)]
+
+    def delete(self, ids:list) -> None:
+        """
+        Description:
+            Method to forget chunks. Their bytes stay in the blob until it is compacted
+        """
+        with self._lock:
+            self._refresh()
+            entries = [{"id": each, "deleted": True} for each in ids if each in self._entries]
+            if not entries:
+                return
+            self._append_log(entries)
+            used = sum(length for _, length, _ in self._entries.values())
+            size = os.path.getsize(self._blob_path)
+            if size and (size - used) / size > self.compact_ratio:
+                self.compact()
+
+    def compact(self) -> None:
+        """
+        Description:
+            Method to rewrite the blob and the log with the live chunks only. The new files replace the old ones atomically
+        """
+        with self._lock:
+            self._refresh()
+            blob = self._blob()
+            old_blob, blob_name = self._blob_path, self._next_blob()
+            entries, offset = [], 0
+            with open(os.path.join(self.store_dir, blob_name), "wb") as file:
+                for chunk_id, (start, length, metadata) in self._entries.items():
+                    file.write(blob[start:start+length])
+                    entries.append({"id": chunk_id, "offset": offset, "length": length, "metadata": metadata})
+                    offset += length
+            # readers switch to the new blob with the log, the old blob stays readable through their open maps
+            self._write_log(blob_name, entries)
+            self._load()
+            os.remove(old_blob)
+
+    def clear(self) -> None:
+        """
+        Description:
+            Method to delete every chunk
+        """
+        with self._lock:
+            old_blob = self._blob_path
+            self._write_log(self._next_blob(), [])
+            self._load()
+            os.remove(old_blob)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
@@ -1,50 +1,301 @@
 ## Embedding
+import asyncio
 import numpy as np
+import os
+import queue
+import threading
+import time
+import torch
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
 from  sentence_transformers import SentenceTransformer # this is our embedding model
 from typing import List
 from services.chunking import Chunk
+from services.embedding_cache import EmbeddingCache
+from services.metrics import metrics
+
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
 
 
 class EmbeddingManager: 
     """
-    handles document embedding generation using sentence transformer model
+    handles document embedding generation using sentence transformer model.
+    The model runs on one of the cpu backends:
+        torch = pytorch in fp32 (reference)
+        torch-int8 = pytorch with the linear layers dynamically quantized to int8
+        onnx = onnx runtime, needs the onnx extra of sentence-transformers (pip install "sentence-transformers[onnx]")
+        onnx-int8 = onnx runtime with the int8 quantized onnx export of the model
     """
-    def __init__(self,model_name:str="all-MiniLM-L6-v2"): 
+    def __init__(self,model_name:str="all-MiniLM-L6-v2",use_cache:bool=True,backend:str=None,threads:int=None,batch_size:int=None): 
         """
         Constructor to initialize the EmbeddingManager
         Arguments:
             model_name = hugging face sentence transformer model name
+            use_cache = reuse embeddings of already seen texts from the on disk cache
+            backend = one of BACKENDS, EMBEDDING_BACKEND variable or torch if not provided
+            threads = no. of cpu threads used by the model, EMBEDDING_THREADS variable or the library default if not provided
+            batch_size = no. of texts per forward pass, EMBEDDING_ENCODE_BATCH_SIZE variable or 32 if not provided
         """
         self.model_name = model_name
+        self.backend = backend or os.getenv("EMBEDDING_BACKEND","torch")
+        if self.backend not in BACKENDS:
+            raise Exception(f"Embedding backend {self.backend} not supported, use one of {BACKENDS}")
+        self.threads = threads or (int(os.getenv("EMBEDDING_THREADS")) if os.getenv("EMBEDDING_THREADS") else None)
+        self.batch_size = batch_size or int(os.getenv("EMBEDDING_ENCODE_BATCH_SIZE","32"))
         self.model = None
+        self.cache = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._stats_lock = threading.Lock()
+        self._executor = None
         self._load_model()
+        if use_cache:
+            # the backends give slightly different vectors, each one has its own cache
+            self.cache = EmbeddingCache(
+                model_name=self.model_name if self.backend == "torch" else f"{self.model_name}@{self.backend}",
+                dim=self.model.get_sentence_embedding_dimension(),
+                cache_dir=os.getenv("EMBEDDING_CACHE_DIR","data/embedding_cache"),
+                capacity=int(os.getenv("EMBEDDING_CACHE_SIZE","50000")),
+            )
 
     def _load_model(self) -> None:
         """
         Load the specified sentence transformer model
         """
         try:
-            print(f"Loading embedding model: {self.model_name}")
-            self.model = SentenceTransformer(self.model_name)
-            print(f"Loaded embedding model successfully. Embedding Dimensions = {self.model.get_sentence_embedding_dimension}")
+            print(f"Loading embedding model: {self.model_name} ({self.backend} backend)")
+            if self.backend.startswith("onnx"):
+                model_kwargs = {"provider": "CPUExecutionProvider"}
+                if self.backend == "onnx-int8":
+                    model_kwargs["file_name"] = os.getenv("EMBEDDING_ONNX_INT8_FILE","onnx/model_qint8_avx2.onnx")
+                if self.threads:
+                    import onnxruntime
+                    session_options = onnxruntime.SessionOptions()
+                    session_options.intra_op_num_threads = self.threads
+                    model_kwargs["session_options"] = session_options
+                self.model = SentenceTransformer(self.model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+            else:
+                if self.threads:
+                    torch.set_num_threads(self.threads)
+                self.model = SentenceTransformer(self.model_name, device="cpu")
+                if self.backend == "torch-int8":
+                    # int8 weights, the activations are quantized on the fly
+                    torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+                self.model.eval()
+            print(f"Loaded embedding model successfully. Embedding Dimensions = {self.model.get_sentence_embedding_dimension()}")
         except Exception as  e:
             raise Exception(f"Error loading model{self.model_name} = {str(e)}")
 
-    def generate_embeddings(self,texts:List[str]) -> np.array:
+    def _encode(self,texts:List[str],show_progress_bar:bool=False) -> np.ndarray:
+        """
+        Runs the model. sentence transformers sorts the texts by length before batching,
+        so every batch holds texts of similar length and little padding is computed
+        """
+        with metrics.span("encode"), torch.inference_mode():
+            return self.model.encode(texts,batch_size=self.batch_size,show_progress_bar=show_progress_bar,convert_to_numpy=True)
+
+    def check_parity(self,texts:List[str],reference:np.ndarray=None,min_cosine:float=0.99) -> dict:
+        """
+        Compares the embeddings of the backend with the reference fp32 pytorch model
+        Arguments:
+            texts = texts to compare on
+            reference = embeddings of texts by the reference model, computed (loading the reference model) if not provided
+            min_cosine = minimum cosine similarity of every text for the check to pass
+        Return:
+            dictionary with the min/mean cosine similarity and whether the check passed
+        """
+        if reference is None:
+            reference = SentenceTransformer(self.model_name, device="cpu").encode(texts,batch_size=self.batch_size,convert_to_numpy=True)
+        embeddings = self._encode(texts)
+        cosine = np.sum(embeddings * reference, axis=1) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1) + 1e-12)
+        result = {"backend": self.backend, "texts": len(texts), "min_cosine": round(float(cosine.min()), 5),
+                  "mean_cosine": round(float(cosine.mean()), 5), "min_required": min_cosine, "passed": bool(cosine.min() >= min_cosine)}
+        if not result["passed"]:
+            print(f"Embedding parity check failed: {result}")
+        return result
+
+    def generate_embeddings(self,texts:List[str],show_progress_bar:bool=True) -> np.array:
         """
         Generates embeddings for list of text
         Arguments:
-            List of texts whose embedding is to be generated
+            texts = List of texts whose embedding is to be generated
+            show_progress_bar = display the encoding progress and log messages
         Return:
             numpy array with shape = (len(texts),embedding_dimensions)
         """
         if not self.model:
             raise ValueError("Model not loaded")
-        print(f"Creating embeddings for {len(texts)} texts.")
-        embeddings = self.model.encode(texts,show_progress_bar=True)
-        print(f"Embeddings generated successfully with shape = {embeddings.shape}")
+        if self.cache is None:
+            if show_progress_bar:
+                print(f"Creating embeddings for {len(texts)} texts.")
+            embeddings = self._encode(texts,show_progress_bar=show_progress_bar)
+            if show_progress_bar:
+                print(f"Embeddings generated successfully with shape = {embeddings.shape}")
+            return embeddings
+
+        keys = self.cache.make_keys(texts)
+        embeddings, missing = self.cache.get(keys)
+        if missing:
+            # identical texts inside the batch are encoded only once
+            unique = {}
+            for i in missing:
+                unique.setdefault(keys[i], texts[i])
+            if show_progress_bar:
+                print(f"Creating embeddings for {len(unique)} texts ({len(texts) - len(missing)} found in cache).")
+            encoded = self._encode(list(unique.values()),show_progress_bar=show_progress_bar)
+            self.cache.put(list(unique.keys()), encoded)
+            rows = dict(zip(unique.keys(), encoded))
+            for i in missing:
+                embeddings[i] = rows[keys[i]]
+        with self._stats_lock:
+            self.cache_hits += len(texts) - len(missing)
+            self.cache_misses += len(missing)
+        if show_progress_bar:
+            print(f"Embeddings generated successfully with shape = {embeddings.shape}")
         return embeddings
 
+    async def agenerate_embeddings(self,texts:List[str]) -> np.array:
+        """
+        Async version of generate_embeddings. Encoding is cpu bound, so it runs on a small thread pool
+        instead of blocking the event loop
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=int(os.getenv("EMBEDDING_WORKERS","2")), thread_name_prefix="embedding")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.generate_embeddings, texts, False)
+
+    def cache_stats(self) -> dict:
+        """
+        Returns the embedding cache counters
+        """
+        with self._stats_lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "enabled": self.cache is not None,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+                "size": len(self.cache) if self.cache is not None else 0,
+            }
+
+
+class EmbeddingBatcher:
+    """
+    Groups the query embeddings requested concurrently (e.g, by parallel chat requests) into one forward pass.
+    Requests are queued and a worker thread encodes them once max_batch_size requests are waiting
+    or the oldest one has waited max_wait_ms, whichever comes first
+    """
+    def __init__(self,embedding_manager:EmbeddingManager,max_batch_size:int=32,max_wait_ms:float=5.0):
+        """
+        Constructor to initialize the batcher
+        Arguments:
+            embedding_manager = EmbeddingManager object used for encoding
+            max_batch_size = maximum no. of texts encoded together, larger batches give more throughput
+            max_wait_ms = maximum time a request waits for other requests, smaller values give lower latency
+        """
+        self.embedding_manager = embedding_manager
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.wait_seconds = 0.0 # time spent in the queue, summed over requests
+        self.encode_seconds = 0.0 # time spent encoding, summed over batches
+        self._started = time.perf_counter()
+
+    def submit(self,text:str) -> Future:
+        """
+        Queues a text to encode
+        Return:
+            future resolved with the embedding of the text
+        """
+        if self._worker is None:
+            with self._start_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._worker.start()
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def encode(self,text:str) -> np.ndarray:
+        """
+        Encodes one text, waiting for its batch
+        """
+        return self.submit(text).result()
+
+    async def aencode(self,text:str) -> np.ndarray:
+        """
+        Async version of encode
+        """
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._encode_batch(batch)
+            except Exception as e:
+                # the worker serves every later request, it must outlive any failure of a batch
+                print(f"Embedding batch failed: {e}")
+                for _, future, _ in batch:
+                    self._resolve(future, exception=e)
+
+    def _encode_batch(self,batch:list) -> None:
+        # requests whose caller went away (e.g, a disconnected stream cancels its future) are not encoded
+        batch = [each for each in batch if each[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        embeddings = self.embedding_manager.generate_embeddings([each[0] for each in batch],show_progress_bar=False)
+        finished = time.perf_counter()
+        for (_, future, _), embedding in zip(batch, embeddings):
+            self._resolve(future, result=embedding)
+        with self._stats_lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.wait_seconds += sum(started - queued for _, _, queued in batch)
+            self.encode_seconds += finished - started
+
+    @staticmethod
+    def _resolve(future:Future,result=None,exception:Exception = None) -> None:
+        if future.done():
+            return
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def stats(self) -> dict:
+        """
+        Returns the batching counters
+        """
+        with self._stats_lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "avg_queue_wait_ms": round(1000 * self.wait_seconds / self.items, 3) if self.items else 0.0,
+                "avg_encode_ms": round(1000 * self.encode_seconds / self.batches, 3) if self.batches else 0.0,
+                "throughput_per_second": round(self.items / elapsed, 2) if elapsed else 0.0,
+            }
+
 
 # if __name__ == "__main__":
 #     chunk_obj = Chunk()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import numpy as np
+from typing import List, Tuple
+
+try:
+    import fcntl # posix file locks
+except ImportError: # windows
+    fcntl = None
+    import msvcrt
+
+
+class _FileLock:
+    """
+    Exclusive lock on a file, so that several processes can share the same cache directory
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self._thread_lock = threading.Lock() # file locks donot exclude threads of the same process
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._thread_lock.release()
+
+
+class EmbeddingCache:
+    """
+    On disk embedding cache keyed by model name and text hash.
+    Vectors live in a memory mapped float32 matrix of fixed capacity, the index file maps each slot to its key
+    and to the last time it was used so that the least recently used slots are evicted first
+    """
+    KEY_BYTES = 32 # hex characters of the hash, fixed width byte strings drop trailing null bytes so raw digests are not used
+
+    def __init__(self, model_name:str, dim:int, cache_dir:str = "data/embedding_cache", capacity:int = 50000):
+        """
+        Description:
+            Constructor to open (or create) the cache of a model
+        Arguments:
+            model_name: name of the embedding model, every model gets its own cache directory
+            dim: embedding dimensions of the model
+            cache_dir: root directory of the caches
+            capacity: maximum no. of embeddings kept on disk
+        """
+        self.model_name = model_name
+        self.dim = int(dim)
+        self.capacity = int(capacity)
+        self.dir = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        os.makedirs(self.dir, exist_ok=True)
+        self._lock = _FileLock(os.path.join(self.dir, ".lock"))
+        self._slots = {} # key -> slot, rebuilt whenever another process changed the index
+        self._generation = -1
+        with self._lock:
+            self._open()
+
+    def _open(self) -> None:
+        """
+        Description:
+            Maps the cache files, (re)creating them when they donot match the model dimensions or capacity
+        """
+        meta_path = os.path.join(self.dir, "meta.json")
+        meta = {"model": self.model_name, "dim": self.dim, "capacity": self.capacity}
+        paths = [os.path.join(self.dir, name) for name in ("vectors.f32", "index.npy", "state.npy")]
+        existing = None
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as file:
+                existing = json.load(file)
+        fresh = existing != meta or not all(os.path.exists(path) for path in paths)
+        mode = "w+" if fresh else "r+"
+        if fresh:
+            print(f"Creating embedding cache at {self.dir}")
+        self.vectors = np.memmap(paths[0], dtype=np.float32, mode=mode, shape=(self.capacity, self.dim))
+        index_dtype = np.dtype([("key", f"S{self.KEY_BYTES}"), ("tick", np.int64)])
+        if fresh:
+            self.index = np.lib.format.open_memmap(paths[1], mode="w+", dtype=index_dtype, shape=(self.capacity,))
+            self.state = np.lib.format.open_memmap(paths[2], mode="w+", dtype=np.int64, shape=(2,)) # generation, clock
+            self.index.flush()
+            self.state.flush()
+            with open(meta_path, "w", encoding="utf-8") as file:
+                json.dump(meta, file)
+        else:
+            self.index = np.lib.format.open_memmap(paths[1], mode="r+")
+            self.state = np.lib.format.open_memmap(paths[2], mode="r+")
+
+    def _refresh(self) -> None:
+        """
+        Description:
+            Rebuilds the in memory key -> slot map if the index was changed (by this or another process)
+        """
+        generation = int(self.state[0])
+        if generation != self._generation:
+            keys = self.index["key"]
+            used = np.flatnonzero(keys != b"")
+            self._slots = dict(zip(keys[used].tolist(), used.tolist()))
+            self._generation = generation
+
+    def make_keys(self, texts:List[str]) -> List[bytes]:
+        """
+        Description:
+            Hashes the texts together with the model name
+        """
+        prefix = f"{self.model_name}\x00".encode("utf-8")
+        return [hashlib.sha256(prefix + text.encode("utf-8")).hexdigest()[:self.KEY_BYTES].encode("ascii") for text in texts]
+
+    def get(self, keys:List[bytes]) -> Tuple[np.ndarray, List[int]]:
+        """
+        Description:
+            Looks up the embeddings of the given keys
+        Arguments:
+            keys: keys created by make_keys
+        Return:
+            tuple of (len(keys), dim) float32 array having the cached rows filled, and positions of the missing keys
+        """
+        result = np.zeros((len(keys), self.dim), dtype=np.float32)
+        with self._lock:
+            self._refresh()
+            positions, slots, missing = [], [], []
+            for i, key in enumerate(keys):
+                slot = self._slots.get(key)
+                if slot is None:
+                    missing.append(i)
+                else:
+                    positions.append(i)
+                    slots.append(slot)
+            if slots:
+                result[positions] = self.vectors[slots]
+                self.state[1] += 1
+                self.index["tick"][slots] = self.state[1] # mark as recently used
+        return result, missing
+
+    def put(self, keys:List[bytes], vectors:np.ndarray) -> None:
+        """
+        Description:
+            Stores embeddings, evicting the least recently used ones when the cache is full
+        Arguments:
+            keys: keys created by make_keys
+            vectors: embeddings of the keys, shape = (len(keys), dim)
+        """
+        with self._lock:
+            self._refresh()
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self._slots:
+                    new[key] = vector
+            if not new:
+                return
+            items = list(new.items())[-self.capacity:] # a batch larger than the cache keeps only its tail
+            free = np.flatnonzero(self.index["key"] == b"")[:len(items)]
+            if len(free) < len(items):
+                used = np.flatnonzero(self.index["key"] != b"")
+                oldest = used[np.argsort(self.index["tick"][used], kind="stable")[:len(items) - len(free)]]
+                for slot in oldest.tolist():
+                    del self._slots[self.index["key"][slot]]
+                free = np.concatenate([free, oldest])
+            self.state[1] += 1
+            slots = free.tolist()
+            self.vectors[slots] = np.asarray([vector for _, vector in items], dtype=np.float32)
+            self.index["key"][slots] = [key for key, _ in items]
+            self.index["tick"][slots] = self.state[1]
+            self._slots.update(zip((key for key, _ in items), slots))
+            self.vectors.flush()
+            self.index.flush()
+            self.state[0] += 1 # tells the other processes to rebuild their key -> slot map
+            self.state.flush()
+            self._generation = int(self.state[0])
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._slots)
@@ -0,0 +1,102 @@
+import time
+from services.chunking import Chunk
+from services.embedding import EmbeddingManager
+from services.vectorstore import BaseVectorStore
+from services.manifest import IngestionManifest, bump_corpus_version
+from services.pipeline import IngestionPipeline
+from services.lexical import BM25Index
+from services.dedup import DedupIndex
+
+
+class IncrementalIngestor:
+    """
+    Ingests only what changed since the last run: new or modified files are parsed, new chunks are embedded
+    and upserted, and the chunks that disappeared are deleted from the vector store and the sql metadata.
+    The changed files go through the streaming IngestionPipeline, which can collapse near duplicate chunks
+    """
+    def __init__(self,embedding_manager:EmbeddingManager,vector_store:BaseVectorStore,manifest:IngestionManifest = None,chunk_obj:Chunk = None,batch_size:int = 64,queue_size:int = 8,lexical_index:BM25Index = None,dedup_index:DedupIndex = None):
+        """
+        Description:
+            Constructor to initialize the ingestor
+        Arguments:
+            embedding_manager = EmbeddingManager object
+            vector_store = vector store object (pinecone or local backend)
+            manifest = IngestionManifest object, loaded from its default path if not provided
+            chunk_obj = Chunk object
+            batch_size = no. of chunks embedded and stored together
+            queue_size = maximum no. of items waiting between two pipeline stages
+            lexical_index = BM25Index object kept in sync with the vector store, not updated if not provided
+            dedup_index = DedupIndex object of the stored chunks, near duplicates are not collapsed if not provided
+        """
+        self.embedding_manager = embedding_manager
+        self.vector_store = vector_store
+        self.manifest = manifest if manifest is not None else IngestionManifest()
+        self.chunk_obj = chunk_obj if chunk_obj is not None else Chunk()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.lexical_index = lexical_index
+        self.dedup_index = dedup_index
+
+    def ingest(self,strategy:str,rebuild:bool = False,summary:dict = None) -> dict:
+        """
+        Description:
+            Method to bring the vector store and sql metadata in sync with the document directory
+        Arguments:
+            strategy: name of the chunking strategy
+            rebuild: drop everything and ingest all files again
+            summary: dictionary filled while the ingestion runs, lets another thread follow the stage and the counts
+        Return:
+            summary dictionary of the ingestion
+        """
+        start = time.perf_counter()
+        summary = summary if summary is not None else {}
+        summary["stage"] = "planning"
+        if not rebuild and not self.manifest.exists:
+            # the first run after the upgrade: the stored chunks have the random ids of the full re-ingestion, which the
+            # manifest doesnot know and would never delete, so the stores are truncated once
+            print("No ingestion manifest found, rebuilding the vector store and the sql metadata")
+            rebuild = True
+        if rebuild:
+            self.vector_store.empty_metadata()
+            self.vector_store.empty_index()
+            if self.lexical_index is not None:
+                self.lexical_index.clear()
+                self.lexical_index.save()
+            if self.dedup_index is not None:
+                self.dedup_index.clear()
+                self.dedup_index.save()
+            self.manifest.clear()
+            self.manifest.save()
+
+        files = self.chunk_obj.list_files()
+        plan = self.manifest.plan(files, strategy)
+        summary.update({"files_changed": len(plan["changed"]), "files_unchanged": len(plan["unchanged"]),
+                        "files_removed": len(plan["removed"]), "files_failed": {}, "files_done": 0,
+                        "chunks_embedded": 0, "chunks_deleted": 0, "chunks_kept": 0, "chunks_collapsed": 0})
+        pipeline = IngestionPipeline(embedding_manager=self.embedding_manager, vector_store=self.vector_store,
+                                     manifest=self.manifest, chunk_obj=self.chunk_obj,
+                                     batch_size=self.batch_size, queue_size=self.queue_size,
+                                     lexical_index=self.lexical_index, dedup_index=self.dedup_index)
+
+        try:
+            # files deleted from the document directory
+            summary["stage"] = "removing"
+            for path in plan["removed"]:
+                # chunks that other files' duplicates were collapsed into are kept
+                deleted = pipeline.release(path, self.manifest.chunk_ids(path))
+                summary["chunks_deleted"] += deleted
+                self.manifest.remove(path)
+                pipeline.checkpoint(changes=deleted + 1)
+            pipeline.checkpoint(force=True)
+
+            if plan["changed"]:
+                summary["stage"] = "ingesting"
+                pipeline.run(files=plan["changed"], strategy=strategy, summary=summary)
+        finally:
+            # a failed run may still have changed the stores, the cached chat answers are invalidated either way
+            if rebuild or summary["chunks_embedded"] or summary["chunks_deleted"]:
+                summary["corpus_version"] = bump_corpus_version()
+        summary["stage"] = "done"
+        summary["seconds"] = round(time.perf_counter() - start, 3)
+        print(f"Ingestion completed: {summary}")
+        return summary
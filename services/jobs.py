@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable
+from services.ingest import IncrementalIngestor
+from services.metrics import metrics
+try:
+    import fcntl
+except ImportError: # windows, only the ingestions of one process are serialized
+    fcntl = None
+
+
+class IngestionJobManager:
+    """
+    Runs the ingestions of a corpus (document directory + its manifest) in the background. A single worker thread
+    runs the jobs one after the other, and a lock file makes the jobs of the other worker processes (e.g, uvicorn
+    --workers 4) wait, so at most one ingestion of the corpus runs at a time and the uploads queue behind it.
+    Jobs are kept in memory, oldest first
+    """
+    def __init__(self,ingestor_factory:Callable[[], IncrementalIngestor],max_jobs:int = 100,lock_path:str = None):
+        """
+        Description:
+            Constructor to initialize the job manager. The worker thread starts with the first job
+        Arguments:
+            ingestor_factory: creates the IncrementalIngestor of a job, called in the worker thread
+            max_jobs: maximum no. of jobs kept for the status endpoint, the oldest finished jobs are forgotten first
+            lock_path: lock file shared by the processes ingesting the corpus, INGESTION_LOCK_PATH variable or
+                "data/ingestion.lock" if not provided
+        """
+        self.ingestor_factory = ingestor_factory
+        self.max_jobs = max_jobs
+        self.lock_path = lock_path or os.getenv("INGESTION_LOCK_PATH", "data/ingestion.lock")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict() # job_id -> job dictionary
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def submit(self, strategy:str, files:list[str] = None, rebuild:bool = False) -> dict:
+        """
+        Description:
+            Method to queue an ingestion
+        Arguments:
+            strategy: name of the chunking strategy
+            files: uploaded files that triggered the job, for reporting only (the whole corpus is brought in sync)
+            rebuild: drop everything and ingest all files again
+        Return:
+            job status dictionary
+        """
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "strategy": strategy,
+            "rebuild": rebuild,
+            "files": list(files or []),
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "summary": {}, # filled by the ingestion while it runs
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            finished = [job_id for job_id, each in self._jobs.items() if each["status"] in ("completed", "failed")]
+            for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[job_id]
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="ingestion-jobs", daemon=True)
+                self._worker.start()
+            self._queue.put(job["job_id"])
+        return self.status(job["job_id"])
+
+    def _run(self) -> None:
+        """
+        Description:
+            Worker thread, runs the queued jobs one after the other
+        """
+        while True:
+            job_id = self._queue.get()
+            if job_id is None: # close()
+                return
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            job["started"] = time.time()
+            job["status"] = "running"
+            try:
+                with self._corpus_lock(job), metrics.trace(name="ingestion_job"):
+                    self.ingestor_factory().ingest(strategy=job["strategy"], rebuild=job["rebuild"], summary=job["summary"])
+                job["status"] = "completed"
+            except Exception as e:
+                print(f"Ingestion job {job['job_id']} failed: {e}")
+                job["error"] = str(e)
+                job["status"] = "failed"
+            finally:
+                job["finished"] = time.time()
+
+    @contextmanager
+    def _corpus_lock(self, job:dict):
+        """
+        Description:
+            Context manager holding the lock file while a job runs. The manifest, local index, lexical index and docstore
+            files of the corpus are rewritten by an ingestion, two processes ingesting at once would corrupt them
+        """
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as file: # closing the file releases the lock, also if the process dies
+            if fcntl is not None:
+                try:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    job["summary"]["stage"] = "waiting for the ingestion of another process"
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def close(self, timeout:float = None) -> None:
+        """
+        Description:
+            Method to stop the worker thread at shutdown, after the running job. Queued jobs are not run, they are
+            reported as failed
+        Arguments:
+            timeout: seconds to wait for the running job, until it finishes if not provided
+        """
+        with self._lock:
+            worker, self._worker = self._worker, None
+            if worker is None:
+                return
+            while True:
+                try:
+                    job = self._jobs.get(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                if job is not None:
+                    job["status"], job["error"], job["finished"] = "failed", "the server shut down before the job ran", time.time()
+            self._queue.put(None)
+        worker.join(timeout)
+
+    def status(self, job_id:str) -> dict | None:
+        """
+        Description:
+            Method to report the state of a job
+        Arguments:
+            job_id: id returned by submit
+        Return:
+            job dictionary with its stage, counts, throughput and error, None if the job is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            queued = [each for each, other in self._jobs.items() if other["status"] == "queued"]
+        status = {key: value for key, value in job.items() if key != "summary"}
+        summary = dict(job["summary"])
+        status["stage"] = summary.pop("stage", "starting") if job["status"] != "queued" else "queued"
+        status["summary"] = summary
+        if job["status"] == "queued":
+            status["queue_position"] = queued.index(job_id) + 1 if job_id in queued else 1
+        if job["started"] is not None:
+            elapsed = (job["finished"] or time.time()) - job["started"]
+            status["elapsed_seconds"] = round(elapsed, 3)
+            status["chunks_per_second"] = round(summary.get("chunks_embedded", 0) / elapsed, 1) if elapsed > 0 else 0.0
+        return status
+
+    def list_jobs(self) -> list[dict]:
+        """
+        Description:
+            Method to report every known job, oldest first
+        """
+        with self._lock:
+            job_ids = list(self._jobs)
+        return [status for status in map(self.status, job_ids) if status is not None]
@@ -0,0 +1,324 @@
+import glob
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+import numpy as np
+from services.docstore import DocStore
+
+# words, numbers and compound tokens such as emails, urls and phone numbers (john.doe@mail.com, 98-4512-3456)
+_TOKEN = re.compile(r"[a-z0-9]+(?:[._%+\-@:/][a-z0-9]+)*")
+_PART = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text:str) -> list[str]:
+    """
+    Description:
+        Splits a text into lowercase tokens. A compound token is kept whole and its parts are added as well,
+        so "john.doe@mail.com" matches both the exact email and the word "john"
+    Arguments:
+        text: text to tokenize
+    Return:
+        list of tokens
+    """
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        parts = _PART.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+def reciprocal_rank_fusion(result_lists:list[list[dict]], top_k:int, k:int = 60) -> list[dict]:
+    """
+    Description:
+        Merges ranked result lists: every result scores sum(1 / (k + rank)) over the lists it appears in
+    Arguments:
+        result_lists: lists of results ({"id","score","metadata"}), best first
+        top_k: no. of results to return
+        k: rank offset, a larger k flattens the difference between the top ranks
+    Return:
+        fused list of results, best first
+    """
+    scores = {}
+    results = {}
+    for result_list in result_lists:
+        for rank, each in enumerate(result_list):
+            scores[each["id"]] = scores.get(each["id"], 0.0) + 1.0 / (k + rank + 1)
+            results.setdefault(each["id"], each)
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [{"id": each, "score": scores[each], "metadata": results[each]["metadata"]} for each in best]
+
+
+def is_confident(results:list[dict], min_margin:float = 1.5) -> bool:
+    """
+    Description:
+        Decides whether the best lexical result is clear enough to answer without the dense search: it contains every
+        exact token of the query (e.g, the email or phone number asked about) and clearly outscores the second result
+    Arguments:
+        results: lexical results, best first
+        min_margin: minimum ratio between the scores of the best and the second result
+    """
+    if not results or results[0]["exact_match"] < 1.0:
+        return False
+    return len(results) == 1 or results[0]["score"] >= min_margin * results[1]["score"]
+
+
+class BM25Index:
+    """
+    On disk BM25 inverted index of the chunk texts. The postings are stored in CSR form (per term offsets into
+    doc and term frequency arrays) in .npy files that are memory mapped for search. Changes are collected in
+    memory and merged into a new generation of the files on save(); index.json names the current generation,
+    so a reader in another process (the chat api) never sees half written files
+    """
+    def __init__(self,index_dir:str = "data/lexical_index",k1:float = 1.2,b:float = 0.75,docstore:DocStore = None):
+        """
+        Description:
+            Constructor to load (or create) the index
+        Arguments:
+            index_dir: directory of the index files
+            k1: term frequency saturation
+            b: document length normalization
+            docstore: DocStore object holding the chunk texts, the texts are kept in index.json if not provided
+        """
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        self.docstore = docstore
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._index_path = os.path.join(self.index_dir, "index.json")
+        self._lock = threading.RLock()
+        self._mtime = None
+        self._load()
+
+    def _file(self, name:str, generation:int) -> str:
+        return os.path.join(self.index_dir, f"{name}_{generation}.npy")
+
+    def _load(self) -> None:
+        """
+        Description:
+            Maps the files of the current generation
+        """
+        self.generation = 0
+        self.ids = []
+        self.metadata = []
+        self.terms = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.zeros(0, dtype=np.int32) # row of the chunk, grouped by term
+        self.frequencies = np.zeros(0, dtype=np.uint16) # term frequency of each posting
+        self.lengths = np.zeros(0, dtype=np.int32) # no. of tokens of each chunk
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding="utf-8") as file:
+                state = json.load(file)
+            self.generation = state["generation"]
+            self.ids = state["ids"]
+            self.metadata = state["metadata"]
+            self.terms = state["terms"]
+            self.offsets = np.load(self._file("offsets", self.generation), mmap_mode="r")
+            self.postings = np.load(self._file("postings", self.generation), mmap_mode="r")
+            self.frequencies = np.load(self._file("frequencies", self.generation), mmap_mode="r")
+            self.lengths = np.load(self._file("lengths", self.generation), mmap_mode="r")
+            self._mtime = os.stat(self._index_path).st_mtime_ns
+        self._term_ids = {term: i for i, term in enumerate(self.terms)}
+        self._rows = {each: row for row, each in enumerate(self.ids)}
+        self.avg_length = float(np.mean(self.lengths)) if len(self.lengths) else 0.0
+        self._pending = {} # chunk id -> (term counts, length, metadata) not saved yet
+        self._deleted = set() # rows deleted since the last save
+        self._metadata_changed = False
+
+    def _reload_if_changed(self) -> None:
+        """
+        Description:
+            Picks up the generation written by another process (e.g, the ingestion api)
+        """
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except FileNotFoundError:
+            if self._mtime is not None:
+                self._mtime = None
+                self._load()
+            return
+        if mtime != self._mtime and not self._pending and not self._deleted and not self._metadata_changed:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids:list, texts:list, metadata:list) -> None:
+        """
+        Description:
+            Method to add (or replace) chunks, visible to search after save()
+        Arguments:
+            ids: chunk ids
+            texts: chunk texts
+            metadata: metadata of the chunks, returned with the search results
+        """
+        with self._lock:
+            self._reload_if_changed()
+            for chunk_id, text, each in zip(ids, texts, metadata):
+                if chunk_id in self._rows:
+                    self._deleted.add(self._rows[chunk_id])
+                tokens = tokenize(text)
+                if self.docstore is not None: # the text is looked up in the docstore
+                    each = {key: value for key, value in each.items() if key != "text"}
+                self._pending[chunk_id] = (Counter(tokens), len(tokens), each)
+
+    def delete(self, ids:list) -> None:
+        """
+        Description:
+            Method to delete chunks, applied on save()
+        """
+        with self._lock:
+            self._reload_if_changed()
+            for chunk_id in ids:
+                self._pending.pop(chunk_id, None)
+                if chunk_id in self._rows:
+                    self._deleted.add(self._rows[chunk_id])
+
+    def update_metadata(self, ids:list, metadata:list) -> None:
+        """
+        Description:
+            Method to change some metadata fields of chunks, applied on save()
+        Arguments:
+            ids: chunk ids
+            metadata: fields to set for each chunk
+        """
+        with self._lock:
+            self._reload_if_changed()
+            for chunk_id, each in zip(ids, metadata):
+                if chunk_id in self._pending:
+                    counts, length, current = self._pending[chunk_id]
+                    self._pending[chunk_id] = (counts, length, {**current, **each})
+                elif chunk_id in self._rows:
+                    row = self._rows[chunk_id]
+                    self.metadata[row] = {**self.metadata[row], **each}
+                    self._metadata_changed = True
+
+    def clear(self) -> None:
+        """
+        Description:
+            Method to delete every chunk, applied on save()
+        """
+        with self._lock:
+            self._pending = {}
+            self._deleted = set(range(len(self.ids)))
+
+    def save(self) -> None:
+        """
+        Description:
+            Method to merge the pending changes into a new generation of the index files
+        """
+        with self._lock:
+            if not self._pending and not self._deleted and not self._metadata_changed:
+                return
+            # postings of the chunks that are kept, with their new rows
+            keep = np.ones(len(self.ids), dtype=bool)
+            keep[list(self._deleted)] = False
+            new_rows = np.cumsum(keep, dtype=np.int64) - 1
+            ids = [each for each, kept in zip(self.ids, keep) if kept]
+            metadata = [each for each, kept in zip(self.metadata, keep) if kept]
+            lengths = [np.asarray(self.lengths)[keep]]
+            posting_terms = np.repeat(np.arange(len(self.terms), dtype=np.int64), np.diff(self.offsets))
+            mask = keep[self.postings] if len(self.postings) else np.zeros(0, dtype=bool)
+            terms = list(self.terms)
+            term_ids = dict(self._term_ids)
+            term_parts = [posting_terms[mask]]
+            row_parts = [new_rows[np.asarray(self.postings)[mask]]]
+            frequency_parts = [np.asarray(self.frequencies)[mask]]
+
+            # postings of the pending chunks
+            new_terms, new_postings, new_frequencies, new_lengths = [], [], [], []
+            for chunk_id, (counts, length, each) in self._pending.items():
+                row = len(ids)
+                ids.append(chunk_id)
+                metadata.append(each)
+                new_lengths.append(length)
+                for term, count in counts.items():
+                    if term not in term_ids:
+                        term_ids[term] = len(terms)
+                        terms.append(term)
+                    new_terms.append(term_ids[term])
+                    new_postings.append(row)
+                    new_frequencies.append(min(count, 65535))
+            term_parts.append(np.asarray(new_terms, dtype=np.int64))
+            row_parts.append(np.asarray(new_postings, dtype=np.int64))
+            frequency_parts.append(np.asarray(new_frequencies, dtype=np.uint16))
+            lengths.append(np.asarray(new_lengths, dtype=np.int32))
+
+            posting_terms = np.concatenate(term_parts)
+            posting_rows = np.concatenate(row_parts)
+            frequencies = np.concatenate(frequency_parts)
+            order = np.lexsort((posting_rows, posting_terms))
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(posting_terms, minlength=len(terms)))
+
+            # terms without postings are dropped from the vocabulary
+            document_frequency = np.diff(offsets)
+            if len(terms) and not document_frequency.all():
+                used = document_frequency > 0
+                remap = np.cumsum(used) - 1
+                posting_terms = remap[posting_terms]
+                terms = [term for term, kept in zip(terms, used) if kept]
+                offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum(document_frequency[used])
+
+            generation = self.generation + 1
+            np.save(self._file("offsets", generation), offsets)
+            np.save(self._file("postings", generation), posting_rows[order].astype(np.int32))
+            np.save(self._file("frequencies", generation), frequencies[order])
+            np.save(self._file("lengths", generation), np.concatenate(lengths).astype(np.int32))
+            tmp_path = f"{self._index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump({"generation": generation, "ids": ids, "metadata": metadata, "terms": terms}, file)
+            os.replace(tmp_path, self._index_path)
+            for path in glob.glob(os.path.join(self.index_dir, "*.npy")):
+                if not path.endswith(f"_{generation}.npy"):
+                    try:
+                        os.remove(path)
+                    except OSError: # still mapped by a reader on windows, removed by a later save
+                        pass
+            self._load()
+
+    def search(self, query:str, top_k:int) -> list[dict]:
+        """
+        Description:
+            Method to rank the chunks by their BM25 score for the query
+        Arguments:
+            query: the search query
+            top_k: no. of top results to return
+        Return:
+            list of results ({"id","score","exact_match","metadata"}), best first. exact_match is the share of the query's
+            exact tokens (tokens with digits or symbols such as emails, phone numbers and dates) found in the chunk
+        """
+        with self._lock:
+            self._reload_if_changed()
+            count = len(self.ids)
+            tokens = set(tokenize(query))
+            exact_tokens = [term for term in tokens if not term.isalpha()]
+            term_ids = [self._term_ids[term] for term in tokens if term in self._term_ids]
+            if count == 0 or not term_ids:
+                return []
+            scores = np.zeros(count, dtype=np.float32)
+            exact = np.zeros(count, dtype=np.int32)
+            lengths = np.asarray(self.lengths, dtype=np.float32)
+            for term_id in term_ids:
+                start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+                rows = np.asarray(self.postings[start:end])
+                frequency = np.asarray(self.frequencies[start:end], dtype=np.float32)
+                idf = math.log(1 + (count - (end - start) + 0.5) / ((end - start) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[rows] / max(self.avg_length, 1e-9))
+                scores[rows] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+                if not self.terms[term_id].isalpha():
+                    exact[rows] += 1
+            top_k = min(top_k, int(np.count_nonzero(scores)))
+            if top_k == 0:
+                return []
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            best = best[np.argsort(-scores[best])]
+            results = [{"id": self.ids[row], "score": float(scores[row]),
+                        "exact_match": float(exact[row]) / len(exact_tokens) if exact_tokens else 0.0,
+                        "metadata": self.metadata[row]} for row in best]
+        return self.docstore.resolve(results) if self.docstore is not None else results
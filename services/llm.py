@@ -0,0 +1,548 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+import httpx
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from services.metrics import Counter, Histogram, metrics
+
+load_dotenv() # Loads variables from .env into os.environ
+
+# llm attempts per model, a hedge that lost the race is cancelled and recorded as "cancelled"
+llm_attempt_seconds = Histogram("rag_llm_attempt_seconds", "Time of one llm completion attempt", labels=("model", "outcome"))
+llm_hedges = Counter("rag_llm_hedges_total", "Hedged llm requests, by the model that answered first", labels=("winner",))
+llm_parse_retries = Counter("rag_llm_parse_retries_total", "Completions asked again because the reply was not valid json", labels=("outcome",))
+metrics.register(llm_attempt_seconds)
+metrics.register(llm_hedges)
+metrics.register(llm_parse_retries)
+
+
+def _strip_fences(content:str) -> str:
+    # models often wrap the json in a markdown code block
+    text = content.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1] if "\n" in text else text[3:]
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+def parse_json_reply(content:str, validate:Callable[[dict], bool] = None) -> str | None:
+    """
+    Arguments:
+        content: completion text
+        validate: checks the fields of the json object (e.g, the required keys), any object is accepted if not provided
+    Return:
+        the completion without its markdown code fences if it is a valid json object, None otherwise
+    """
+    if not content:
+        return None
+    text = _strip_fences(content)
+    try:
+        output = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(output, dict) or (validate is not None and not validate(output)):
+        return None
+    return text
+
+
+class LatencyTracker:
+    """
+    Recent successful attempt latencies per model, the hedge delay is their p95
+    """
+    def __init__(self, window:int = 200, min_samples:int = 20):
+        """
+        Arguments:
+            window: no. of latencies kept per model
+            min_samples: no. of latencies needed before percentile() answers
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model:str, seconds:float) -> None:
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, model:str, q:float) -> float | None:
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return float(np.percentile(samples, q))
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = {model: list(values) for model, values in self._samples.items()}
+        return {model: {"samples": len(values), **{f"p{q}_ms": round(float(np.percentile(values, q)) * 1000, 1) for q in (50, 95, 99)}}
+                for model, values in samples.items() if values}
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a share of the requests: every request adds `ratio` tokens, a retry takes one.
+    When the upstream keeps returning bad replies the retries stop instead of multiplying the load
+    """
+    def __init__(self, ratio:float = 0.1, max_tokens:float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LLMClient:
+    """
+    Client of the OpenRouter chat completion endpoint with pooled keep-alive connections and tail latency controls:
+    every attempt has a deadline, a request still running after the p95 latency of its model is hedged with a second
+    attempt on the fallback model (the first answer wins), a failed attempt falls back to the other model, and a reply
+    that is not valid json is asked again while the retry budget allows. complete() is for sync callers, acomplete()
+    for the async pipeline
+    """
+    def __init__(self,url:str = "https://openrouter.ai/api/v1/chat/completions",model:str = None,timeout:float = None,max_connections:int = 200,
+                 fallback_model:str = None,attempt_timeout:float = None,hedging:bool = None,hedge_delay:float = None,
+                 parse_retries:int = None,retry_budget_ratio:float = None):
+        """
+        Description:
+            Constructor to initialize the client. Connections are opened lazily and reused between requests
+        Arguments:
+            url: chat completion endpoint
+            model: model name, LLM_MODEL variable or "stepfun/step-3.5-flash:free" if not provided
+            timeout: seconds to wait for the completion, all attempts included, LLM_TIMEOUT_SECONDS variable or 60 if not provided
+            max_connections: maximum no. of pooled connections
+            fallback_model: model of the hedged and fallback attempts, LLM_FALLBACK_MODEL variable or the same model if not provided
+            attempt_timeout: seconds to wait for one attempt, LLM_ATTEMPT_TIMEOUT_SECONDS variable or 30 if not provided
+            hedging: whether slow attempts are hedged, LLM_HEDGING variable or True if not provided
+            hedge_delay: seconds before hedging while the model has too few recorded latencies for a p95,
+                LLM_HEDGE_DELAY_SECONDS variable or 10 if not provided
+            parse_retries: maximum no. of times a reply that is not valid json is asked again, LLM_PARSE_RETRIES variable or 1 if not provided
+            retry_budget_ratio: fallback attempts and parse retries allowed per request (on average),
+                LLM_RETRY_BUDGET_RATIO variable or 0.1 if not provided
+        """
+        self.url = url
+        self.model = model or os.getenv("LLM_MODEL", "stepfun/step-3.5-flash:free")
+        self.fallback_model = fallback_model or os.getenv("LLM_FALLBACK_MODEL") or self.model
+        self.timeout = timeout or float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+        self.attempt_timeout = min(attempt_timeout or float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "30")), self.timeout)
+        self.hedging = hedging if hedging is not None else os.getenv("LLM_HEDGING", "true").lower() != "false"
+        self.initial_hedge_delay = hedge_delay or float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "10"))
+        self.parse_retries = parse_retries if parse_retries is not None else int(os.getenv("LLM_PARSE_RETRIES", "1"))
+        self.retry_budget = RetryBudget(ratio=retry_budget_ratio or float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.1")))
+        self.latency = LatencyTracker()
+        self.connect_timeout = 5.0
+        self.max_connections = max_connections
+        self.OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY") # access variables
+        self._session = None
+        self._async_client = None
+        self._executor = None
+        self._counts = {"requests": 0, "hedges": 0, "hedge_wins": 0, "hedges_skipped": 0, "fallbacks": 0, "parse_retries": 0, "parse_failures": 0}
+        self._lock = threading.Lock()
+
+    def _headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.OPENROUTER_API_KEY}",
+            "Content-Type": "application/json",
+            # "HTTP-Referer": "<YOUR_SITE_URL>", # Optional. Site URL for rankings on openrouter.ai.
+            # "X-Title": "<YOUR_SITE_NAME>", # Optional. Site title for rankings on openrouter.ai.
+        }
+
+    def _payload(self,messages:list,model:str = None) -> dict:
+        return {
+            "model": model or self.model,
+            "messages": messages,
+            "reasoning": {"enabled": True}
+        }
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.attempt_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=min(self.max_connections, 50)),
+            )
+        return self._async_client
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # sync attempts run here so that the caller can wait for the first of two
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="llm")
+        return self._executor
+
+    def _count(self, name:str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def hedge_delay(self, model:str = None) -> float:
+        """
+        Return:
+            seconds after which an attempt on the model is hedged: the p95 of its recent latencies
+        """
+        p95 = self.latency.percentile(model or self.model, 95)
+        return min(p95 if p95 is not None else self.initial_hedge_delay, self.attempt_timeout)
+
+    @staticmethod
+    def _content(response, model:str) -> str:
+        if response.status_code != 200:
+            raise Exception(f"{model} answered with status {response.status_code}: {response.text[:200]}")
+        body = response.json()
+        if "error" in body:
+            raise Exception(f"{model} answered with an error: {body['error']}")
+        return body['choices'][0]['message']['content']
+
+    def _record(self, model:str, seconds:float, outcome:str) -> None:
+        if outcome == "ok":
+            self.latency.record(model, seconds)
+        llm_attempt_seconds.observe(seconds, model, outcome)
+
+    def _attempt(self, messages:list, model:str) -> str:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url=self.url, headers=self._headers(), json=self._payload(messages, model),
+                                         timeout=(self.connect_timeout, self.attempt_timeout))
+            content = self._content(response, model)
+        except Exception:
+            self._record(model, time.perf_counter() - start, "error")
+            raise
+        self._record(model, time.perf_counter() - start, "ok")
+        return content
+
+    async def _aattempt(self, messages:list, model:str) -> str:
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.async_client.post(self.url, headers=self._headers(), json=self._payload(messages, model)),
+                                              self.attempt_timeout)
+            content = self._content(response, model)
+        except asyncio.CancelledError:
+            self._record(model, time.perf_counter() - start, "cancelled") # lost the hedge race
+            raise
+        except Exception:
+            self._record(model, time.perf_counter() - start, "error")
+            raise
+        self._record(model, time.perf_counter() - start, "ok")
+        return content
+
+    def _next_attempt(self, model:str, hedge_due:bool, sent:int, failed:bool) -> str | None:
+        """
+        Return:
+            "hedge" if the running attempt is slower than the hedge delay, "fallback" if it failed, None otherwise.
+            Both are extra attempts paid from the retry budget, at most two attempts are sent per request
+        """
+        if sent >= 2 or not (failed or hedge_due):
+            return None
+        if self.retry_budget.withdraw():
+            return "fallback" if failed else "hedge"
+        if failed:
+            print(f"LLM retry budget exhausted, not falling back after the failure of {model}")
+        else:
+            self._count("hedges_skipped")
+        return None
+
+    def _winner(self, kind:str, hedged:bool) -> None:
+        if hedged:
+            llm_hedges.inc(kind)
+            if kind == "hedge":
+                self._count("hedge_wins")
+
+    def _failed(self, errors:list, timed_out:bool) -> Exception:
+        if timed_out or not errors:
+            errors = errors + [f"no answer within the {self.timeout:.0f}s deadline"]
+        return Exception("LLM request failed: " + "; ".join(errors))
+
+    def complete(self,messages:list,model:str = None) -> str:
+        """
+        Description:
+            Sends the messages and waits for the first completion of the model or of its hedge
+        Arguments:
+            messages: chat messages
+            model: model name, defaults to the client's model
+        Return:
+            content of the first choice
+        """
+        with metrics.span("llm"):
+            return self._complete(messages, model)
+
+    def _complete(self,messages:list,model:str = None,deadline:float = None) -> str:
+        # deadline: perf_counter() time the answer is due, timeout seconds from now if not provided
+        model = model or self.model
+        self.retry_budget.deposit()
+        self._count("requests")
+        deadline = deadline or time.perf_counter() + self.timeout
+        hedge_at = time.perf_counter() + self.hedge_delay(model) if self.hedging else None
+        pending = {self.executor.submit(self._attempt, messages, model): "primary"}
+        errors, hedged = [], False
+        while pending:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            timeout = deadline - now if hedge_at is None or len(pending) + len(errors) >= 2 else min(deadline, hedge_at) - now
+            done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                kind = pending.pop(future)
+                try:
+                    content = future.result()
+                except Exception as e:
+                    errors.append(f"{kind} attempt: {str(e) or type(e).__name__}")
+                    continue
+                self._winner(kind, hedged)
+                return content
+            # the losing attempt of a sync call cannot be interrupted, it ends within its attempt timeout
+            hedge_due = hedge_at is not None and time.perf_counter() >= hedge_at
+            action = self._next_attempt(model, hedge_due, len(pending) + len(errors), bool(errors) and not pending)
+            if hedge_due and action != "hedge":
+                hedge_at = None # no hedge for this request, wait for its attempt
+            if action is not None:
+                hedged = hedged or action == "hedge"
+                self._count("hedges" if action == "hedge" else "fallbacks")
+                pending[self.executor.submit(self._attempt, messages, self.fallback_model)] = action
+        raise self._failed(errors, bool(pending))
+
+    async def acomplete(self,messages:list,model:str = None) -> str:
+        """
+        Description:
+            Async version of complete(), the slower attempt is cancelled
+        """
+        with metrics.span("llm"):
+            return await self._acomplete(messages, model)
+
+    async def _acomplete(self,messages:list,model:str = None,deadline:float = None) -> str:
+        model = model or self.model
+        self.retry_budget.deposit()
+        self._count("requests")
+        deadline = deadline or time.perf_counter() + self.timeout
+        hedge_at = time.perf_counter() + self.hedge_delay(model) if self.hedging else None
+        pending = {asyncio.create_task(self._aattempt(messages, model)): "primary"}
+        errors, hedged = [], False
+        try:
+            while pending:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                timeout = deadline - now if hedge_at is None or len(pending) + len(errors) >= 2 else min(deadline, hedge_at) - now
+                done, _ = await asyncio.wait(pending, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind = pending.pop(task)
+                    try:
+                        content = task.result()
+                    except Exception as e:
+                        errors.append(f"{kind} attempt: {str(e) or type(e).__name__}")
+                        continue
+                    self._winner(kind, hedged)
+                    return content
+                hedge_due = hedge_at is not None and time.perf_counter() >= hedge_at
+                action = self._next_attempt(model, hedge_due, len(pending) + len(errors), bool(errors) and not pending)
+                if hedge_due and action != "hedge":
+                    hedge_at = None # no hedge for this request, wait for its attempt
+                if action is not None:
+                    hedged = hedged or action == "hedge"
+                    self._count("hedges" if action == "hedge" else "fallbacks")
+                    pending[asyncio.create_task(self._aattempt(messages, self.fallback_model))] = action
+            raise self._failed(errors, bool(pending))
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _reask(messages:list, content:str) -> list:
+        return messages + [{"role": "assistant", "content": content[:2000]},
+                           {"role": "user", "content": "Your previous reply was not a valid JSON object in the requested format. Reply again with only the JSON object, in the format asked above."}]
+
+    def _may_retry_parse(self, model:str, started:float) -> bool:
+        # the retry has to fit in the request deadline, at the typical latency of the model
+        p50 = self.latency.percentile(model, 50) or 0.0
+        if time.perf_counter() - started + p50 > self.timeout or not self.retry_budget.withdraw():
+            llm_parse_retries.inc("skipped")
+            return False
+        self._count("parse_retries")
+        return True
+
+    def _parsed(self, content:str, retried:bool, validate:Callable[[dict], bool]) -> str:
+        reply = parse_json_reply(content, validate)
+        if retried:
+            llm_parse_retries.inc("recovered" if reply is not None else "failed")
+        if reply is None:
+            self._count("parse_failures")
+        return reply if reply is not None else content
+
+    def complete_json(self,messages:list,model:str = None,validate:Callable[[dict], bool] = None) -> str:
+        """
+        Description:
+            complete() for prompts asking for a json object: a reply that is not a json object, or that validate rejects
+            (e.g, a required key is missing), is asked again, up to parse_retries times and while the retry budget and
+            the deadline allow. The retries share the deadline of the first request
+        Arguments:
+            messages: chat messages
+            model: model name, defaults to the client's model
+            validate: checks the fields of the json object, any object is accepted if not provided
+        Return:
+            the json reply without markdown code fences, or the last reply as is if none was valid
+        """
+        model = model or self.model
+        with metrics.span("llm"):
+            started = time.perf_counter()
+            deadline = started + self.timeout
+            content, retried = self._complete(messages, model, deadline), False
+            for _ in range(self.parse_retries):
+                if parse_json_reply(content, validate) is not None or not self._may_retry_parse(model, started):
+                    break
+                print(f"LLM reply is not a valid json object, asking {model} again")
+                try:
+                    content, retried = self._complete(self._reask(messages, content), model, deadline), True
+                except Exception as e:
+                    # out of time or failed, the reply already received is returned as is
+                    print(f"LLM parse retry failed: {e}")
+                    retried = True
+                    break
+            return self._parsed(content, retried, validate)
+
+    async def acomplete_json(self,messages:list,model:str = None,validate:Callable[[dict], bool] = None) -> str:
+        """
+        Description:
+            Async version of complete_json()
+        """
+        model = model or self.model
+        with metrics.span("llm"):
+            started = time.perf_counter()
+            deadline = started + self.timeout
+            content, retried = await self._acomplete(messages, model, deadline), False
+            for _ in range(self.parse_retries):
+                if parse_json_reply(content, validate) is not None or not self._may_retry_parse(model, started):
+                    break
+                print(f"LLM reply is not a valid json object, asking {model} again")
+                try:
+                    content, retried = await self._acomplete(self._reask(messages, content), model, deadline), True
+                except Exception as e:
+                    # out of time or failed, the reply already received is returned as is
+                    print(f"LLM parse retry failed: {e}")
+                    retried = True
+                    break
+            return self._parsed(content, retried, validate)
+
+    async def astream(self,messages:list,model:str = None):
+        """
+        Description:
+            Streams the completion as server sent events. If the model fails before its first token, the completion
+            is streamed from the fallback model instead (once the text started there is nothing to fall back to).
+            The whole stream, fallback included, has to finish within the timeout
+        Arguments:
+            messages: chat messages
+            model: model name, defaults to the client's model
+        Return:
+            async generator of completion text deltas
+        """
+        model = model or self.model
+        self.retry_budget.deposit()
+        self._count("requests")
+        deadline = time.perf_counter() + self.timeout
+        streamed = False
+        try:
+            async for delta in self._astream(messages, model, deadline):
+                streamed = True
+                yield delta
+            return
+        except Exception as e:
+            if streamed or time.perf_counter() >= deadline or not self.retry_budget.withdraw():
+                raise
+            print(f"LLM stream of {model} failed before the first token ({e}), streaming from {self.fallback_model}")
+        self._count("fallbacks")
+        async for delta in self._astream(messages, self.fallback_model, deadline):
+            yield delta
+
+    async def _astream(self,messages:list,model:str,deadline:float):
+        payload = self._payload(messages, model)
+        payload["stream"] = True
+        started, first_token = time.perf_counter(), True
+        try:
+            # the read timeout bounds the wait for the response headers, the lines are awaited up to the deadline
+            timeout = httpx.Timeout(max(deadline - started, 0.001), connect=self.connect_timeout)
+            async with self.async_client.stream("POST", self.url, headers=self._headers(), json=payload, timeout=timeout) as response:
+                response.raise_for_status()
+                lines = response.aiter_lines()
+                while True:
+                    try:
+                        line = await asyncio.wait_for(anext(lines), max(deadline - time.perf_counter(), 0))
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise Exception(f"LLM stream not finished within the {self.timeout:.0f}s deadline")
+                    # openrouter also sends ": OPENROUTER PROCESSING" comments to keep the connection alive
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise Exception(f"Error during streaming: {chunk['error']}")
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        if first_token:
+                            metrics.observe("llm_first_token", time.perf_counter() - started)
+                            first_token = False
+                        yield delta
+        except Exception:
+            self._record(model, time.perf_counter() - started, "error")
+            raise
+        metrics.observe("llm", time.perf_counter() - started)
+        self._record(model, time.perf_counter() - started, "ok")
+
+    def stats(self) -> dict:
+        """
+        Return:
+            recent latencies and hedge delay per model, counts of requests, hedges, fallbacks and parse retries
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        latency = self.latency.stats()
+        for model in latency:
+            latency[model]["hedge_delay_ms"] = round(self.hedge_delay(model) * 1000, 1)
+        return {"model": self.model, "fallback_model": self.fallback_model, "hedging": self.hedging, **counts,
+                "retry_budget_tokens": round(self.retry_budget.tokens, 2), "latency": latency}
+
+    async def aclose(self) -> None:
+        """
+        Description:
+            Closes the pooled connections
+        """
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
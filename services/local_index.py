@@ -0,0 +1,425 @@
+import json
+import os
+import threading
+import numpy as np
+from services.vectorstore import BaseVectorStore
+from services.docstore import DocStore
+from services.quantization import make_quantizer, load_quantizer
+
+
+class LocalVectorStore(BaseVectorStore):
+    """
+    In process vector store. Vectors are L2 normalized and kept in a memory mapped float32 matrix,
+    so cosine similarity is a single matrix-vector product. Larger indexes also get an IVF
+    (inverted file) index that only scores the vectors of the clusters closest to the query.
+    With compression, queries scan int8 or PQ codes held in memory instead of the float32 matrix, which stays
+    on disk and is only read for the exact re-scoring of the best candidates.
+    The ids and metadata are kept in index.json and the changes of each upsert/delete are appended to index.log, which is
+    merged into index.json once it outgrows it, so an ingestion writes them O(no. of vectors) times in total
+    """
+    def __init__(self,index_dir:str = "data/vector_index",ivf_min_vectors:int = 20000,nprobe:int = 8,
+                 compression:str = None,compression_min_vectors:int = 5000,rescore:int = 4,pq_m:int = None,docstore:DocStore = None,
+                 compact_min_bytes:int = 1 << 20):
+        """
+        Description:
+            Constructor to load (or create) the local index
+        Arguments:
+            index_dir: directory of the index files
+            ivf_min_vectors: no. of vectors from which the IVF index is built automatically
+            nprobe: no. of IVF clusters scored per query
+            compression: "int8" (4x smaller) or "pq" (product quantization, pq_m bytes per vector), no compression if not provided.
+                An index that was compressed keeps its codes up to date until it is emptied
+            compression_min_vectors: no. of vectors from which the quantizer is trained and the codes are built automatically
+            rescore: the rescore * top_k best candidates of the codes are re-scored with the float32 vectors, 0 to disable
+            pq_m: no. of PQ sub vectors, must divide the dimensions
+            docstore: DocStore object of the chunk texts, the texts are kept in index.json if not provided
+            compact_min_bytes: size of index.log below which it is not merged into index.json
+        """
+        self.index_dir = index_dir
+        self.ivf_min_vectors = ivf_min_vectors
+        self.nprobe = nprobe
+        self.compression = compression
+        self.compression_min_vectors = compression_min_vectors
+        self.rescore = rescore
+        self.pq_m = pq_m
+        self.docstore = docstore
+        self.compact_min_bytes = compact_min_bytes
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._vectors_path = os.path.join(self.index_dir, "vectors.f32")
+        self._assign_path = os.path.join(self.index_dir, "ivf_assign.i32")
+        self._centroids_path = os.path.join(self.index_dir, "ivf_centroids.npy")
+        self._codes_path = os.path.join(self.index_dir, "codes.u8")
+        self._quantizer_path = os.path.join(self.index_dir, "quantizer.npz")
+        self._index_path = os.path.join(self.index_dir, "index.json")
+        self._log_path = os.path.join(self.index_dir, "index.log")
+        self._lock = threading.RLock()
+        self._file_state = None # (mtime of index.json, size of index.log) when they were last read or written
+        self._load()
+        self._build_quantizer_if_needed()
+
+    def _load(self) -> None:
+        """
+        Description:
+            Reads the ids and metadata (index.json, then the changes of index.log) and maps the index files without copying them into memory
+        """
+        self.vectors = None
+        self.assign = None
+        self.centroids = None
+        self.quantizer = None
+        self.codes = None
+        # taken before reading: a save landing while the files are read then shows up as a change and they are read again
+        file_state = self._read_file_state()
+        state = {"dim": None, "capacity": 0, "ivf": False, "compression": None, "generation": 0, "ids": [], "metadata": []}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding="utf-8") as file:
+                state.update(json.load(file))
+        self.dim = state["dim"]
+        self.capacity = state["capacity"]
+        self.ids = state["ids"]
+        self.metadata = state["metadata"]
+        self._generation = state["generation"]
+        self._rows = {each: row for row, each in enumerate(self.ids)}
+        self._replay_log()
+        if self._read_file_state() != file_state:
+            return self._load()
+        self.count = len(self.ids)
+        self._index_bytes = os.path.getsize(self._index_path) if os.path.exists(self._index_path) else 0
+        if self.dim is not None:
+            self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+            if state["ivf"]:
+                self.assign = np.memmap(self._assign_path, dtype=np.int32, mode="r+", shape=(self.capacity,))
+                self.centroids = np.load(self._centroids_path)
+            if state.get("compression"):
+                self.quantizer = load_quantizer(self._quantizer_path)
+                self._map_codes()
+        self._file_state = file_state
+
+    def _replay_log(self) -> None:
+        """
+        Description:
+            Applies the changes appended to index.log since index.json was written. The vectors of the changes are
+            already in the memory mapped files, only the ids and metadata are replayed
+        """
+        try:
+            with open(self._log_path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+        for line in data.split(b"\n")[:-1]: # the last piece is empty, or a change still being written by another process
+            change = json.loads(line)
+            if change["generation"] != self._generation:
+                continue # already merged into index.json
+            self.dim, self.capacity = change["dim"], change["capacity"]
+            if change["op"] == "upsert":
+                self._upsert_rows(change["ids"], change["metadata"])
+            elif change["op"] == "update":
+                self._update_rows(change["ids"], change["metadata"])
+            else:
+                self._delete_rows(change["ids"])
+
+    def _read_file_state(self) -> tuple:
+        state = []
+        for path, stat in ((self._index_path, "st_mtime_ns"), (self._log_path, "st_size")):
+            try:
+                state.append(getattr(os.stat(path), stat))
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def _map_codes(self) -> None:
+        # int8 codes are signed, PQ codes are centroid ids
+        dtype = np.int8 if self.quantizer.kind == "int8" else np.uint8
+        self.codes = np.memmap(self._codes_path, dtype=dtype, mode="r+", shape=(self.capacity, self.quantizer.code_size))
+
+    def _reload_if_changed(self) -> None:
+        """
+        Description:
+            Picks up the changes written by another process (e.g, the ingestion api), also when the index was emptied
+        """
+        if self._read_file_state() != self._file_state:
+            self._load()
+
+    def _flush(self) -> None:
+        self.vectors.flush()
+        if self.assign is not None:
+            self.assign.flush()
+        if self.codes is not None:
+            self.codes.flush()
+
+    def _save(self) -> None:
+        """
+        Description:
+            Flushes the vectors and atomically replaces the index file. The new generation makes the changes of index.log
+            obsolete, the log is then emptied
+        """
+        self._flush()
+        state = {"dim": self.dim, "count": self.count, "capacity": self.capacity, "ivf": self.centroids is not None,
+                 "compression": self.quantizer.kind if self.quantizer is not None else None,
+                 "generation": self._generation + 1, "ids": self.ids, "metadata": self.metadata}
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self._index_path)
+        self._generation += 1
+        open(self._log_path, "wb").close()
+        self._index_bytes = os.path.getsize(self._index_path)
+        self._file_state = self._read_file_state()
+
+    def _append_change(self, op:str, ids:list, metadata:list = None) -> None:
+        """
+        Description:
+            Flushes the vectors and appends one change to index.log, merged into index.json when the log outgrows it
+        """
+        self._flush()
+        change = {"generation": self._generation, "dim": self.dim, "capacity": self.capacity, "op": op, "ids": ids}
+        if metadata is not None:
+            change["metadata"] = metadata
+        with open(self._log_path, "ab") as file:
+            file.write(json.dumps(change).encode("utf-8") + b"\n") # one write, a reader never sees half a change
+        log_bytes = os.path.getsize(self._log_path)
+        if log_bytes > max(self._index_bytes, self.compact_min_bytes):
+            self._save()
+        else:
+            self._file_state = self._read_file_state()
+
+    def _upsert_rows(self, ids:list, metadata:list) -> list:
+        """
+        Return:
+            rows of the ids, the new ids are added at the end
+        """
+        rows = []
+        for i, each in enumerate(ids):
+            row = self._rows.get(each)
+            if row is None:
+                row = len(self.ids)
+                self._rows[each] = row
+                self.ids.append(each)
+                self.metadata.append(metadata[i])
+            else:
+                self.metadata[row] = metadata[i]
+            rows.append(row)
+        return rows
+
+    def _update_rows(self, ids:list, metadata:list) -> bool:
+        updated = False
+        for i, each in enumerate(ids):
+            row = self._rows.get(each)
+            if row is not None:
+                self.metadata[row] = {**self.metadata[row], **metadata[i]}
+                updated = True
+        return updated
+
+    def _delete_rows(self, ids:list) -> list:
+        """
+        Return:
+            (deleted row, last row moved into it) pairs, in order
+        """
+        moves = []
+        for row in sorted((self._rows[each] for each in set(ids) if each in self._rows), reverse=True):
+            # swap the last row into the deleted one so that the matrix stays dense
+            last = len(self.ids) - 1
+            del self._rows[self.ids[row]]
+            if row != last:
+                self.ids[row] = self.ids[last]
+                self.metadata[row] = self.metadata[last]
+                self._rows[self.ids[row]] = row
+            self.ids.pop()
+            self.metadata.pop()
+            moves.append((row, last))
+        return moves
+
+    def _grow(self, needed:int) -> None:
+        """
+        Description:
+            Extends the memory mapped files (capacity doubles) so that at least needed rows fit
+        """
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2, 1024)
+        code_size = self.quantizer.code_size if self.quantizer is not None else 0
+        for path, itemsize, width in ((self._vectors_path, 4, self.dim), (self._assign_path, 4, 1), (self._codes_path, 1, code_size)):
+            if (path == self._assign_path and self.assign is None) or (path == self._codes_path and self.codes is None):
+                continue
+            with open(path, "a+b") as file:
+                file.truncate(capacity * itemsize * width)
+        self.capacity = capacity
+        self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+        if self.assign is not None:
+            self.assign = np.memmap(self._assign_path, dtype=np.int32, mode="r+", shape=(self.capacity,))
+        if self.codes is not None:
+            self._map_codes()
+
+    @staticmethod
+    def _normalize(vectors:np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _upsert_vectors(self,ids:list,embeddings:np.array,vector_metadata:list)->None:
+        embeddings = self._normalize(embeddings)
+        with self._lock:
+            self._reload_if_changed()
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                open(self._vectors_path, "wb").close()
+            elif embeddings.shape[1] != self.dim:
+                raise Exception(f"Embedding dimensions {embeddings.shape[1]} doesnot match the index dimensions {self.dim}")
+            rows = self._upsert_rows(ids, vector_metadata)
+            self._grow(len(self.ids))
+            self.vectors[rows] = embeddings
+            self.count = len(self.ids)
+            if self.centroids is not None:
+                self.assign[rows] = self._nearest_centroid(embeddings)
+            if self.quantizer is not None:
+                self.codes[rows] = self.quantizer.encode(embeddings)
+            self._append_change("upsert", list(ids), vector_metadata)
+            if self.centroids is None and self.count >= self.ivf_min_vectors:
+                self.build_ivf()
+            self._build_quantizer_if_needed()
+
+    def _update_vector_metadata(self,ids:list,metadata:list)->None:
+        with self._lock:
+            self._reload_if_changed()
+            if self._update_rows(ids, metadata):
+                self._append_change("update", list(ids), metadata)
+
+    def _delete_vectors(self,ids:list)->None:
+        with self._lock:
+            self._reload_if_changed()
+            moves = self._delete_rows(ids)
+            for row, last in moves:
+                if row != last:
+                    self.vectors[row] = self.vectors[last]
+                    if self.assign is not None:
+                        self.assign[row] = self.assign[last]
+                    if self.codes is not None:
+                        self.codes[row] = self.codes[last]
+            self.count = len(self.ids)
+            if moves:
+                self._append_change("delete", list(ids))
+
+    def _nearest_centroid(self, vectors:np.ndarray) -> np.ndarray:
+        """
+        Description:
+            Assigns each (normalized) vector to its most similar centroid, in blocks to bound the memory
+        """
+        assign = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), 65536):
+            block = np.asarray(vectors[start:start+65536])
+            assign[start:start+len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return assign
+
+    def build_ivf(self, nlist:int = None, iterations:int = 10, seed:int = 0) -> None:
+        """
+        Description:
+            Builds the IVF index with spherical k-means over a sample of the vectors
+        Arguments:
+            nlist: no. of clusters, defaults to sqrt(no. of vectors)
+            iterations: k-means iterations
+            seed: random seed of the sampling
+        """
+        with self._lock:
+            self._reload_if_changed()
+            if self.count == 0:
+                return
+            nlist = nlist or max(1, int(np.sqrt(self.count)))
+            nlist = min(nlist, self.count)
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(self.count, size=min(self.count, nlist * 256), replace=False))
+            sample = np.asarray(self.vectors[sample_rows])
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, sample)
+                counts = np.bincount(labels, minlength=nlist)
+                empty = counts == 0
+                sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))] # reseed empty clusters
+                centroids = self._normalize(sums)
+            self.centroids = centroids
+            np.save(self._centroids_path, centroids)
+            with open(self._assign_path, "wb") as file:
+                file.truncate(self.capacity * 4)
+            self.assign = np.memmap(self._assign_path, dtype=np.int32, mode="r+", shape=(self.capacity,))
+            self.assign[:self.count] = self._nearest_centroid(self.vectors[:self.count])
+            self._save()
+            print(f"IVF index built with {nlist} clusters over {self.count} vectors")
+
+    def _build_quantizer_if_needed(self) -> None:
+        if self.compression is None or self.count < self.compression_min_vectors:
+            return
+        if self.quantizer is None or self.quantizer.kind != self.compression:
+            self.build_quantizer()
+
+    def build_quantizer(self, sample_size:int = 16384, seed:int = 0) -> None:
+        """
+        Description:
+            Trains the quantizer of the compression mode over a sample of the vectors and encodes every vector
+        Arguments:
+            sample_size: maximum no. of vectors the quantizer is trained on
+            seed: random seed of the sampling
+        """
+        with self._lock:
+            self._reload_if_changed()
+            if self.count == 0 or self.compression is None:
+                return
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(self.count, size=min(self.count, sample_size), replace=False))
+            quantizer = make_quantizer(self.compression, self.dim, self.pq_m).fit(np.asarray(self.vectors[sample_rows]), seed=seed)
+            np.savez(self._quantizer_path, **quantizer.state())
+            self.quantizer = quantizer
+            with open(self._codes_path, "wb") as file:
+                file.truncate(self.capacity * quantizer.code_size)
+            self._map_codes()
+            for start in range(0, self.count, 65536):
+                end = min(start + 65536, self.count)
+                self.codes[start:end] = quantizer.encode(np.asarray(self.vectors[start:end]))
+            self._save()
+            print(f"{self.compression} codes built for {self.count} vectors ({quantizer.code_size} bytes per vector)")
+
+    def query(self,vector:list,top_k:int)->list[dict]:
+        with self._lock:
+            self._reload_if_changed()
+            if self.count == 0:
+                return []
+            q = self._normalize(vector)
+            candidates = None
+            if self.centroids is not None:
+                probe = np.argsort(self.centroids @ q)[-self.nprobe:]
+                candidates = np.flatnonzero(np.isin(self.assign[:self.count], probe))
+                if len(candidates) < top_k:
+                    candidates = None # too few vectors in the probed clusters, fall back to exact search
+            rows = np.arange(self.count) if candidates is None else candidates
+            if self.quantizer is not None:
+                codes = self.codes[:self.count] if candidates is None else self.codes[candidates]
+                scores = self.quantizer.scores(codes, q)
+                if self.rescore:
+                    # exact scores of the best candidates, only their rows of the float32 matrix are read
+                    shortlist = min(len(scores), top_k * self.rescore)
+                    rows = np.sort(rows[np.argpartition(-scores, shortlist - 1)[:shortlist]])
+                    scores = np.asarray(self.vectors[rows]) @ q
+            elif candidates is None:
+                scores = self.vectors[:self.count] @ q
+            else:
+                scores = self.vectors[candidates] @ q
+            k = min(top_k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            matches = [{"id": self.ids[rows[i]], "score": float(scores[i]), "metadata": self.metadata[rows[i]]} for i in top]
+        return self._resolve(matches)
+
+    def empty_index(self)->None:
+        """
+        Description:
+            Method to truncate the vector database
+        """
+        with self._lock:
+            self.vectors = None
+            self.assign = None
+            self.codes = None
+            for path in (self._index_path, self._log_path, self._vectors_path, self._assign_path, self._centroids_path, self._codes_path, self._quantizer_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._load()
+        self._clear_docstore()
+        print("Local index is emptied")
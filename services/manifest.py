@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List
+
+
+def file_hash(path:str) -> str:
+    """
+    Description:
+        Computes the content hash of a file without reading it into memory at once
+    Arguments:
+        path: path of the file
+    Return:
+        sha256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_chunk_id(text:str, source:str, occurrence:int = 0) -> str:
+    """
+    Description:
+        Creates the stable id of one chunk
+    Arguments:
+        text: chunk text
+        source: source file of the chunk
+        occurrence: how many identical chunks came before it in the same file
+    Return:
+        chunk id
+    """
+    digest = hashlib.sha256(f"{source}\x00{text}".encode("utf-8")).hexdigest()[:24]
+    return f"doc_{digest}" if occurrence == 0 else f"doc_{digest}_{occurrence}"
+
+
+def make_chunk_ids(texts:List[str], sources:List[str]) -> List[str]:
+    """
+    Description:
+        Creates stable chunk ids from the chunk content and its source file. The same chunk of the same file
+        always gets the same id, so unchanged chunks donot need to be embedded or written again
+    Arguments:
+        texts: chunk texts
+        sources: source file of each chunk
+    Return:
+        list of chunk ids in the same order as texts
+    """
+    seen = defaultdict(int) # identical text can repeat inside a file, the occurrence number keeps the ids unique
+    ids = []
+    for text, source in zip(texts, sources):
+        ids.append(make_chunk_id(text, source, seen[(source, text)]))
+        seen[(source, text)] += 1
+    return ids
+
+
+class IngestionManifest:
+    """
+    Persistent record of the ingested files, their content hash and the ids of their chunks
+    """
+    def __init__(self, path:str = "data/ingestion_manifest.json"):
+        """
+        Description:
+            Constructor to load the manifest from disk. An empty manifest is used if the file doesnot exist
+        Arguments:
+            path: path of the manifest file
+        """
+        self.path = path
+        self.files: Dict[str, dict] = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as file:
+                self.files = json.load(file).get("files", {})
+
+    def plan(self, paths:List[str], strategy:str) -> dict:
+        """
+        Description:
+            Method to compare the files on disk with the manifest
+        Arguments:
+            paths: files currently present in the document directory
+            strategy: chunking strategy of the current ingestion
+        Return:
+            dictionary with "changed" (new or modified files with their hash), "unchanged" and "removed" file lists
+        """
+        changed = {}
+        unchanged = []
+        for path in paths:
+            digest = file_hash(path)
+            entry = self.files.get(path)
+            if entry and entry["hash"] == digest and entry["strategy"] == strategy:
+                unchanged.append(path)
+            else:
+                changed[path] = digest
+        current = set(paths)
+        removed = [path for path in self.files if path not in current]
+        return {"changed": changed, "unchanged": unchanged, "removed": removed}
+
+    def chunk_ids(self, path:str) -> List[str]:
+        """
+        Description:
+            Method to get the chunk ids recorded for a file
+        """
+        entry = self.files.get(path)
+        return list(entry["chunks"]) if entry else []
+
+    def referenced_elsewhere(self, chunk_ids:List[str], path:str) -> set:
+        """
+        Description:
+            Method to find the chunks that other files also use, e.g a chunk that near duplicate chunks of other files were collapsed into
+        Arguments:
+            chunk_ids: chunk ids of the file
+            path: the file
+        Return:
+            set of the chunk ids listed by at least one other file
+        """
+        wanted = set(chunk_ids)
+        return {each for other, entry in self.files.items() if other != path for each in entry["chunks"] if each in wanted}
+
+    def update(self, path:str, digest:str, strategy:str, chunk_ids:List[str]) -> None:
+        """
+        Description:
+            Method to record the state of an ingested file
+        """
+        self.files[path] = {"hash": digest, "strategy": strategy, "chunks": list(chunk_ids)}
+
+    @property
+    def exists(self) -> bool:
+        """
+        Whether the manifest was ever saved, the stores of an install without one were not written by the incremental ingestion
+        """
+        return os.path.exists(self.path)
+
+    def remove(self, path:str) -> None:
+        """
+        Description:
+            Method to forget a file that no longer exists
+        """
+        self.files.pop(path, None)
+
+    def clear(self) -> None:
+        """
+        Description:
+            Method to forget every file, used when the stores are rebuilt from scratch
+        """
+        self.files = {}
+
+    def save(self) -> None:
+        """
+        Description:
+            Method to write the manifest to disk. The file is replaced atomically so a crash never leaves a half written manifest
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"files": self.files}, file)
+        os.replace(tmp_path, self.path)
+
+
+def read_corpus_version(path:str = "data/corpus_version") -> int:
+    """
+    Description:
+        Reads the corpus version, which changes every time ingestion changes the stored chunks
+    Arguments:
+        path: path of the version file
+    Return:
+        corpus version, 0 if nothing was ingested yet
+    """
+    try:
+        with open(path, encoding="utf-8") as file:
+            return int(file.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def bump_corpus_version(path:str = "data/corpus_version") -> int:
+    """
+    Description:
+        Increments the corpus version so that answers cached for the old corpus are no longer served
+    Arguments:
+        path: path of the version file
+    Return:
+        new corpus version
+    """
+    version = read_corpus_version(path) + 1
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(str(version))
+    os.replace(tmp_path, path)
+    return version
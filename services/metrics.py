@@ -0,0 +1,226 @@
+import contextvars
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency buckets, from a redis round trip to a slow llm completion
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names:tuple, values:tuple, extra:str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """
+    Prometheus style histogram with labels. An observation is one bisect and a few additions under a lock
+    """
+    def __init__(self, name:str, description:str, labels:tuple = (), buckets:tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # label values -> [bucket counts (last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, *label_values) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> dict:
+        """
+        Return:
+            {label values: (cumulative bucket counts, sum, count)}
+        """
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in series.items():
+            for i in range(1, len(counts)):
+                counts[i] += counts[i - 1]
+        return series
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.snapshot().items()):
+            for bound, cumulative in zip([*map(repr, self.buckets), "+Inf"], counts):
+                le = 'le="' + bound + '"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {count}")
+        return lines
+
+
+class Counter:
+    """
+    Prometheus style counter with labels
+    """
+    def __init__(self, name:str, description:str, labels:tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount:float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels_text(self.labels, key)} {value}" for key, value in sorted(values.items())]
+        return lines
+
+
+class Trace:
+    """
+    Spans of one request, kept with its trace id and the chat session id
+    """
+    def __init__(self, sessionid:str = None, name:str = "request"):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.sessionid = sessionid
+        self.name = name
+        self.started = time.time()
+        self.seconds = None
+        self.spans = [] # (stage, start offset, seconds)
+        self._start = time.perf_counter()
+
+    def to_dict(self) -> dict:
+        return {"trace_id": self.trace_id, "sessionid": self.sessionid, "name": self.name, "started": self.started,
+                "seconds": self.seconds, "spans": [{"stage": stage, "start_ms": round(offset * 1000, 3), "ms": round(seconds * 1000, 3)}
+                                                   for stage, offset, seconds in self.spans]}
+
+
+class MetricsRegistry:
+    """
+    Process wide metrics: stage latency histograms, request latency histograms, stage errors and the most recent traces.
+    Spans are cheap enough to stay on in production (two clock reads and one histogram update), METRICS_ENABLED=false
+    turns them off
+    """
+    def __init__(self, enabled:bool = None, max_traces:int = None, slow_trace_seconds:float = None):
+        """
+        Description:
+            Constructor to initialize the metrics
+        Arguments:
+            enabled: whether spans are recorded, METRICS_ENABLED variable or True if not provided
+            max_traces: no. of recent traces kept for /traces/, TRACE_BUFFER_SIZE variable or 1000 if not provided
+            slow_trace_seconds: traces slower than this are printed with their spans, TRACE_SLOW_SECONDS variable or 5 if not provided
+        """
+        self.enabled = enabled if enabled is not None else os.getenv("METRICS_ENABLED", "true").lower() != "false"
+        self.slow_trace_seconds = slow_trace_seconds if slow_trace_seconds is not None else float(os.getenv("TRACE_SLOW_SECONDS", "5"))
+        self.stage_seconds = Histogram("rag_stage_seconds", "Time spent in each pipeline stage", labels=("stage",))
+        self.request_seconds = Histogram("rag_request_seconds", "Time to answer a request", labels=("endpoint",))
+        self.stage_errors = Counter("rag_stage_errors_total", "Pipeline stages that raised an exception", labels=("stage",))
+        self._metrics = [self.stage_seconds, self.request_seconds, self.stage_errors]
+        self._traces = deque(maxlen=max_traces or int(os.getenv("TRACE_BUFFER_SIZE", "1000")))
+        self._current = contextvars.ContextVar("trace", default=None)
+
+    def register(self, metric) -> None:
+        """
+        Description:
+            Method to export another Histogram or Counter on the metrics endpoint
+        """
+        self._metrics.append(metric)
+
+    @property
+    def current_trace(self) -> Trace | None:
+        return self._current.get()
+
+    @contextmanager
+    def span(self, stage:str):
+        """
+        Description:
+            Context manager timing a stage, recorded in the stage histogram and in the current trace if there is one.
+            Works around awaits too, and in threads started with asyncio.to_thread (the context is copied)
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.stage_errors.inc(stage)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.stage_seconds.observe(seconds, stage)
+            trace = self._current.get()
+            if trace is not None:
+                trace.spans.append((stage, start - trace._start, seconds))
+
+    def observe(self, stage:str, seconds:float) -> None:
+        """
+        Description:
+            Method to record a stage timed by the caller
+        """
+        if self.enabled:
+            self.stage_seconds.observe(seconds, stage)
+
+    @contextmanager
+    def trace(self, sessionid:str = None, name:str = "request"):
+        """
+        Description:
+            Context manager starting the trace of a request. The spans recorded inside it are attached to the trace
+        Return:
+            the Trace object, its trace_id is returned to the client
+        """
+        trace = Trace(sessionid=sessionid, name=name)
+        token = self._current.set(trace)
+        try:
+            yield trace
+        finally:
+            try:
+                self._current.reset(token)
+            except ValueError:
+                pass # an async generator (streamed response) closed from another context
+            trace.seconds = time.perf_counter() - trace._start
+            if self.enabled:
+                self.request_seconds.observe(trace.seconds, name)
+                self._traces.append(trace)
+                if trace.seconds > self.slow_trace_seconds:
+                    breakdown = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, _, seconds in trace.spans)
+                    print(f"Slow {name} {trace.trace_id} (session {sessionid}): {trace.seconds:.2f}s [{breakdown}]")
+
+    def recent_traces(self, sessionid:str = None, limit:int = 50) -> list[dict]:
+        """
+        Description:
+            Method to list the most recent traces, newest first
+        Arguments:
+            sessionid: only the traces of this chat session if provided
+            limit: maximum no. of traces
+        """
+        traces = [each for each in reversed(list(self._traces)) if sessionid is None or each.sessionid == sessionid]
+        return [each.to_dict() for each in traces[:limit]]
+
+    def render(self) -> str:
+        """
+        Return:
+            every metric in the prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# one registry per process
+metrics = MetricsRegistry()
@@ -0,0 +1,230 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+import pymupdf
+from langchain_core.documents import Document
+
+
+def parse_file(path:str, start_page:int = 0, end_page:int = None) -> list[Document]:
+    """
+    Description:
+        Parses a file, or a page range of a pdf, into documents (one document per pdf page, one per txt file).
+        Runs in the worker processes of ParallelParser, so it only depends on its arguments
+    Arguments:
+        path: path of the file
+        start_page: first pdf page to parse
+        end_page: pdf page after the last one to parse, the last page of the pdf if not provided
+    Return:
+        list of documents
+    """
+    return parse_range(path, start_page, end_page)[0]
+
+
+def parse_range(path:str, start_page:int = 0, end_page:int = None) -> tuple:
+    """
+    Description:
+        parse_file() that also returns the no. of pages of the file, so the first task of a pdf tells how many
+        other tasks it needs without opening the file in the calling process
+    Return:
+        tuple of (list of documents, no. of pages), a txt file counts as one page
+    """
+    docs = list(iter_pages(path, start_page, end_page))
+    if Path(path).suffix != ".pdf":
+        return docs, 1
+    return docs, docs[0].metadata["total_pages"] if docs else _pdf_page_count(path)
+
+
+def _pdf_page_count(path:str) -> int:
+    with pymupdf.open(path) as pdf:
+        return len(pdf)
+
+
+def iter_pages(path:str, start_page:int = 0, end_page:int = None) -> Iterator[Document]:
+    """
+    Description:
+        Generator of the documents of a file, one pdf page at a time
+    Arguments:
+        path: path of the file
+        start_page: first pdf page to parse
+        end_page: pdf page after the last one to parse, the last page of the pdf if not provided
+    """
+    if Path(path).suffix != ".pdf":
+        with open(path, encoding="utf-8") as file:
+            yield Document(page_content=file.read(), metadata={"source": path})
+        return
+    with pymupdf.open(path) as pdf:
+        # source/page metadata like langchain's PyMuPDFLoader
+        info = {key: value for key, value in pdf.metadata.items() if isinstance(value, (str, int)) and value != ""}
+        end_page = len(pdf) if end_page is None else min(end_page, len(pdf))
+        for number in range(start_page, end_page):
+            metadata = {**info, "source": path, "file_path": path, "total_pages": len(pdf), "page": number}
+            yield Document(page_content=pdf[number].get_text().strip(), metadata=metadata)
+
+
+class _FileTasks:
+    """
+    Parse tasks of one file in page order. The first task of a pdf also counts its pages, the next page ranges are
+    submitted once it is known
+    """
+    def __init__(self, path:str, pages_per_task:int):
+        self.path = path
+        self.pages_per_task = pages_per_task
+        self.futures = deque() # submitted tasks, not returned yet
+        self.next_page = 0
+        self.pages = None # unknown until the first task returns
+
+    def can_submit(self) -> bool:
+        if self.next_page == 0:
+            return True
+        if self.pages is None and self.futures and self.futures[0].done() and self.futures[0].exception() is None:
+            self.pages = self.futures[0].result()[1]
+        return self.pages is not None and self.next_page < self.pages
+
+    def submit(self, executor:ProcessPoolExecutor) -> None:
+        self.futures.append(executor.submit(parse_range, self.path, self.next_page, self.next_page + self.pages_per_task))
+        self.next_page += self.pages_per_task
+
+    def done(self) -> bool:
+        return not self.futures and self.pages is not None and self.next_page >= self.pages
+
+class ParallelParser:
+    """
+    Parses files across a pool of processes. Large pdfs are split into page ranges so that a single big file
+    also uses several cores. Files come back in the order they were given and a file that cannot be parsed
+    is reported on its own without stopping the others
+    """
+    def __init__(self,max_workers:int = None,pages_per_task:int = 16,max_pending:int = None,min_parallel_bytes:int = 1 << 20):
+        """
+        Description:
+            Constructor to initialize the parser. The process pool is started on the first parse that needs it and reused afterwards
+        Arguments:
+            max_workers: no. of worker processes, PARSER_WORKERS variable or the no. of cpus if not provided
+            pages_per_task: no. of pdf pages parsed by one task
+            max_pending: maximum no. of tasks submitted ahead of the page range being returned, bounds the parsed pages held in memory
+            min_parallel_bytes: files smaller than this in total are parsed in the calling process, starting the workers would
+                cost more than it saves
+        """
+        self.max_workers = max_workers or int(os.getenv("PARSER_WORKERS", str(os.cpu_count() or 1)))
+        self.pages_per_task = pages_per_task
+        self.max_pending = max_pending or self.max_workers * 2
+        self.min_parallel_bytes = min_parallel_bytes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn instead of fork, the parent process may hold the embedding model and its threads
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def close(self) -> None:
+        """
+        Description:
+            Stops the worker processes
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+    def parse(self, files:list[str]) -> Iterator[tuple]:
+        """
+        Description:
+            Method to parse the files. The pages are streamed out as their tasks return, a file's documents are
+            never all held at once
+        Arguments:
+            files: paths of the files
+        Return:
+            generator of (path, documents, error) in the order of files. documents is a generator of the file's documents,
+            to consume before the next file, and raises if a later page range of the file fails. documents is None and
+            error is the message when the file cannot be parsed at all
+        """
+        if self.max_workers <= 1 or sum(os.path.getsize(path) for path in files if os.path.exists(path)) < self.min_parallel_bytes:
+            # not worth using the worker processes, the files are read one page at a time in this process
+            for path in files:
+                pages = iter_pages(path)
+                try:
+                    first = next(pages, None)
+                except Exception as e:
+                    yield path, None, str(e)
+                    continue
+                yield path, chain([first] if first is not None else [], pages), None
+            return
+
+        executor = self.executor
+        remaining = deque(files)
+        started = deque() # _FileTasks of the files being parsed, in order
+        submitted = 0
+
+        def fill() -> None:
+            # submit ahead while there is room, in file and page order, always at least the next task
+            nonlocal submitted
+            while submitted < self.max_pending or not submitted:
+                tasks = next((each for each in started if each.can_submit()), None)
+                if tasks is None:
+                    if not remaining:
+                        return
+                    tasks = _FileTasks(remaining.popleft(), self.pages_per_task)
+                    started.append(tasks)
+                tasks.submit(executor)
+                submitted += 1
+
+        def take(tasks:_FileTasks) -> list[Document]:
+            # the documents of the file's next page range
+            nonlocal submitted
+            if not tasks.futures: # the tasks ahead took the room, the file being returned always gets its next task
+                tasks.submit(executor)
+                submitted += 1
+            future = tasks.futures.popleft()
+            submitted -= 1
+            try:
+                docs, pages = future.result()
+                if tasks.pages is None:
+                    tasks.pages = pages
+            finally:
+                fill()
+            return docs
+
+        def documents(tasks:_FileTasks, first:list[Document]) -> Iterator[Document]:
+            yield from first
+            while not tasks.done():
+                yield from take(tasks)
+
+        fill()
+        while started:
+            tasks = started[0]
+            try:
+                first = take(tasks) # a file that cannot be opened fails here, before any of its documents
+            except Exception as e:
+                submitted -= self._drop(started.popleft())
+                yield tasks.path, None, str(e)
+                continue
+            docs = documents(tasks, first)
+            try:
+                yield tasks.path, docs, None
+                for _ in docs: # the caller stopped early, the file's tasks are waited for in order
+                    pass
+            finally:
+                if started and started[0] is tasks:
+                    started.popleft()
+                    submitted -= self._drop(tasks)
+            fill()
+
+    @staticmethod
+    def _drop(tasks:_FileTasks) -> int:
+        """
+        Return:
+            no. of tasks of the file that were still submitted
+        """
+        count = len(tasks.futures)
+        for future in tasks.futures:
+            future.cancel()
+        tasks.futures.clear()
+        return count
@@ -0,0 +1,368 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Iterator
+from services.chunking import Chunk
+from services.embedding import EmbeddingManager
+from services.vectorstore import BaseVectorStore
+from services.manifest import IngestionManifest, make_chunk_id
+from services.lexical import BM25Index
+from services.dedup import DedupIndex
+from services.metrics import metrics
+
+_END = object() # sentinel closing a stage's output queue
+
+
+class IngestionPipeline:
+    """
+    Streaming ingestion of changed files. Loading, splitting, deduplicating, embedding and storing run as concurrent stages
+    connected by bounded queues, so only a few batches are in memory at any time and the total time
+    approaches the time of the slowest stage instead of the sum of all stages
+    """
+    def __init__(self,embedding_manager:EmbeddingManager,vector_store:BaseVectorStore,manifest:IngestionManifest,chunk_obj:Chunk = None,batch_size:int = 64,queue_size:int = 8,lexical_index:BM25Index = None,dedup_index:DedupIndex = None,
+                 checkpoint_ratio:float = 0.25,checkpoint_min_chunks:int = 1000):
+        """
+        Description:
+            Constructor to initialize the pipeline
+        Arguments:
+            embedding_manager = EmbeddingManager object
+            vector_store = vector store object (pinecone or local backend)
+            manifest = IngestionManifest object, each file is recorded once all its chunks are stored
+            chunk_obj = Chunk object
+            batch_size = no. of chunks embedded and stored together
+            queue_size = maximum no. of items waiting between two stages
+            lexical_index = BM25Index object updated along with the vector store, not updated if not provided
+            dedup_index = DedupIndex object, near duplicate chunks are collapsed into the stored chunk instead of being embedded again. No deduplication if not provided
+            checkpoint_ratio = the indexes and the manifest are saved once the chunks changed since the last save reach this share of the index
+            checkpoint_min_chunks = minimum no. of changed chunks between two saves
+        """
+        self.embedding_manager = embedding_manager
+        self.vector_store = vector_store
+        self.manifest = manifest
+        self.chunk_obj = chunk_obj if chunk_obj is not None else Chunk()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.lexical_index = lexical_index
+        self.dedup_index = dedup_index
+        self.checkpoint_ratio = checkpoint_ratio
+        self.checkpoint_min_chunks = checkpoint_min_chunks
+        self._unsaved = 0 # chunks changed since the last checkpoint
+        self._stop = threading.Event()
+        self._errors = []
+        self.stage_seconds = {} # time each stage spent working, waiting on the queues excluded
+
+    def _put(self, out_queue:queue.Queue, item) -> bool:
+        # blocks while the next stage is busy, gives up when another stage failed
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue:queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _run_stage(self, name:str, stage, in_queue:queue.Queue, out_queue:queue.Queue) -> None:
+        """
+        Description:
+            Runs a stage in its own thread. The stage is a generator function taking the items of the previous stage
+            and yielding the items of the next one
+        """
+        waited = 0.0
+        busy = 0.0
+
+        def inputs():
+            nonlocal waited
+            while True:
+                start = time.perf_counter()
+                item = self._get(in_queue)
+                waited += time.perf_counter() - start
+                if item is _END:
+                    return
+                yield item
+
+        try:
+            outputs = stage(inputs()) if in_queue is not None else stage()
+            while True:
+                start, waited_before = time.perf_counter(), waited
+                try:
+                    item = next(outputs)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed = time.perf_counter() - start
+                    busy += elapsed
+                metrics.observe(name, elapsed - (waited - waited_before)) # work on this item, waiting for the input excluded
+                if out_queue is not None and not self._put(out_queue, item):
+                    break
+        except Exception as e:
+            self._errors.append(f"{name} stage: {str(e)}")
+            self._stop.set()
+        finally:
+            self.stage_seconds[name] = round(busy - waited, 3)
+            if out_queue is not None:
+                self._put(out_queue, _END)
+
+    def _load(self, files:dict, summary:dict) -> Iterator[tuple]:
+        """
+        Description:
+            Load stage: the pages of every file one at a time, followed by an end of file marker.
+            A file that cannot be parsed is reported in the summary and left out of the manifest, so the next run retries it.
+            When a page range fails after some pages were sent, a failed marker makes the next stages drop what they stored of the file
+        """
+        for path, docs, error in self.chunk_obj.parse_files(list(files)):
+            if error is None:
+                try:
+                    for doc in docs:
+                        yield ("document", path, doc)
+                except Exception as e:
+                    error = str(e)
+                    yield ("failed", path)
+                else:
+                    yield ("end", path, files[path])
+                    continue
+            print(f"Error in parsing {path}: {error}")
+            summary["files_failed"][path] = error
+
+    def _split(self, strategy:str):
+        """
+        Description:
+            Split stage: chunks the documents, gives the chunks their ids and batches the chunks that are not stored yet
+        """
+        def stage(items) -> Iterator[tuple]:
+            ids, seen, batch, kept = [], defaultdict(int), [], 0
+            for item in items:
+                kind, path = item[0], item[1]
+                if kind == "document":
+                    old_ids = set(self.manifest.chunk_ids(path))
+                    for chunk in self.chunk_obj.iter_chunks(strategy, [item[2]]):
+                        text = chunk.page_content
+                        chunk_id = make_chunk_id(text, path, seen[text]) # identical chunks of a file are numbered
+                        seen[text] += 1
+                        ids.append(chunk_id)
+                        if chunk_id in old_ids: # unchanged chunk, already embedded and stored
+                            kept += 1
+                            continue
+                        batch.append((chunk_id, text, chunk.metadata))
+                        if len(batch) >= self.batch_size:
+                            yield ("batch", path, batch)
+                            batch = []
+                elif kind == "failed":
+                    yield item
+                    ids, seen, batch, kept = [], defaultdict(int), [], 0
+                else:
+                    if batch:
+                        yield ("batch", path, batch)
+                    yield ("end", path, item[2], ids, kept)
+                    ids, seen, batch, kept = [], defaultdict(int), [], 0
+        return stage
+
+    def _dedup(self, summary:dict):
+        """
+        Description:
+            Dedup stage: a chunk that is a near duplicate of a stored chunk (or of an earlier chunk of this run) is dropped
+            from its batch and its file refers to the stored chunk instead. The batches carry the new sources of those stored chunks
+        """
+        def stage(items) -> Iterator[tuple]:
+            aliases = {} # chunk id -> id of the chunk it was collapsed into, for the current file
+            added, collapsed_into = [], set() # chunks of the current file added to the index, stored chunks it became a source of
+            for item in items:
+                if item[0] == "batch":
+                    _, path, batch = item
+                    kept, sources = [], {}
+                    for chunk_id, text, metadata in batch:
+                        signature = self.dedup_index.hasher.signature(text)
+                        canonical = self.dedup_index.find(signature)
+                        if canonical is None or canonical == chunk_id:
+                            self.dedup_index.add(chunk_id, signature, path)
+                            added.append(chunk_id)
+                            kept.append((chunk_id, text, metadata))
+                            continue
+                        aliases[chunk_id] = canonical
+                        if path not in self.dedup_index.sources.get(canonical, []): # the metadata is updated once per new source
+                            sources[canonical] = self.dedup_index.add_source(canonical, path)
+                            collapsed_into.add(canonical)
+                        summary["chunks_collapsed"] += 1
+                    yield ("batch", path, kept, sources)
+                elif item[0] == "failed":
+                    # forgotten here, before the next files are deduplicated against them
+                    path = item[1]
+                    self.dedup_index.delete(added)
+                    remaining = {each: self.dedup_index.remove_source(each, path) for each in collapsed_into}
+                    yield ("failed", path, {each: sources for each, sources in remaining.items() if sources})
+                    aliases, added, collapsed_into = {}, [], set()
+                else:
+                    _, path, digest, ids, kept = item
+                    # a chunk collapsed twice in one file keeps a single reference
+                    ids = list(dict.fromkeys(aliases.get(each, each) for each in ids))
+                    aliases, added, collapsed_into = {}, [], set()
+                    yield ("end", path, digest, ids, kept)
+        return stage
+
+    def _embed(self, items) -> Iterator[tuple]:
+        """
+        Description:
+            Embed stage: encodes the batches of chunks
+        """
+        for item in items:
+            if item[0] == "batch":
+                texts = [each[1] for each in item[2]]
+                embeddings = self.embedding_manager.generate_embeddings(texts=texts, show_progress_bar=False) if texts else None
+                item = item[:3] + (item[3] if len(item) > 3 else {}, embeddings)
+            yield item
+
+    def _set_sources(self, sources:dict) -> None:
+        """
+        Description:
+            Records the source files of stored chunks in their metadata, the first source stays the chunk's source
+        Arguments:
+            sources: chunk id -> its source files
+        """
+        if not sources:
+            return
+        ids = list(sources)
+        metadata = [{"source": sources[each][0], "sources": sources[each]} for each in ids]
+        self.vector_store.update_metadata(ids=ids, metadata=metadata)
+        if self.lexical_index is not None:
+            self.lexical_index.update_metadata(ids=ids, metadata=metadata)
+
+    def release(self, path:str, chunk_ids:list) -> int:
+        """
+        Description:
+            Method to release the chunks a file no longer uses. A chunk that other files still refer to
+            (near duplicates of theirs were collapsed into it) only loses the file as a source, the others are deleted
+        Arguments:
+            path: the file
+            chunk_ids: chunk ids the file no longer uses
+        Return:
+            no. of deleted chunks
+        """
+        shared = self.manifest.referenced_elsewhere(chunk_ids, path)
+        stale = [each for each in chunk_ids if each not in shared]
+        self.vector_store.delete(stale)
+        if self.lexical_index is not None:
+            self.lexical_index.delete(stale)
+        if self.dedup_index is not None:
+            self.dedup_index.delete(stale)
+            remaining = {each: self.dedup_index.remove_source(each, path) for each in shared}
+            self._set_sources({each: sources for each, sources in remaining.items() if sources})
+        return len(stale)
+
+    def save_indexes(self) -> None:
+        """
+        Description:
+            Method to write the lexical and dedup indexes to disk
+        """
+        if self.lexical_index is not None:
+            self.lexical_index.save()
+        if self.dedup_index is not None:
+            self.dedup_index.save()
+
+    def checkpoint(self, changes:int = 0, force:bool = False) -> None:
+        """
+        Description:
+            Method to save the lexical and dedup indexes, then the manifest, so the manifest only records files whose
+            chunks are in the saved indexes. Every save rewrites the whole indexes, so unless forced nothing is written until
+            the changes reach checkpoint_ratio of the index: a run writes them O(corpus) in total instead of once per file.
+            A crash loses the files since the last checkpoint, the next run ingests them again
+        Arguments:
+            changes: no. of chunks added or deleted since the previous call
+            force: save even if few chunks changed, e.g at the end of a run
+        """
+        self._unsaved += changes
+        indexed = max(len(self.lexical_index) if self.lexical_index is not None else 0,
+                      len(self.dedup_index.ids) if self.dedup_index is not None else 0)
+        if not force and self._unsaved < max(self.checkpoint_min_chunks, self.checkpoint_ratio * indexed):
+            return
+        self.save_indexes()
+        self.manifest.save()
+        self._unsaved = 0
+
+    def _store(self, strategy:str, summary:dict):
+        """
+        Description:
+            Store stage: upserts the batches and, at the end of a file, deletes its stale chunks and records the file in the manifest,
+            written at the next checkpoint
+        """
+        def stage(items) -> Iterator[None]:
+            written = [] # chunks of the current file stored by this run
+            for item in items:
+                if item[0] == "batch":
+                    _, path, batch, sources, embeddings = item
+                    written.extend(each[0] for each in batch)
+                    if batch:
+                        self.vector_store.upsert(ids=[each[0] for each in batch], embeddings=embeddings,
+                                                 texts=[each[1] for each in batch], chunk_metadata=[each[2] for each in batch])
+                        if self.lexical_index is not None:
+                            self.lexical_index.add(ids=[each[0] for each in batch], texts=[each[1] for each in batch],
+                                                   metadata=[{"text": each[1], "source": each[2]["source"]} for each in batch])
+                    self._set_sources(sources)
+                    summary["chunks_embedded"] += len(batch)
+                    self._unsaved += len(batch)
+                elif item[0] == "failed":
+                    # the file stays out of the manifest, its chunks stored so far are deleted
+                    self.vector_store.delete(written)
+                    if self.lexical_index is not None:
+                        self.lexical_index.delete(written)
+                    self._set_sources(item[2] if len(item) > 2 else {})
+                    self.checkpoint(changes=len(written))
+                    written = []
+                else:
+                    written = []
+                    _, path, digest, ids, kept = item
+                    stale = list(set(self.manifest.chunk_ids(path)) - set(ids))
+                    deleted = self.release(path, stale)
+                    summary["chunks_deleted"] += deleted
+                    self.manifest.update(path, digest, strategy, ids)
+                    self.checkpoint(changes=deleted)
+                    summary["chunks_kept"] += kept
+                    summary["files_done"] += 1
+                yield None
+        return stage
+
+    def run(self, files:dict, strategy:str, summary:dict) -> dict:
+        """
+        Description:
+            Method to ingest the given files
+        Arguments:
+            files: paths of the new or modified files with their content hash
+            strategy: name of the chunking strategy
+            summary: summary dictionary, its chunk counts and failed files are updated while the pipeline runs
+        Return:
+            summary dictionary
+        """
+        if strategy not in ("document", "recursive"):
+            raise Exception(f"{strategy} chunking strategy not supported!!!!")
+        documents = queue.Queue(maxsize=self.queue_size)
+        chunks = queue.Queue(maxsize=self.queue_size)
+        vectors = queue.Queue(maxsize=self.queue_size)
+        stages = [
+            ("load", lambda: self._load(files, summary), None, documents),
+            ("split", self._split(strategy), documents, chunks),
+            ("embed", self._embed, chunks, vectors),
+            ("store", self._store(strategy, summary), vectors, None),
+        ]
+        if self.dedup_index is not None:
+            unique = queue.Queue(maxsize=self.queue_size)
+            stages.insert(2, ("dedup", self._dedup(summary), chunks, unique))
+            stages[3] = ("embed", self._embed, unique, vectors)
+        summary.setdefault("chunks_collapsed", 0)
+        threads = [threading.Thread(target=self._run_stage, args=stage, name=f"ingestion-{stage[0]}", daemon=True) for stage in stages]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the files finished since the last checkpoint, also when another file failed
+        self.checkpoint(force=True)
+        summary["stage_seconds"] = dict(self.stage_seconds)
+        if self._errors:
+            raise Exception(f"Ingestion failed: {'; '.join(self._errors)}")
+        return summary
@@ -0,0 +1,166 @@
+import numpy as np
+
+
+def _kmeans(vectors:np.ndarray, k:int, iterations:int, rng:np.random.Generator) -> np.ndarray:
+    """
+    Description:
+        Plain (euclidean) k-means, empty clusters are reseeded with random vectors
+    Return:
+        (k, dim) float32 centroids
+    """
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=len(vectors) < k)].copy()
+    for _ in range(iterations):
+        # argmin |x-c|^2 = argmax x.c - |c|^2/2
+        labels = np.argmax(vectors @ centroids.T - 0.5 * np.sum(centroids ** 2, axis=1), axis=1)
+        counts = np.bincount(labels, minlength=k)
+        # per dimension bincount, much faster than np.add.at for the few dimensions of a sub space
+        sums = np.stack([np.bincount(labels, weights=vectors[:, d], minlength=k) for d in range(vectors.shape[1])], axis=1)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+    return centroids.astype(np.float32)
+
+
+class ScalarQuantizer:
+    """
+    int8 scalar quantization: every dimension is scaled by its maximum absolute value into [-127, 127].
+    4x smaller than float32, queries are scored against the codes without decoding them
+    """
+    kind = "int8"
+
+    def __init__(self, scale:np.ndarray = None):
+        """
+        Description:
+            Constructor of the quantizer, call fit() before encoding if scale is not provided
+        Arguments:
+            scale: per dimension float32 scale (max absolute value / 127)
+        """
+        self.scale = scale
+
+    @property
+    def code_size(self) -> int:
+        """bytes per encoded vector"""
+        return len(self.scale)
+
+    def fit(self, vectors:np.ndarray, seed:int = 0) -> "ScalarQuantizer":
+        self.scale = np.maximum(np.abs(vectors).max(axis=0), 1e-12).astype(np.float32) / 127
+        return self
+
+    def encode(self, vectors:np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale
+
+    def scores(self, codes:np.ndarray, query:np.ndarray, block:int = 4096) -> np.ndarray:
+        """
+        Description:
+            Inner products of the query with the encoded vectors, the scale is folded into the query.
+            Converted block by block, a small block stays in the cpu cache
+        """
+        scaled = (query * self.scale).astype(np.float32)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block):
+            scores[start:start+block] = np.asarray(codes[start:start+block], dtype=np.float32) @ scaled
+        return scores
+
+    def state(self) -> dict:
+        return {"kind": np.array(self.kind), "scale": self.scale}
+
+
+class ProductQuantizer:
+    """
+    Product quantization: the vector is cut into m sub vectors and each one is replaced by the id of its nearest
+    centroid among 256, so a vector takes m bytes. Queries use asymmetric distance computation (ADC): the query
+    stays in float32, its inner products with every centroid are computed once and a vector's score is the sum
+    of m table lookups
+    """
+    kind = "pq"
+
+    def __init__(self, m:int = 48, centroids:np.ndarray = None):
+        """
+        Description:
+            Constructor of the quantizer, call fit() before encoding if centroids are not provided
+        Arguments:
+            m: no. of sub vectors (bytes per vector), must divide the dimensions
+            centroids: (m, 256, dim/m) float32 centroids of the sub spaces
+        """
+        self.m = m if centroids is None else len(centroids)
+        self.centroids = centroids
+
+    @property
+    def code_size(self) -> int:
+        """bytes per encoded vector"""
+        return self.m
+
+    def _split(self, vectors:np.ndarray) -> np.ndarray:
+        # (n, dim) -> (m, n, dim/m)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # contiguous, matrix products on the transposed view would not use blas
+        return np.ascontiguousarray(vectors.reshape(len(vectors), self.m, -1).transpose(1, 0, 2))
+
+    def fit(self, vectors:np.ndarray, iterations:int = 10, seed:int = 0) -> "ProductQuantizer":
+        if vectors.shape[1] % self.m:
+            raise Exception(f"PQ sub vectors {self.m} doesnot divide the dimensions {vectors.shape[1]}")
+        rng = np.random.default_rng(seed)
+        self.centroids = np.stack([_kmeans(sub, 256, iterations, rng) for sub in self._split(vectors)])
+        return self
+
+    def encode(self, vectors:np.ndarray, block:int = 16384) -> np.ndarray:
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        norms = np.sum(self.centroids ** 2, axis=2) # (m, 256)
+        for start in range(0, len(vectors), block):
+            subs = self._split(vectors[start:start+block])
+            for j in range(self.m):
+                codes[start:start+len(subs[j]), j] = np.argmax(subs[j] @ self.centroids[j].T - 0.5 * norms[j], axis=1)
+        return codes
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        return np.concatenate([self.centroids[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def scores(self, codes:np.ndarray, query:np.ndarray, block:int = 4096) -> np.ndarray:
+        """
+        Description:
+            ADC inner products of the query with the encoded vectors
+        """
+        table = np.einsum("md,mkd->mk", query.reshape(self.m, -1).astype(np.float32), self.centroids) # (m, 256)
+        # row j of the flattened table starts at j*256, so one gather scores every sub vector of every code
+        offsets = (np.arange(self.m) * 256).astype(np.intp)
+        flat = table.ravel()
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block):
+            part = np.asarray(codes[start:start+block])
+            scores[start:start+len(part)] = flat[part.astype(np.intp) + offsets].sum(axis=1)
+        return scores
+
+    def state(self) -> dict:
+        return {"kind": np.array(self.kind), "centroids": self.centroids}
+
+
+def make_quantizer(kind:str, dim:int, pq_m:int = None):
+    """
+    Description:
+        Creates an untrained quantizer
+    Arguments:
+        kind: "int8" or "pq"
+        dim: dimensions of the vectors
+        pq_m: no. of PQ sub vectors, the largest of 48/32/24/16/8 dividing dim if not provided
+    """
+    if kind == "int8":
+        return ScalarQuantizer()
+    if kind == "pq":
+        pq_m = pq_m or next((m for m in (48, 32, 24, 16, 8) if dim % m == 0), 1)
+        return ProductQuantizer(m=pq_m)
+    raise Exception(f"{kind} compression not supported, use int8 or pq")
+
+
+def load_quantizer(path:str):
+    """
+    Description:
+        Loads a quantizer saved with np.savez(path, **quantizer.state())
+    """
+    with np.load(path) as state:
+        kind = str(state["kind"])
+        if kind == "int8":
+            return ScalarQuantizer(scale=state["scale"])
+        return ProductQuantizer(centroids=state["centroids"])
@@ -1,189 +1,619 @@
-import requests
+import asyncio
 import json
-from dotenv import load_dotenv
 import os
-from typing import Dict
-from services.embedding import EmbeddingManager
-from services.vectorstore import VectorStore
+import time
+import numpy as np
+from dotenv import load_dotenv
+from typing import Callable, Dict
+from services.embedding import EmbeddingManager, EmbeddingBatcher
+from services.vectorstore import BaseVectorStore
 from services.vectorstore import Metadata
 from services.chat_memory import ChatMemory
+from services.llm import LLMClient
+from services.streaming import ReplyStreamParser
+from services.semantic_cache import SemanticCache, history_fingerprint
+from services.context import ContextAssembler, estimate_tokens
+from services.lexical import BM25Index, reciprocal_rank_fusion, is_confident
+from services.router import IntentRouter, BOOKING_FIELDS
+from services.availability import AvailabilityCache
+from services.metrics import metrics
 
 load_dotenv() # Loads variables from .env into os.environ
 
+# system prompt for the llm
+booking_system_prompt = """
+            Your job is to decide whether:
+            1. the user wants to book an interview or,
+            2. the user is asking a general question
+
+            If the user is asking a general question:
+            - Set route to "rag"
+            - Answer using the provided context and conversation history
+            - Put the answer in the "reply" field
+
+            If the user wants to book an interview:
+            - Set route to "booking"
+            - Extract the following fields:
+                - name
+                - email
+                - date
+                - time
+
+            Rules:
+            - Respond ONLY in valid JSON
+            - JSON fields must be exactly: route, booking, reply
+            - If a booking field is missing or unclear, set that field to null. Do NOT guess missing booking fields
+            - Convert dates to YYYY-MM-DD
+            - Convert times to 24-hour HH:MM
+            - If route is "booking", reply must be null
+            - If route is "rag", booking must be null
+            """
+
+
+def is_valid_output(output:dict) -> bool:
+    """
+    Description:
+        Checks the fields of the llm output: a "rag" reply needs its text, a "booking" reply an object of booking fields
+    Arguments:
+        output: json object of the llm completion
+    Return:
+        whether the output can be used for the turn
+    """
+    route = output.get("route")
+    if route == "rag":
+        return isinstance(output.get("reply"), str)
+    if route == "booking":
+        return isinstance(output.get("booking") or {}, dict)
+    return False
+
 
 class RAGRetriever:
     """
     Handles query based retrieval from vector store
     """
-    def __init__(self,metadata:Metadata,chat_memory:ChatMemory,embedding_manager:EmbeddingManager,vector_store:VectorStore):
+    def __init__(self,metadata:Metadata | Callable[[], Metadata],chat_memory:ChatMemory,embedding_manager:EmbeddingManager,vector_store:BaseVectorStore,llm_client:LLMClient = None,semantic_cache:SemanticCache = None,embedding_batcher:EmbeddingBatcher = None,context_assembler:ContextAssembler = None,lexical_index:BM25Index = None,intent_router:IntentRouter = None,availability:AvailabilityCache | Callable[[], AvailabilityCache] = None):
         """
         Description:
             Constructor to initialize the retriever
         Arguments:
-            metadata = Metadata object
+            metadata = Metadata object, or a function returning it. A function is only called on booking turns, so that
+                the other turns donot need mysql
             chat_memory = ChatMemory object
             embedding_manager = EmbeddingManager object
-            vector_store = VectorStore object
+            vector_store = vector store object (pinecone or local backend)
+            llm_client = LLMClient object, a new client is created if not provided
+            semantic_cache = SemanticCache object answering repeated "rag" questions, no caching if not provided
+            embedding_batcher = EmbeddingBatcher object batching the query embeddings of concurrent requests
+            context_assembler = ContextAssembler object keeping the prompt within its token budget, a default one is created if not provided
+            lexical_index = BM25Index object fused with the dense search, dense search only if not provided
+            intent_router = IntentRouter object, booking turns it recognizes skip the retrieval (and the llm when the booking
+                fields are extracted locally). Every turn goes through retrieval and the llm if not provided
+            availability = AvailabilityCache object or a function returning it (like metadata), used to suggest free slots and
+                to catch a booked slot before writing
         """
-        self.metadata = metadata
+        self._metadata = metadata
         self.chat_memory = chat_memory
         self.vector_store = vector_store
         self.embedding_manager = embedding_manager
+        self.llm_client = llm_client if llm_client is not None else LLMClient()
+        self.semantic_cache = semantic_cache
+        self.embedding_batcher = embedding_batcher
+        self.context_assembler = context_assembler if context_assembler is not None else ContextAssembler()
+        self.lexical_index = lexical_index
+        self.intent_router = intent_router
+        self._availability = availability
+        self._cache_version = None # corpus version of the semantic cache lookup of this turn
+        self._cache_context = "" # conversation context of that lookup
+        self.lexical_skip_margin = float(os.getenv("LEXICAL_SKIP_MARGIN", "1.5"))
+
+    @property
+    def metadata(self) -> Metadata:
+        # resolved on the first booking write, raises while mysql is unreachable
+        if callable(self._metadata):
+            self._metadata = self._metadata()
+        return self._metadata
+
+    @property
+    def availability(self) -> AvailabilityCache | None:
+        # resolved on the first booking turn. While mysql is unreachable the booking questions are asked without
+        # free slot suggestions, and the unique indexes still catch a booked slot on write
+        if callable(self._availability):
+            try:
+                self._availability = self._availability()
+            except Exception as e:
+                print(f"error: {str(e)}")
+                return None
+        return self._availability
 
-    def retrieve(self, query:str, top_k:int) -> list[Dict]:
+    def _embed_query(self, query:str) -> np.ndarray:
         """
         Description:
-            Method to retrieve relevant documents/chunks for a query i.e, performs semantic search on vector database
-        Arguments:
-            query: the search query
-            top_k: no. of top results to return
-        Returns:
-            List of dictionaries containing retrieved documents and metadata
+            Method to create the query embedding, through the batcher when there is one
         """
-        print(f"Retrieving documents for query: {query}")
+        with metrics.span("embed_query"):
+            if self.embedding_batcher is not None:
+                return self.embedding_batcher.encode(query)
+            return self.embedding_manager.generate_embeddings([query],show_progress_bar=False)[0]
 
-        # generate query embeddings
-        query_embedding = self.embedding_manager.generate_embeddings([query])[0]
+    async def _aembed_query(self, query:str) -> np.ndarray:
+        """
+        Description:
+            Async version of _embed_query
+        """
+        with metrics.span("embed_query"):
+            if self.embedding_batcher is not None:
+                return await self.embedding_batcher.aencode(query)
+            return (await self.embedding_manager.agenerate_embeddings([query]))[0]
+
+    def _search(self, query:str, top_k:int, query_embedding:np.ndarray) -> list[Dict]:
+        """
+        Description:
+            Method for hybrid search: the lexical (BM25) and dense results are merged with reciprocal rank fusion.
+            When the best lexical result is a clear match (e.g, the only chunk with the asked email) the vector store is not queried
+        """
+        lexical = []
+        if self.lexical_index is not None:
+            try:
+                with metrics.span("lexical_search"):
+                    lexical = self.lexical_index.search(query, top_k)
+            except Exception as e:
+                print(f"Error during lexical retrieval : {e}")
+            if is_confident(lexical, min_margin=self.lexical_skip_margin):
+                print("Confident lexical match, dense retrieval skipped")
+                return lexical
 
         # search in vector store
         try:
-            results = self.vector_store.pinecone_index.query(
-                vector=query_embedding.tolist(), 
-                top_k=top_k,
-                include_metadata=True,
-                include_values=False
-            )
-            return results
+            with metrics.span("vector_query"):
+                dense = self.vector_store.query(vector=query_embedding.tolist(), top_k=top_k)
         except Exception as e:
             print(f"Error during retrieval : {e}")
-            return []
-        
-    def ret_aug_gen(self,query:str,top_k:int=3)->dict:
+            dense = []
+        if not lexical:
+            return dense
+        return reciprocal_rank_fusion([dense, lexical], top_k=top_k)
+
+    def retrieve(self, query:str, top_k:int, query_embedding:np.ndarray = None) -> list[Dict]:
         """
         Description:
-            Method for augmentation and generation
+            Method to retrieve relevant documents/chunks for a query i.e, performs hybrid (semantic + lexical) search
         Arguments:
             query: the search query
             top_k: no. of top results to return
+            query_embedding: embedding of the query if it is already computed
         Returns:
-            response dictionary
+            List of dictionaries containing retrieved documents and metadata
         """
-        # retrieve the context
-        results = self.retrieve(query=query,top_k=top_k)
-        results = [each['metadata'] for each in results['matches']]
-        context = "\n\n".join([each['text'] for each in results]) if results else "" # ternary operator not list comprehension with condition
-
-        # using redis for chat memory
-        history = self.chat_memory.get_chat_history()
+        print(f"Retrieving documents for query: {query}")
 
-        # system prompt for the llm
-        booking_system_prompt = """
-            Your job is to decide whether:
-            1. the user wants to book an interview or,
-            2. the user is asking a general question
+        # generate query embeddings
+        if query_embedding is None:
+            query_embedding = self._embed_query(query)
+        with metrics.span("retrieve"):
+            return self._search(query, top_k, query_embedding)
 
-            If the user is asking a general question:
-            - Set route to "rag"
-            - Answer using the provided context and conversation history
-            - Put the answer in the "reply" field
+    async def aretrieve(self, query:str, top_k:int, query_embedding:np.ndarray = None) -> list[Dict]:
+        """
+        Async version of retrieve. The embedding and the (blocking) searches run off the event loop
+        """
+        print(f"Retrieving documents for query: {query}")
+        if query_embedding is None:
+            query_embedding = await self._aembed_query(query)
+        with metrics.span("retrieve"):
+            return await asyncio.to_thread(self._search, query, top_k, query_embedding)
 
-            If the user wants to book an interview:
-            - Set route to "booking"
-            - Extract the following fields:
-                - name
-                - email
-                - date
-                - time
+    def _build_messages(self,query:str,results:list[Dict],history:list) -> list:
+        """
+        Description:
+            Method for augmentation i.e, builds the llm messages from the retrieved chunks and the chat history.
+            The history and the (merged) chunks are fitted in the token budget of the context assembler
+        """
+        history, context = self.context_assembler.assemble(query=query, results=results, history=history,
+                                                           reserved_tokens=estimate_tokens(booking_system_prompt))
 
-            Rules:
-            - Respond ONLY in valid JSON
-            - JSON fields must be exactly: route, booking, reply
-            - If a booking field is missing or unclear, set that field to null. Do NOT guess missing booking fields
-            - Convert dates to YYYY-MM-DD
-            - Convert times to 24-hour HH:MM
-            - If route is "booking", reply must be null
-            - If route is "rag", booking must be null
-            """
-        # user prompt for the llm 
+        # user prompt for the llm
         prompt = f"""
                 Conversation so far:
                 {history}
 
                 Context:
                 {context}
-                
+
                 Query:
                 {query}
                 """
         # print(prompt)
-        OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY") # access variables
-        response = requests.post(
-        url="https://openrouter.ai/api/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            # "HTTP-Referer": "<YOUR_SITE_URL>", # Optional. Site URL for rankings on openrouter.ai.
-            # "X-Title": "<YOUR_SITE_NAME>", # Optional. Site title for rankings on openrouter.ai.
-        },
-        data=json.dumps({
-            "model": "stepfun/step-3.5-flash:free",
-            # "model": "liquid/lfm-2.5-1.2b-thinking:free",
-            "messages": [
+        return [
             {"role": "system", "content": booking_system_prompt},
             {
                 "role": "user",
                 "content": prompt
             }
-            ],
-            "reasoning": {"enabled": True}
-        })
-        )
-        # print(response.json())
-        # print(type(json.loads(response.json())))
+            ]
 
-        hist = {"user":query,"assistance":None}
+    def _interpret_output(self,content:str,hist:dict) -> tuple:
+        """
+        Description:
+            Method to parse the llm output and decide the reply
+        Arguments:
+            content: llm completion text
+            hist: history entry of this turn, its "assistance" field is filled here
+        Returns:
+            tuple of (route, booking fields found by the llm or None, whether the turn should be saved in chat history)
+        """
         try:
-            output  = json.loads(response.json()['choices'][0]['message']['content'])
+            with metrics.span("parse"):
+                output  = json.loads(content)
             print(output)
+            if not isinstance(output, dict) or not is_valid_output(output):
+                raise Exception(f"LLM output is not in the requested format: {content[:200]}")
         except Exception as e:
             print(f"error: {str(e)}")
             hist['assistance'] = f"Something went wrong during response parsing. Try to give clear prompts."
-            return hist
+            return None, None, False
 
-        if output['route'] == "booking":
-            if output["booking"] is not None:
-                missing_fields = [k for k,v in output["booking"].items() if v is None] # fields having none values
-                if len(missing_fields) != 0:
-                    hist["assistance"] = f"Please provide the missing fields: {','.join(missing_fields)}"
+        route = output.get('route')
+        if route == "booking":
+            # the fields the llm found, merged with the session's booking draft by _booking_turn
+            return route, {k:v for k,v in (output.get("booking") or {}).items() if v is not None}, True
+        elif route == "rag":
+            hist["assistance"] = output["reply"]
+            return route, None, True
+        hist['assistance'] = f"Something went wrong during response parsing. Try to give clear prompts."
+        return route, None, False
+
+    def _route(self,query:str,query_embedding:np.ndarray,draft:dict | None) -> str | None:
+        """
+        Description:
+            Method to classify the turn with the local router before any retrieval
+        Returns:
+            "booking", "rag" or None when there is no router or it is unsure
+        """
+        if self.intent_router is None:
+            return None
+        with metrics.span("route"):
+            return self.intent_router.route(query, query_embedding, draft)
+
+    def _extract_booking(self,query:str,draft:dict | None) -> dict | None:
+        """
+        Description:
+            Method to extract the booking fields of a booking turn without the llm
+        Returns:
+            the fields found, None when the extraction failed and the llm has to read the message
+        """
+        missing = [field for field in BOOKING_FIELDS if not (draft or {}).get(field)]
+        fields = self.intent_router.extractor.extract(query, expecting=missing if draft is not None else [])
+        # a new booking request without any field only needs the questions, an answer without any field needs the llm.
+        # A complete draft (its write failed while mysql was unreachable) only needs the write
+        if fields or draft is None or not missing:
+            return fields
+        return None
+
+    def _booking_turn(self,fields:dict,draft:dict | None,hist:dict) -> tuple:
+        """
+        Description:
+            Method to merge the booking fields of this turn into the session's draft. The reply asks for the missing fields
+        Returns:
+            tuple of (booking details to write or None, draft to keep or None once the booking is complete)
+        """
+        draft = {**(draft or {}), **{k:v for k,v in fields.items() if k in BOOKING_FIELDS and v}}
+        missing_fields = [field for field in BOOKING_FIELDS if not draft.get(field)]
+        if missing_fields:
+            hist["assistance"] = f"Please provide the missing fields: {','.join(missing_fields)}"
+            if "date" in missing_fields or "time" in missing_fields:
+                hist["assistance"] += self._free_slots_text(draft.get("date"))
+            return None, draft
+        booking = {field: draft[field] for field in BOOKING_FIELDS}
+        if not self._slot_free(booking):
+            return self._slot_taken(booking, hist) # known to be booked, no write
+        return booking, None
+
+    def _slot_free(self,booking:dict) -> bool:
+        """
+        Description:
+            Method to check the slot in the availability cache. A slot that cannot be checked is written, the unique
+            index of the booking table decides
+        """
+        availability = self.availability
+        if availability is None:
+            return True
+        try:
+            return availability.is_free(booking["date"], booking["time"])
+        except Exception as e:
+            print(f"error: {str(e)}")
+            return True
+
+    def _free_slots_text(self,preferred_date:str = None) -> str:
+        """
+        Description:
+            Method to list the next free slots for the reply, from the availability cache
+        """
+        availability = self.availability
+        if availability is None:
+            return ""
+        try:
+            slots = availability.suggest_free_slots(preferred_date=preferred_date)
+        except Exception as e:
+            print(f"error: {str(e)}")
+            return ""
+        if not slots:
+            return ""
+        return " Free slots: " + ", ".join(f"{slot_date} {slot_time}" for slot_date, slot_time in slots)
+
+    def _slot_taken(self,booking:dict,hist:dict) -> tuple:
+        """
+        Description:
+            Method to reply to a booking of a slot that is already booked. The other fields are kept in the draft,
+            so the user only has to choose another slot
+        Returns:
+            tuple of (None, draft without the date and time)
+        """
+        hist["assistance"] = "This interview slot is already booked, please provide another date and time." + self._free_slots_text(booking["date"])
+        return None, {k:v for k,v in booking.items() if k not in ("date","time")}
+
+    def _write_booking(self,booking:dict) -> None | dict:
+        """
+        Description:
+            Method to write the booking in the sql database and keep the availability cache up to date
+        Returns:
+            the result of Metadata.write_booking_details, or {"Message", "conflict": "unavailable"} while mysql is unreachable
+        """
+        try:
+            with metrics.span("booking_write"):
+                response = self.metadata.write_booking_details(booking)
+        except Exception as e:
+            print(f"error: {str(e)}")
+            return {"Message":"Booking is not available right now, your details are kept. Please ask to book the interview again later","conflict":"unavailable"}
+        availability = self.availability
+        if availability is not None:
+            try:
+                if response is None:
+                    availability.mark_booked(booking["date"], booking["time"])
+                elif response.get("conflict") == "slot":
+                    availability.refresh() # booked by another process since the last read
+            except Exception as e:
+                print(f"error: {str(e)}")
+        return response
+
+    def _booking_reply(self,response:None | dict,booking:dict,hist:dict) -> tuple:
+        """
+        Description:
+            Method to fill the reply from the result of the booking write
+        Returns:
+            tuple of (whether the turn should be saved in chat history, draft to keep or None)
+        """
+        if response is None:
+            hist["assistance"] = "Your interview is scheduled successfully"
+            return True, None
+        if response.get("conflict") == "slot":
+            return True, self._slot_taken(booking, hist)[1]
+        hist['assistance'] = response['Message']
+        if response.get("conflict") == "unavailable":
+            return False, booking # kept as the draft, the next booking turn of the session writes it again
+        return False, None
+
+    def _cached_reply(self,query_embedding:np.ndarray,history:list,draft:dict | None = None) -> str | None:
+        """
+        Description:
+            Method to look the query up in the semantic cache. The cache is skipped while a booking is in progress,
+            because the user's message then answers the booking questions instead of asking about the documents.
+            Answers are only shared between turns of the same history, they can depend on it. The corpus version
+            and the context of the lookup are kept for _cache_reply
+        """
+        if self.semantic_cache is None or draft is not None:
+            return None
+        if history and "Please provide the missing fields" in str(history[-1]):
+            return None
+        with metrics.span("cache_lookup"):
+            self._cache_context = history_fingerprint(history)
+            reply, self._cache_version = self.semantic_cache.lookup(query_embedding, self._cache_context)
+        return reply
+
+    def _cache_reply(self,route:str,query_embedding:np.ndarray,hist:dict,started:float) -> None:
+        """
+        Description:
+            Method to cache the reply of a "rag" turn, under the corpus version of its lookup. Booking turns and the turns
+            that skipped the lookup are never cached
+        """
+        if self.semantic_cache is not None and route == "rag" and hist["assistance"] and self._cache_version is not None:
+            self.semantic_cache.store(query_embedding, hist["assistance"], time.perf_counter() - started, self._cache_version,
+                                      self._cache_context)
+
+    def ret_aug_gen(self,query:str,top_k:int=3)->dict:
+        """
+        Description:
+            Method for augmentation and generation
+        Arguments:
+            query: the search query
+            top_k: no. of top results to return
+        Returns:
+            response dictionary
+        """
+        started = time.perf_counter()
+        query_embedding = self._embed_query(query)
+
+        # using redis for chat memory, the booking draft is read in the same round trip
+        history, draft = self.chat_memory.get_session()
+
+        hist = {"user":query,"assistance":None}
+        if self._route(query, query_embedding, draft) == "booking":
+            fields = self._extract_booking(query, draft)
+            if fields is not None:
+                # handled locally, no retrieval and no llm call
+                booking, draft = self._booking_turn(fields, draft, hist)
+                if self._finish_booking(booking, draft, hist):
                     self.chat_memory.save_chat_history(history= hist)
-                    return hist
-                else:
-                    # print(output['booking'])
-                    # saving the booking details in the same sql database of metadata
-                    # save the booking details
-                    response = self.metadata.write_booking_details(output["booking"])
-                    if response is None:
-                        hist["assistance"] = "Your interview is scheduled successfully"
-                        self.chat_memory.save_chat_history(history= hist)
-                        return hist
-                    else:
-                        hist['assistance'] = response['Message']
-                        return hist
-                        
-            else:
-                all_fields = ["name","email","date","time"]
-                hist['assistance'] = f"Please provide the missing fields: {','.join(all_fields)}"
+                return hist
+            results = [] # the llm only has to read the booking fields, the documents are not needed
+        else:
+            cached = self._cached_reply(query_embedding, history, draft)
+            if cached is not None:
+                hist["assistance"] = cached
                 self.chat_memory.save_chat_history(history= hist)
                 return hist
-        elif output["route"] == "rag":
-            hist["assistance"] = output["reply"]
+
+            # retrieve the context
+            results = self.retrieve(query=query,top_k=top_k,query_embedding=query_embedding)
+
+        messages = self._build_messages(query=query,results=results,history=history)
+        try:
+            content = self.llm_client.complete_json(messages, validate=is_valid_output)
+        except Exception as e:
+            print(f"error: {str(e)}")
+            hist['assistance'] = f"Something went wrong during response parsing. Try to give clear prompts."
+            return hist
+
+        route, fields, save = self._interpret_output(content, hist)
+        if route == "booking":
+            booking, draft = self._booking_turn(fields, draft, hist)
+            save = self._finish_booking(booking, draft, hist)
+        if save:
             self.chat_memory.save_chat_history(history= hist)
+        self._cache_reply(route, query_embedding, hist, started)
+        return hist
+
+    def _finish_booking(self,booking:dict | None,draft:dict | None,hist:dict) -> bool:
+        """
+        Description:
+            Method to save the complete booking details in the sql database, and the draft of an incomplete booking in redis
+        Returns:
+            whether the turn should be saved in chat history
+        """
+        save = True
+        if booking is not None:
+            # saving the booking details in the same sql database of metadata
+            save, draft = self._booking_reply(self._write_booking(booking), booking, hist)
+        self.chat_memory.save_booking_draft(draft)
+        return save
+
+    async def _afinish_booking(self,booking:dict | None,draft:dict | None,hist:dict) -> bool:
+        """
+        Description:
+            Async version of _finish_booking
+        """
+        save = True
+        if booking is not None:
+            response = await asyncio.to_thread(self._write_booking, booking)
+            save, draft = self._booking_reply(response, booking, hist)
+        await self.chat_memory.asave_booking_draft(draft)
+        return save
+
+    async def _aprepare(self,query:str) -> tuple:
+        """
+        Description:
+            Method to embed the query and read the session (chat history and booking draft) concurrently, then route the turn
+            and, unless it is a booking turn, look the query up in the semantic cache
+        Returns:
+            tuple of (query embedding, chat history, booking draft or None, route, cached reply or None)
+        """
+        query_embedding, (history, draft) = await asyncio.gather(
+            self._aembed_query(query),
+            self.chat_memory.aget_session(),
+        )
+        route = self._route(query, query_embedding, draft)
+        cached = self._cached_reply(query_embedding, history, draft) if route != "booking" else None
+        return query_embedding, history, draft, route, cached
+
+    async def aret_aug_gen(self,query:str,top_k:int=3)->dict:
+        """
+        Async version of ret_aug_gen. The query embedding and the chat history read run concurrently and the llm call
+        doesnot hold a worker thread while waiting
+        """
+        started = time.perf_counter()
+        query_embedding, history, draft, route, cached = await self._aprepare(query)
+        hist = {"user":query,"assistance":None}
+        if cached is not None:
+            hist["assistance"] = cached
+            await self.chat_memory.asave_chat_history(history= hist)
+            return hist
+
+        results = []
+        if route == "booking":
+            fields = self._extract_booking(query, draft)
+            if fields is not None:
+                booking, draft = self._booking_turn(fields, draft, hist)
+                if await self._afinish_booking(booking, draft, hist):
+                    await self.chat_memory.asave_chat_history(history= hist)
+                return hist
+        else:
+            results = await self.aretrieve(query=query,top_k=top_k,query_embedding=query_embedding)
+        messages = self._build_messages(query=query,results=results,history=history)
+        try:
+            content = await self.llm_client.acomplete_json(messages, validate=is_valid_output)
+        except Exception as e:
+            print(f"error: {str(e)}")
+            hist['assistance'] = f"Something went wrong during response parsing. Try to give clear prompts."
             return hist
 
+        route, fields, save = self._interpret_output(content, hist)
+        if route == "booking":
+            booking, draft = self._booking_turn(fields, draft, hist)
+            save = await self._afinish_booking(booking, draft, hist)
+        if save:
+            await self.chat_memory.asave_chat_history(history= hist)
+        self._cache_reply(route, query_embedding, hist, started)
+        return hist
+
+    async def astream_ret_aug_gen(self,query:str,top_k:int=3):
+        """
+        Description:
+            Streaming version of aret_aug_gen. The llm completion is parsed while it arrives, so the route
+            and the reply tokens are sent to the client before the completion has finished
+        Arguments:
+            query: the search query
+            top_k: no. of top results to return
+        Returns:
+            async generator of events: ("route", route), ("token", reply text) and finally ("done", response dictionary)
+        """
+        started = time.perf_counter()
+        query_embedding, history, draft, route, cached = await self._aprepare(query)
+        hist = {"user":query,"assistance":None}
+        if cached is not None:
+            hist["assistance"] = cached
+            await self.chat_memory.asave_chat_history(history= hist)
+            yield ("route", "rag")
+            yield ("token", cached)
+            yield ("done", hist)
+            return
+
+        results = []
+        if route == "booking":
+            fields = self._extract_booking(query, draft)
+            if fields is not None:
+                yield ("route", "booking")
+                booking, draft = self._booking_turn(fields, draft, hist)
+                if await self._afinish_booking(booking, draft, hist):
+                    await self.chat_memory.asave_chat_history(history= hist)
+                yield ("done", hist)
+                return
+        else:
+            results = await self.aretrieve(query=query,top_k=top_k,query_embedding=query_embedding)
+        messages = self._build_messages(query=query,results=results,history=history)
+        parser = ReplyStreamParser()
+        try:
+            async for delta in self.llm_client.astream(messages):
+                for event, data in parser.feed(delta):
+                    yield ("route", data) if event == "route" else ("token", data)
+        except Exception as e:
+            print(f"error: {str(e)}")
+            hist['assistance'] = f"Something went wrong during response parsing. Try to give clear prompts."
+            yield ("done", hist)
+            return
+
+        # the history is saved once the whole completion has arrived
+        route, fields, save = self._interpret_output(parser.json_text(), hist)
+        if route == "booking":
+            booking, draft = self._booking_turn(fields, draft, hist)
+            save = await self._afinish_booking(booking, draft, hist)
+        if save:
+            await self.chat_memory.asave_chat_history(history= hist)
+        self._cache_reply(route, query_embedding, hist, started)
+        yield ("done", hist)
+
 # if __name__ == "__main__":
 #     rag_retriever = RAGRetriever()
 #     # response = rag_retriever.ret_aug_gen(query="Did he get certification from any college or institution? If yes what is the name of the institution")
 #     # response = rag_retriever.ret_aug_gen(query="What skillsets has he got?")
 #     response = rag_retriever.ret_aug_gen(query="What is his contact number?")
 #     print("\n\n")
-#     print(response['assistance'])
\ No newline at end of file
+#     print(response['assistance'])
@@ -0,0 +1,292 @@
+import os
+import threading
+import time
+from typing import Callable, Dict
+from services.embedding import EmbeddingManager, EmbeddingBatcher
+from services.vectorstore import BaseVectorStore, Metadata, create_vector_store
+from services.chat_memory import ChatMemory
+from services.llm import LLMClient
+from services.semantic_cache import SemanticCache
+from services.context import ContextAssembler
+from services.parsing import ParallelParser
+from services.lexical import BM25Index
+from services.dedup import DedupIndex
+from services.docstore import DocStore
+from services.router import IntentRouter
+from services.availability import AvailabilityCache
+
+# resources of the chat api: the ones every turn needs, and the mysql ones only booking turns need (loaded on first use)
+CHAT_RESOURCES = ["embedding_manager", "docstore", "vector_store", "redis_client", "async_redis_client", "llm_client",
+                  "semantic_cache", "embedding_batcher", "context_assembler", "lexical_index", "intent_router"]
+BOOKING_RESOURCES = ["metadata", "availability"]
+
+class ResourceRegistry:
+    """
+    Holds the process wide resources (embedding model, vector store client, sql metadata, redis clients and llm client)
+    so that they are created once and shared by every request and worker thread
+    """
+    def __init__(self):
+        """
+        Description:
+            Constructor to initialize the registry. Nothing is loaded until warm_up() or the first get()
+        """
+        self._lock = threading.RLock() # reentrant because some factories get other resources
+        self._resources = {}
+        self._errors = {}
+        self._load_times = {}
+        # name -> factory creating the resource
+        self._factories: Dict[str, Callable] = {
+            "embedding_manager": self._create_embedding_manager,
+            "docstore": lambda: DocStore(store_dir=os.getenv("DOCSTORE_DIR", "data/docstore")),
+            "vector_store": lambda: create_vector_store(docstore=self.get("docstore")),
+            "metadata": self._create_metadata,
+            "redis_client": ChatMemory.create_connection,
+            "async_redis_client": ChatMemory.create_async_connection,
+            "llm_client": LLMClient,
+            "semantic_cache": self._create_semantic_cache,
+            "embedding_batcher": self._create_embedding_batcher,
+            "context_assembler": self._create_context_assembler,
+            "parser": ParallelParser,
+            "lexical_index": lambda: BM25Index(index_dir=os.getenv("LEXICAL_INDEX_DIR", "data/lexical_index"), docstore=self.get("docstore")),
+            "dedup_index": lambda: DedupIndex(index_dir=os.getenv("DEDUP_INDEX_DIR", "data/dedup_index"),
+                                              threshold=float(os.getenv("DEDUP_THRESHOLD", "0.9"))),
+            "intent_router": lambda: IntentRouter(embedding_manager=self.get("embedding_manager")),
+            "availability": self._create_availability,
+        }
+
+    def _create_embedding_manager(self) -> EmbeddingManager:
+        """
+        Description:
+            Loads the embedding model and runs one dummy encode so that the first request doesnot pay for the lazy initialization
+        """
+        embedding_manager = EmbeddingManager()
+        embedding_manager.model.encode(["warm up"], show_progress_bar=False)
+        return embedding_manager
+
+    def _create_metadata(self) -> Metadata:
+        """
+        Description:
+            Connects to the sql database and makes sure the booking table has its unique indexes
+        """
+        metadata = Metadata()
+        metadata.ensure_schema()
+        return metadata
+
+    def _create_availability(self) -> AvailabilityCache:
+        """
+        Description:
+            Reads the booked slots once, so that the first booking turn doesnot wait for mysql
+        """
+        availability = AvailabilityCache(metadata=self.get("metadata"))
+        availability.refresh()
+        return availability
+
+    def _create_semantic_cache(self) -> SemanticCache:
+        """
+        Description:
+            Creates the semantic answer cache configured by the SEMANTIC_CACHE_* variables
+        """
+        return SemanticCache(
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "1000")),
+            ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600")),
+        )
+
+    def _create_embedding_batcher(self) -> EmbeddingBatcher:
+        """
+        Description:
+            Creates the query embedding batcher configured by the EMBEDDING_BATCH_* variables
+        """
+        return EmbeddingBatcher(
+            self.get("embedding_manager"),
+            max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+            max_wait_ms=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")),
+        )
+
+    def _create_context_assembler(self) -> ContextAssembler:
+        """
+        Description:
+            Creates the prompt assembler configured by the PROMPT_* variables
+        """
+        return ContextAssembler(
+            max_tokens=int(os.getenv("PROMPT_TOKEN_BUDGET", "3000")),
+            recent_turns=int(os.getenv("PROMPT_RECENT_TURNS", "4")),
+        )
+
+    def register(self, name:str, factory:Callable) -> None:
+        """
+        Description:
+            Method to replace the factory of a resource (e.g, with a local stand-in). A loaded resource of that name is
+            forgotten and created again by the new factory on next get
+        Arguments:
+            name: name of the resource
+            factory: function creating the resource
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._resources.pop(name, None)
+            self._errors.pop(name, None)
+            self._load_times.pop(name, None)
+
+    def reset(self) -> None:
+        """
+        Description:
+            Method to forget every loaded resource, they are created again on next get. The connections
+            must be closed with aclose() first
+        """
+        with self._lock:
+            self._resources.clear()
+            self._errors.clear()
+            self._load_times.clear()
+
+    def get(self, name:str):
+        """
+        Description:
+            Method to get a shared resource. The resource is created on first use if warm up didnot load it
+        Arguments:
+            name: name of the resource. Supported names = "embedding_manager","docstore","vector_store","metadata","redis_client","async_redis_client","llm_client","semantic_cache","embedding_batcher","context_assembler","parser","lexical_index","dedup_index","intent_router","availability"
+        Return:
+            the shared resource object
+        """
+        resource = self._resources.get(name)
+        if resource is not None:
+            return resource
+        if name not in self._factories:
+            raise Exception(f"{name} resource not supported!!!!")
+        with self._lock:
+            # another thread might have created it while we were waiting for the lock
+            if name not in self._resources:
+                start = time.perf_counter()
+                try:
+                    self._resources[name] = self._factories[name]()
+                    self._errors.pop(name, None)
+                except Exception as e:
+                    self._errors[name] = str(e)
+                    raise Exception(f"Error in loading {name}: {str(e)}")
+                self._load_times[name] = round(time.perf_counter() - start, 3)
+                print(f"{name} loaded in {self._load_times[name]} seconds")
+            return self._resources[name]
+
+    def warm_up(self, names:list = None) -> dict:
+        """
+        Description:
+            Method to load the resources of an app at startup. Failures are recorded instead of raised so that
+            the app still starts and reports what is not ready
+        Arguments:
+            names: resources to load, every registered resource if not provided
+        Return:
+            readiness dictionary of the same resources
+        """
+        for name in names or list(self._factories):
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"Warm up failed: {e}")
+        return self.readiness(names)
+
+    def readiness(self, names:list = None, optional:list = None) -> dict:
+        """
+        Description:
+            Method to report the state of the resources of an app
+        Arguments:
+            names: resources the app needs to be ready, every registered resource if not provided
+            optional: resources that are reported but donot make the app unready (e.g, mysql for the chat api)
+        Return:
+            dictionary with overall readiness and per resource status
+        """
+        names = names or list(self._factories)
+        optional = [name for name in optional or [] if name not in names]
+        resources = {}
+        for name in names + optional:
+            if name in self._resources:
+                resources[name] = {"status": "ready", "load_seconds": self._load_times.get(name)}
+            elif name in self._errors:
+                resources[name] = {"status": "error", "error": self._errors[name]}
+            else:
+                resources[name] = {"status": "not loaded"}
+        ready = all(resources[name]["status"] == "ready" for name in names)
+        return {"ready": ready, "resources": resources}
+
+    def chat_memory(self, sessionid:str) -> ChatMemory:
+        """
+        Description:
+            Method to create the per session chat memory on top of the shared redis clients
+        Arguments:
+            sessionid: id of the chat session
+        Return:
+            ChatMemory object
+        """
+        return ChatMemory(sessionid=sessionid, redis_client=self.get("redis_client"), async_redis_client=self.get("async_redis_client"))
+
+    async def aclose(self) -> None:
+        """
+        Description:
+            Method to close the pooled network connections (llm, redis, mysql) and the parser processes at shutdown
+        """
+        if "llm_client" in self._resources:
+            await self._resources["llm_client"].aclose()
+        if "async_redis_client" in self._resources:
+            await self._resources["async_redis_client"].aclose()
+        if "redis_client" in self._resources:
+            self._resources["redis_client"].close()
+            ChatMemory.close_pool()
+        if "metadata" in self._resources:
+            self._resources["metadata"].close()
+        if "parser" in self._resources:
+            self._resources["parser"].close()
+
+    @property
+    def embedding_manager(self) -> EmbeddingManager:
+        return self.get("embedding_manager")
+
+    @property
+    def docstore(self) -> DocStore:
+        return self.get("docstore")
+
+    @property
+    def vector_store(self) -> BaseVectorStore:
+        return self.get("vector_store")
+
+    @property
+    def metadata(self) -> Metadata:
+        return self.get("metadata")
+
+    @property
+    def llm_client(self) -> LLMClient:
+        return self.get("llm_client")
+
+    @property
+    def semantic_cache(self) -> SemanticCache:
+        return self.get("semantic_cache")
+
+    @property
+    def embedding_batcher(self) -> EmbeddingBatcher:
+        return self.get("embedding_batcher")
+
+    @property
+    def context_assembler(self) -> ContextAssembler:
+        return self.get("context_assembler")
+
+    @property
+    def parser(self) -> ParallelParser:
+        return self.get("parser")
+
+    @property
+    def lexical_index(self) -> BM25Index:
+        return self.get("lexical_index")
+
+    @property
+    def dedup_index(self) -> DedupIndex:
+        return self.get("dedup_index")
+
+    @property
+    def intent_router(self) -> IntentRouter:
+        return self.get("intent_router")
+
+    @property
+    def availability(self) -> AvailabilityCache:
+        return self.get("availability")
+
+
+# one registry per process
+registry = ResourceRegistry()
@@ -0,0 +1,233 @@
+import os
+import re
+from datetime import date, timedelta
+import numpy as np
+from services.embedding import EmbeddingManager
+
+BOOKING_FIELDS = ["name", "email", "date", "time"]
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+_MONTH = r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sept?(?:ember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b\.?"
+_WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_ISO_DATE = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+_NUMERIC_DATE = re.compile(r"\b(\d{1,2})[/.](\d{1,2})[/.](\d{4})\b")
+_DAY_MONTH = re.compile(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?" + _MONTH + r"(?:,?\s+(\d{4}))?\b")
+_MONTH_DAY = re.compile(r"\b" + _MONTH + r"\s+(\d{1,2})(?:st|nd|rd|th)?(?:,?\s+(\d{4}))?\b")
+_RELATIVE_DAY = re.compile(r"\b(day after tomorrow|tomorrow|today)\b")
+_WEEKDAY = re.compile(r"\b(?:(next|this|on|coming)\s+)?(" + "|".join(_WEEKDAYS) + r")\b")
+_CLOCK_TIME = re.compile(r"\b([01]?\d|2[0-3]):([0-5]\d)\s*([ap])?\.?m?\.?(?![\w])")
+_HOUR_TIME = re.compile(r"\b(1[0-2]|0?[1-9])\s*([ap])\.?m\.?(?![\w])")
+_NOON = re.compile(r"\b(noon|midday|midnight)\b")
+_NAME = re.compile(r"\b(my name is|name is|name\s*[:=]|this is|i am|i'm)\s+([A-Za-z][A-Za-z.'-]*(?:\s+[A-Za-z][A-Za-z.'-]*){0,2})", re.IGNORECASE)
+_PLAIN_NAME = re.compile(r"[A-Za-z][A-Za-z.'-]*(?:\s+[A-Za-z][A-Za-z.'-]*){0,2}")
+# words that end a name, or show that a short message is not a name
+_NOT_NAME = {"and", "my", "email", "mail", "on", "at", "for", "the", "a", "an", "to", "is", "available", "interested", "looking",
+             "here", "free", "yes", "no", "ok", "okay", "hi", "hello", "hey", "thanks", "thank", "you", "sure", "please", "book",
+             "interview", "tomorrow", "today", "not", "fine", "good", "done", "what", "who", "how", "why", "when", "where",
+             "his", "her", "their", "me", "tell", "about", "show", "list", "give"}
+# words of questions about the documents, a short message with one of them is not a name ("Python skills")
+_TOPIC_WORDS = {"skill", "skills", "experience", "education", "project", "projects", "contact", "number", "phone", "resume",
+                "cv", "profile", "work", "job", "jobs", "company", "companies", "degree", "certification", "certifications",
+                "language", "languages", "summary", "details", "address", "salary", "role", "roles", "team", "years"}
+_QUESTION = re.compile(r"\?\s*$|^\s*(what|which|who|whom|whose|where|when|why|how|does|did|is|are|was|were|has|have|tell|list|describe|summari[sz]e)\b", re.IGNORECASE)
+# explicit requests to book, reschedule or set up an interview
+_BOOKING_REQUEST = re.compile(r"\b(book|schedule|reschedule|set\s+up|arrange|fix)\b.*\b(interview|slot|appointment|meeting|call)\b"
+                              r"|\b(interview|slot|appointment)\b.*\b(book|schedule)\b")
+# questions that ask for something to be done ("can I book an interview?") rather than about the documents
+_REQUEST_QUESTION = re.compile(r"^\s*(?:please\s+)?(can|could|may|would|will)\s+(i|we|you)\b", re.IGNORECASE)
+
+BOOKING_EXAMPLES = [
+    "I want to book an interview",
+    "schedule an interview for me",
+    "can I book an interview slot tomorrow at 10 am",
+    "please book an interview on 2026-03-10 at 14:00",
+    "I would like to set up an interview",
+    "my email is john@example.com and my name is John",
+    "book me for friday afternoon",
+    "is there an interview slot available next week",
+]
+RAG_EXAMPLES = [
+    "what are his skills",
+    "what is his contact number",
+    "tell me about his education",
+    "which projects has he worked on",
+    "summarize the document",
+    "what certifications does he have",
+    "how many years of work experience does he have",
+    "which programming languages does he know",
+]
+
+
+class BookingExtractor:
+    """
+    Deterministic extraction of the booking fields (name, email, date, time) from a message.
+    Dates are converted to YYYY-MM-DD and times to 24-hour HH:MM, like the llm is asked to do.
+    Ambiguous values (e.g 03/04/2026) are left out so that the user or the llm fills them
+    """
+    def _date(self, text:str, today:date) -> str | None:
+        candidates = []
+        match = _ISO_DATE.search(text)
+        if match:
+            candidates.append((int(match[1]), int(match[2]), int(match[3])))
+        match = _NUMERIC_DATE.search(text)
+        if match:
+            first, second, year = int(match[1]), int(match[2]), int(match[3])
+            if first > 12 or first == second:
+                candidates.append((year, second, first)) # day first
+            elif second > 12:
+                candidates.append((year, first, second)) # month first
+        for match, day_group, month_group in ((_DAY_MONTH.search(text), 1, 2), (_MONTH_DAY.search(text), 2, 1)):
+            if match:
+                month = _MONTHS.index(match[month_group][:3]) + 1
+                year = int(match[3]) if match[3] else today.year
+                candidates.append((year, month, int(match[day_group])))
+                if not match[3]: # a day of the month without a year is the next one
+                    try:
+                        if date(year, month, int(match[day_group])) < today:
+                            candidates[-1] = (year + 1, month, int(match[day_group]))
+                    except ValueError:
+                        pass
+        match = _RELATIVE_DAY.search(text)
+        if match:
+            days = {"today": 0, "tomorrow": 1, "day after tomorrow": 2}[match[1]]
+            candidates.append((today + timedelta(days=days)).timetuple()[:3])
+        match = _WEEKDAY.search(text)
+        if match:
+            ahead = (_WEEKDAYS.index(match[2]) - today.weekday()) % 7 or 7 # the next one, never today
+            candidates.append((today + timedelta(days=ahead)).timetuple()[:3])
+        for year, month, day in candidates:
+            try:
+                return date(year, month, day).isoformat()
+            except ValueError:
+                continue
+        return None
+
+    def _time(self, text:str) -> str | None:
+        match = _CLOCK_TIME.search(text)
+        if match:
+            hour, minute = int(match[1]), int(match[2])
+            if match[3] and hour <= 12:
+                hour = hour % 12 + (12 if match[3] == "p" else 0)
+            return f"{hour:02d}:{minute:02d}"
+        match = _HOUR_TIME.search(text)
+        if match:
+            hour = int(match[1]) % 12 + (12 if match[2] == "p" else 0)
+            return f"{hour:02d}:00"
+        match = _NOON.search(text)
+        if match:
+            return "00:00" if match[1] == "midnight" else "12:00"
+        return None
+
+    def _name(self, message:str, expecting:list) -> str | None:
+        match = _NAME.search(message)
+        if match:
+            words = []
+            for word in match[2].split():
+                if word.lower() in _NOT_NAME:
+                    break
+                words.append(word)
+            # "i am"/"this is" are also used for other things ("I am free on monday"), the name must be capitalized there
+            explicit = "name" in match[1].lower()
+            if words and (explicit or all(word[0].isupper() for word in words)):
+                return " ".join(word.capitalize() for word in words)
+        # a short answer to a question asking for the name: no question, no topic of the documents, and capitalized
+        # like a name, or typed all in lower case
+        stripped = message.strip().strip(".!")
+        if "name" in expecting and _PLAIN_NAME.fullmatch(stripped) and not _QUESTION.search(stripped):
+            words = stripped.split()
+            capitalized = [word[0].isupper() for word in words]
+            if (all(capitalized) or not any(capitalized)) and \
+                    not any(word.lower() in _NOT_NAME or word.lower() in _TOPIC_WORDS for word in words):
+                return " ".join(word.capitalize() for word in words)
+        return None
+
+    def extract(self, message:str, expecting:list = None, today:date = None) -> dict:
+        """
+        Description:
+            Method to extract the booking fields found in a message
+        Arguments:
+            message: the user's message
+            expecting: booking fields the user was asked for, a short message is then read as the answer
+            today: reference day of the relative dates (tomorrow, next monday), the current day if not provided
+        Return:
+            dictionary of the fields found, the others are left out
+        """
+        expecting = expecting or []
+        today = today or date.today()
+        text = message.lower()
+        fields = {}
+        email = _EMAIL.search(message)
+        if email:
+            fields["email"] = email[0].lower()
+        # the email is removed first, its digits and dots would look like dates and times
+        text = _EMAIL.sub(" ", text)
+        for field, value in (("date", self._date(text, today)), ("time", self._time(text)),
+                             ("name", self._name(_EMAIL.sub(" ", message), expecting))):
+            if value is not None:
+                fields[field] = value
+        return fields
+
+
+class IntentRouter:
+    """
+    Fast local classification of a chat message as a booking turn or a question about the documents, before
+    any retrieval. Rules decide the clear cases (answers to the booking questions, explicit booking requests),
+    then the query embedding is compared with the centroids of booking and question examples
+    """
+    def __init__(self,embedding_manager:EmbeddingManager,margin:float = None,extractor:BookingExtractor = None):
+        """
+        Description:
+            Constructor to initialize the router. The centroids are computed on the first call
+        Arguments:
+            embedding_manager: EmbeddingManager object, the same model as the query embeddings
+            margin: minimum difference of the cosine similarities with the two centroids, ROUTER_MARGIN variable or 0.05 if not provided
+            extractor: BookingExtractor object
+        """
+        self.embedding_manager = embedding_manager
+        self.margin = margin if margin is not None else float(os.getenv("ROUTER_MARGIN", "0.05"))
+        self.extractor = extractor if extractor is not None else BookingExtractor()
+        self._centroids = None
+
+    @property
+    def centroids(self) -> np.ndarray:
+        """
+        (2, dim) normalized centroids of the booking and the question examples
+        """
+        if self._centroids is None:
+            centroids = []
+            for examples in (BOOKING_EXAMPLES, RAG_EXAMPLES):
+                embeddings = np.asarray(self.embedding_manager.generate_embeddings(examples, show_progress_bar=False), dtype=np.float32)
+                embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+                centroid = embeddings.mean(axis=0)
+                centroids.append(centroid / max(np.linalg.norm(centroid), 1e-12))
+            self._centroids = np.stack(centroids)
+        return self._centroids
+
+    def route(self, query:str, query_embedding:np.ndarray = None, draft:dict = None) -> str | None:
+        """
+        Description:
+            Method to classify a message
+        Arguments:
+            query: the user's message
+            query_embedding: embedding of the message, only the rules are used if not provided
+            draft: booking fields collected so far in the session, None if no booking is in progress
+        Return:
+            "booking", "rag", or None when the router is unsure and the llm decides
+        """
+        if draft is not None:
+            missing = [field for field in BOOKING_FIELDS if not draft.get(field)]
+            if self.extractor.extract(query, expecting=missing):
+                return "booking" # answers the booking questions
+        if _BOOKING_REQUEST.search(query.lower()) and (not _QUESTION.search(query) or _REQUEST_QUESTION.search(query)):
+            return "booking" # a question mentioning a booking word ("did he fix the call routing bug?") is not a request
+        if query_embedding is None:
+            return None
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        similarity = self.centroids @ (vector / max(np.linalg.norm(vector), 1e-12))
+        if similarity[0] - similarity[1] >= self.margin:
+            # a question close to the booking examples ("what is his email?") is left to the llm
+            return None if _QUESTION.search(query) else "booking"
+        if similarity[1] - similarity[0] >= self.margin:
+            return "rag"
+        return None
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from services.manifest import read_corpus_version
+
+
+def history_fingerprint(history:list) -> str:
+    """
+    Description:
+        Key of the conversation an answer was given in, an answer can depend on it ("what is his number?")
+    Arguments:
+        history: chat history of the session before the query
+    Return:
+        "" for a conversation without history, a hash of the history otherwise
+    """
+    if not history:
+        return ""
+    return hashlib.sha256(json.dumps(history, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+
+class SemanticCache:
+    """
+    Cache of "rag" answers keyed by the query embedding and the conversation it was asked in. A query is served from
+    the cache when a cached query of the same conversation context is at least `threshold` cosine similar. Entries expire after `ttl_seconds`, the least recently used entry
+    is evicted when the cache is full, and everything is dropped when ingestion bumps the corpus version
+    """
+    def __init__(self,threshold:float = 0.92,max_entries:int = 1000,ttl_seconds:float = 3600,version_path:str = "data/corpus_version",version_check_seconds:float = 1.0):
+        """
+        Description:
+            Constructor to initialize the cache
+        Arguments:
+            threshold: minimum cosine similarity of a cache hit
+            max_entries: maximum no. of cached answers
+            ttl_seconds: lifetime of a cached answer
+            version_path: path of the corpus version file written by ingestion
+            version_check_seconds: how often the corpus version file is read
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_path = version_path
+        self.version_check_seconds = version_check_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> {"embedding","context","reply","created","cost"}, oldest use first
+        self._next_key = 0
+        self._matrix = None # normalized embeddings of the entries, rebuilt after a change
+        self._keys = []
+        self._contexts = None # context of each row of the matrix
+        self._version = read_corpus_version(self.version_path)
+        self._version_checked = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self.stale_drops = 0 # answers not cached because the corpus changed while they were built
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _check_version(self) -> None:
+        now = time.monotonic()
+        if now - self._version_checked < self.version_check_seconds:
+            return
+        self._version_checked = now
+        version = read_corpus_version(self.version_path)
+        if version != self._version:
+            print(f"Corpus changed (version {self._version} -> {version}), semantic cache cleared")
+            self._version = version
+            self._entries.clear()
+            self._matrix = None
+
+    def _expire(self) -> None:
+        deadline = time.monotonic() - self.ttl_seconds
+        expired = [key for key, entry in self._entries.items() if entry["created"] < deadline]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, query_embedding, context:str = "") -> tuple:
+        """
+        Description:
+            Method to find the answer of a semantically similar query asked in the same context
+        Arguments:
+            query_embedding: embedding of the query
+            context: conversation context of the query (history_fingerprint), answers of other contexts are not served
+        Return:
+            tuple of (cached reply or None on a miss, corpus version, to be passed to store() with the answer of a miss)
+        """
+        query = self._normalize(query_embedding)
+        with self._lock:
+            self._check_version()
+            self._expire()
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries.keys())
+                    self._matrix = np.stack([self._entries[key]["embedding"] for key in self._keys])
+                    self._contexts = np.array([self._entries[key]["context"] for key in self._keys], dtype=object)
+                scores = np.where(self._contexts == context, self._matrix @ query, -np.inf)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key = self._keys[best]
+                    entry = self._entries[key]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.latency_saved += entry["cost"]
+                    return entry["reply"], self._version
+            self.misses += 1
+            return None, self._version
+
+    def store(self, query_embedding, reply:str, cost_seconds:float, version, context:str = "") -> None:
+        """
+        Description:
+            Method to cache the answer of a query. The answer is dropped if ingestion changed the corpus since the lookup,
+            it was built from the previous documents
+        Arguments:
+            query_embedding: embedding of the query
+            reply: answer sent to the user
+            cost_seconds: time it took to produce the answer, credited as latency saved on every hit
+            version: corpus version returned by the lookup of the query
+            context: conversation context of the query, the same as its lookup
+        """
+        with self._lock:
+            self._check_version()
+            if version != self._version:
+                self.stale_drops += 1
+                return
+            self._entries[self._next_key] = {"embedding": self._normalize(query_embedding), "context": context, "reply": reply,
+                                             "created": time.monotonic(), "cost": cost_seconds}
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self) -> dict:
+        """
+        Description:
+            Method to report the cache counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+                "stale_drops": self.stale_drops,
+                "size": len(self._entries),
+                "corpus_version": self._version,
+            }
@@ -0,0 +1,161 @@
+import re
+
+_HEX_DIGITS = set("0123456789abcdefABCDEF")
+_LOW_SURROGATE = re.compile(r"\\u[dD][c-fC-F][0-9a-fA-F]{2}")
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class ReplyStreamParser:
+    """
+    Incremental parser of the llm's JSON answer ({"route": ..., "booking": ..., "reply": ...}).
+    Completion tokens are fed as they arrive; the route is reported as soon as its value is complete
+    and the reply string is decoded and reported piece by piece, before the JSON is finished
+    """
+    def __init__(self):
+        self.text = "" # whole completion, parsed with json.loads once the stream ends
+        self.route = None
+        self._state = "start" # start, key, colon, value, string, other, after, end
+        self._key = ""
+        self._key_mode = False # whether the string being read is a key or a value
+        self._value = "" # string value being decoded
+        self._pending = "" # escape sequence split across chunks
+        self._depth = 0 # nesting of non string values (e.g, the booking object)
+        self._in_nested_string = False
+        self._nested_escape = False
+
+    def feed(self, chunk:str) -> list[tuple]:
+        """
+        Description:
+            Method to parse the next piece of the completion
+        Arguments:
+            chunk: completion text delta
+        Return:
+            list of events: ("route", value) once, and ("reply", text) for every decoded piece of the reply
+        """
+        self.text += chunk
+        events = []
+        reply = []
+        data = self._pending + chunk
+        self._pending = ""
+        i = 0
+        while i < len(data):
+            char = data[i]
+            state = self._state
+            if state == "start":
+                if char == "{": # anything before the object (e.g, a ```json fence) is ignored
+                    self._state = "key"
+            elif state == "key":
+                if char == '"':
+                    self._state = "string"
+                    self._key_mode = True
+                    self._value = ""
+                elif char == "}":
+                    self._state = "end"
+            elif state == "colon":
+                if char == ":":
+                    self._state = "value"
+            elif state == "value":
+                if char == '"':
+                    self._state = "string"
+                    self._key_mode = False
+                    self._value = ""
+                elif not char.isspace():
+                    self._state = "other"
+                    self._depth = 0
+                    continue # let the "other" state look at this character
+            elif state == "string":
+                if char == "\\":
+                    escape = data[i:i+2]
+                    if len(escape) < 2:
+                        self._pending = data[i:]
+                        break
+                    if escape[1] == "u":
+                        digits = data[i+2:i+6]
+                        if not all(each in _HEX_DIGITS for each in digits):
+                            # malformed escape from the model, kept as text instead of failing the stream
+                            self._append("\\u", reply)
+                            i += 2
+                            continue
+                        if len(digits) < 4:
+                            self._pending = data[i:]
+                            break
+                        code = int(digits, 16)
+                        i += 6
+                        if 0xD800 <= code <= 0xDBFF:
+                            # a character outside the BMP (e.g, an emoji) is escaped as a surrogate pair
+                            following = data[i:i+6]
+                            if len(following) < 6 and following[:1] in ("", "\\"):
+                                self._pending = data[i-6:]
+                                break
+                            if _LOW_SURROGATE.fullmatch(following):
+                                code = 0x10000 + ((code - 0xD800) << 10) + (int(following[2:], 16) - 0xDC00)
+                                i += 6
+                        # a lone surrogate cannot be encoded to UTF-8, it is replaced
+                        decoded = "\ufffd" if 0xD800 <= code <= 0xDFFF else chr(code)
+                    else:
+                        decoded = _ESCAPES.get(escape[1], escape[1])
+                        i += 2
+                    self._append(decoded, reply)
+                    continue
+                if char == '"':
+                    self._close_string(events, reply)
+                else:
+                    self._append(char, reply)
+            elif state == "other":
+                if self._in_nested_string:
+                    if self._nested_escape:
+                        self._nested_escape = False
+                    elif char == "\\":
+                        self._nested_escape = True
+                    elif char == '"':
+                        self._in_nested_string = False
+                elif char == '"':
+                    self._in_nested_string = True
+                elif char in "{[":
+                    self._depth += 1
+                elif char in "}]":
+                    if self._depth == 0: # end of the top level object
+                        self._state = "end"
+                    else:
+                        self._depth -= 1
+                elif char == "," and self._depth == 0:
+                    self._state = "key"
+            elif state == "after":
+                if char == ",":
+                    self._state = "key"
+                elif char == "}":
+                    self._state = "end"
+            i += 1
+        if reply:
+            events.append(("reply", "".join(reply)))
+        return events
+
+    def _append(self, text:str, reply:list) -> None:
+        if not self._key_mode and self._key == "reply":
+            reply.append(text)
+        else:
+            self._value += text
+
+    def _close_string(self, events:list, reply:list) -> None:
+        if self._key_mode:
+            self._key = self._value
+            self._state = "colon"
+            return
+        if self._key == "route" and self.route is None:
+            self.route = self._value
+            if reply: # keep the order of the events
+                events.append(("reply", "".join(reply)))
+                reply.clear()
+            events.append(("route", self.route))
+        self._state = "after"
+
+    def json_text(self) -> str:
+        """
+        Description:
+            Method to get the complete JSON answer once the stream has ended, without any text around the object
+        """
+        text = self.text.strip()
+        start, end = text.find("{"), text.rfind("}")
+        if start != -1 and end != -1:
+            text = text[start:end+1]
+        return text
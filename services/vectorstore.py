@@ -1,26 +1,76 @@
 from services.chunking import Chunk
 from services.embedding import EmbeddingManager
+from services.manifest import make_chunk_ids
+from services.db_pool import ConnectionPool
+from services.docstore import DocStore
+from services.metrics import metrics
 from pymysql import Connection
 import numpy as np
+from abc import ABC, abstractmethod
 import pinecone
 import os
+import json
+import re
+import threading
+from typing import Callable
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-import pymysql, uuid
+import pymysql
 import pymysql.cursors
 from dotenv import load_dotenv
 load_dotenv() # Loads variables from .env into os.environ
 
 
+# unique index of the booking table -> (conflict, message) of write_booking_details
+_BOOKING_CONFLICTS = {
+    "uq_booking_email": ("email", "An interview is already booked for this email"),
+    "uq_booking_slot": ("slot", "This interview slot is already booked"),
+}
+_DUPLICATE_KEY = re.compile(r"for key '(?:[^'.]*\.)?([^']+)'")
+
+
+def _duplicate_key(error:pymysql.err.IntegrityError) -> str | None:
+    """
+    Return:
+        name of the unique index of a duplicate entry error (1062), e.g "Duplicate entry '...' for key 'booking_details.uq_booking_email'"
+        (mysql 8) or "... for key 'uq_booking_email'" (older versions), None for any other integrity error
+    """
+    if not error.args or error.args[0] != 1062:
+        return None
+    match = _DUPLICATE_KEY.search(str(error.args[-1]))
+    return match.group(1) if match else None
+
+
 class Metadata:
-    def __init__(self):
+    # connection pools shared by every Metadata object of the process, one per database
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self,connection_factory:Callable = None,batch_size:int = None,pool_size:int = None):
         """
         Description:
             Constructor to initialize database credentials
+        Arguments:
+            connection_factory = function returning a new (pymysql compatible) connection. Connects to the mysql database if not provided
+            batch_size = no. of rows written per executemany call
+            pool_size = maximum no. of open connections of the pool
         """
         self.MYSQL_UID = os.getenv('MYSQL_UID')
         self.MYSQL_PWD = os.getenv('MYSQL_PWD')
         self.connection = None
         self.host = 'localhost'
+        self.batch_size = batch_size or int(os.getenv("METADATA_BATCH_SIZE", "500"))
+        pool_size = pool_size or int(os.getenv("MYSQL_POOL_SIZE", "5"))
+        if connection_factory is not None:
+            self.pool = ConnectionPool(factory=connection_factory, max_size=pool_size)
+        else:
+            key = (self.host, self.MYSQL_UID, 'rag_metadata')
+            with Metadata._pools_lock:
+                if key not in Metadata._pools:
+                    Metadata._pools[key] = ConnectionPool(factory=self._create_connection, max_size=pool_size)
+                self.pool = Metadata._pools[key]
 
     def _create_connection(self) -> Connection:
         """
@@ -41,80 +91,337 @@ class Metadata:
         except Exception as e:
             raise Exception(f"Error in creating connection with sql: {str(e)}")
     
-    def write(self,metadata:list) -> None:
+    def write(self,metadata:list,replace:bool = False) -> None:
         """
         Description:
-            Method to write metadata to the database
+            Method to write metadata to the database. Rows are sent with executemany in batches of batch_size,
+            which pymysql turns into one multi row INSERT per batch
         Arguments:
             metadata = list of metadata of embeddings
+            replace = overwrite the rows having the same id instead of failing
         """
-        connection = self._create_connection()
-        with connection:
+        if not metadata:
+            return
+        statement = "REPLACE" if replace else "INSERT"
+        # rows having the same columns share one statement
+        groups = {}
+        for each in metadata:
+            groups.setdefault(tuple(each.keys()), []).append(tuple(each.values()))
+        with self.pool.connection() as connection:
             with connection.cursor() as cursor:
-                for each in metadata:
-                    cols = list(each.keys())
-                    values = tuple(each.values())
+                for cols, rows in groups.items():
                     cols_q = ", ".join(cols)
                     placeholders = ", ".join(['%s']*len(cols))
-                    # print(cols)
-                    # print(values)
-                    query = f"INSERT INTO booking_rag_metadata ({cols_q}) VALUES ({placeholders})"
-                    # print(query)
-                    cursor.execute(query,values)
+                    query = f"{statement} INTO booking_rag_metadata ({cols_q}) VALUES ({placeholders})"
+                    for start in range(0, len(rows), self.batch_size):
+                        cursor.executemany(query,rows[start:start+self.batch_size])
             connection.commit()
-        # print(metadata)
+
+    def close(self) -> None:
+        """
+        Description:
+            Method to close the idle connections of the pool at shutdown, the borrowed ones are closed when they come back
+        """
+        self.pool.close()
 
     def delete_all(self) -> None:
         """
         Description:
             Method to delete all metadata from the database
         """       
-        connection = self._create_connection()
-        with connection:
+        with self.pool.connection() as connection:
             with connection.cursor() as cursor:
                 query = f"TRUNCATE TABLE booking_rag_metadata;"
                 cursor.execute(query)
             connection.commit()  
 
+    def delete_ids(self,ids:list) -> None:
+        """
+        Description:
+            Method to delete the metadata of the given chunk ids
+        Arguments:
+            ids = list of chunk ids
+        """
+        if not ids:
+            return
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                for start in range(0, len(ids), self.batch_size): # keeps the IN clause of each query bounded
+                    batch = ids[start:start+self.batch_size]
+                    placeholders = ", ".join(['%s']*len(batch))
+                    cursor.execute(f"DELETE FROM booking_rag_metadata WHERE id IN ({placeholders})", tuple(batch))
+            connection.commit()
+
+    def ensure_schema(self) -> None:
+        """
+        Description:
+            Method to create the booking table with unique indexes on email and on date+time, or to add the indexes to
+            an existing table. The indexes make write_booking_details atomic, the database rejects a second booking of
+            the same email or slot. Raises if an index cannot be created (e.g, the table already has double bookings), so that
+            the metadata resource and /ready/ report the error instead of writing bookings without the check
+        """
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS booking_details (name VARCHAR(255), email VARCHAR(255), date VARCHAR(10), time VARCHAR(5), "
+                               "CONSTRAINT uq_booking_email UNIQUE (email), CONSTRAINT uq_booking_slot UNIQUE (date, time))")
+                for name, cols in (("uq_booking_email", "email"), ("uq_booking_slot", "date, time")):
+                    try:
+                        cursor.execute(f"ALTER TABLE booking_details ADD CONSTRAINT {name} UNIQUE ({cols})")
+                    except pymysql.err.MySQLError as e:
+                        if e.args and e.args[0] == 1061: # duplicate key name, the index already exists
+                            continue
+                        # without the index double bookings would go through, the bookings must not be written
+                        raise Exception(f"Unique index {name} on booking_details not created, remove the duplicate bookings first: {str(e)}")
+            connection.commit()
+
     def write_booking_details(self,booking_details:dict) -> None | dict:
         """
         Description:
-            Method to write interview booking details to the database
+            Method to write interview booking details to the database in one INSERT. The unique indexes created by
+            ensure_schema reject a booking of an email or a slot that is already booked, also under concurrent writes
         Arguments:
             booking_details = dict of booking fields
+        Return:
+            None if the interview is booked, else {"Message", "conflict": "email" or "slot"}
+        """
+        cols = list(booking_details.keys())
+        values = tuple(booking_details.values())
+        cols_q = ", ".join(cols)
+        placeholders = ", ".join(['%s']*len(cols))
+        with self.pool.connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"INSERT INTO booking_details ({cols_q}) VALUES ({placeholders})",values)
+                connection.commit()
+            except pymysql.err.IntegrityError as e:
+                connection.rollback() # the pooled connection must not keep the failed transaction open
+                conflict = _BOOKING_CONFLICTS.get(_duplicate_key(e))
+                if conflict is None:
+                    raise
+                return {"Message":conflict[1],"conflict":conflict[0]}
+        return None
+
+    def read_booked_slots(self,from_date:str = None) -> set:
+        """
+        Description:
+            Method to read the booked interview slots
+        Arguments:
+            from_date = first date (YYYY-MM-DD) read, every booking if not provided
+        Return:
+            set of (date, time) tuples as YYYY-MM-DD and HH:MM strings
         """
-        connection = self._create_connection()
-        with connection:
+        with self.pool.connection() as connection:
             with connection.cursor() as cursor:
-                # checking if the an interview is already booked for the given email
-                email = booking_details['email']
-                cursor.execute(f"SELECT * FROM booking_details WHERE email=%s",(email,))
-                if cursor.rowcount > 0:
-                    return {"Message":"An interview is already booked for this email"}
-
-                cols = list(booking_details.keys())
-                values = tuple(booking_details.values())
-                cols_q = ", ".join(cols)
-                placeholders = ", ".join(['%s']*len(cols))
-                # print(cols)
-                # print(values)
-                query = f"INSERT INTO booking_details ({cols_q}) VALUES ({placeholders})"
-                # print(query)
-                cursor.execute(query,values)
-            connection.commit()
-        # print(metadata)
+                if from_date is None:
+                    cursor.execute("SELECT date, time FROM booking_details")
+                else:
+                    cursor.execute("SELECT date, time FROM booking_details WHERE date >= %s",(from_date,))
+                rows = cursor.fetchall()
+            connection.rollback() # ends the read transaction of the pooled connection
+        slots = set()
+        for row in rows:
+            booked_date, booked_time = row["date"], row["time"]
+            # DATE and TIME columns come back as date and timedelta objects
+            if hasattr(booked_time, "total_seconds"):
+                minutes = int(booked_time.total_seconds()) // 60
+                booked_time = f"{minutes // 60:02d}:{minutes % 60:02d}"
+            slots.add((str(booked_date)[:10], str(booked_time)[:5]))
+        return slots
+
 
+class BaseVectorStore(ABC):
+    """
+    Interface of the vector databases. The sql metadata is written here, the backends only handle the vectors.
+    With a docstore, the chunk texts are kept in the docstore instead of the vector metadata and the matches
+    of a query get their texts from it in one batched lookup
+    """
+    docstore: DocStore = None
+    sql_metadata: Metadata = None # Metadata object of the sql writes, a new one (on the shared pool) if not set
 
-class VectorStore:
-    def __init__(self):
+    def _sql(self) -> Metadata:
+        return self.sql_metadata if self.sql_metadata is not None else Metadata()
+
+    def upsert(self,ids:list,embeddings:np.array,texts:list,chunk_metadata:list)->None:
+        """
+        Description:
+            Method to insert or overwrite vectors in vector database and their metadata in sql database
+        Arguments:
+            ids: chunk ids of the vectors
+            embeddings: embedding vectors
+            texts: corresponding texts of embedding vectors
+            chunk_metadata : metadata of corresponding vectors
+        """
+        if not ids:
+            return
+        vector_metadata = []
+        metadata  = []
+        uploaded_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        for i in range(len(ids)):
+            if self.docstore is not None:
+                vector_metadata.append({"source": chunk_metadata[i]['source']})
+            else:
+                vector_metadata.append({"text": texts[i], "source": chunk_metadata[i]['source']})
+            metadata.append(
+                {
+                "id": ids[i],
+                "uploaded_time": uploaded_time,
+                "source": chunk_metadata[i]['source']
+                }
+            )
+        try:
+            print(f"writting the metadata of {len(ids)} chunks in the database")
+            with metrics.span("metadata_write"):
+                self._sql().write(metadata=metadata, replace=True)
+
+            if self.docstore is not None: # before the vectors, so that a match always finds its text
+                with metrics.span("docstore_write"):
+                    self.docstore.put(ids=ids,texts=texts,metadata=vector_metadata)
+            print(f"writting {len(ids)} vectors in the vectorstore")
+            with metrics.span("upsert"):
+                self._upsert_vectors(ids=ids,embeddings=embeddings,vector_metadata=vector_metadata)
+        except Exception as e:
+            raise Exception(f"{str(e)}")
+
+    def delete(self,ids:list)->None:
+        """
+        Description:
+            Method to delete vectors from vector database and their metadata from sql database
+        Arguments:
+            ids: chunk ids to delete
+        """
+        if not ids:
+            return
+        try:
+            print(f"deleting {len(ids)} stale chunks")
+            with metrics.span("metadata_write"):
+                self._sql().delete_ids(ids)
+            with metrics.span("delete"):
+                self._delete_vectors(ids)
+            if self.docstore is not None:
+                self.docstore.delete(ids)
+        except Exception as e:
+            raise Exception(f"{str(e)}")
+
+    def update_metadata(self,ids:list,metadata:list)->None:
+        """
+        Description:
+            Method to change some metadata fields of stored vectors, the other fields are kept
+        Arguments:
+            ids: chunk ids of the vectors
+            metadata: fields to set for each vector
+        """
+        if not ids:
+            return
+        try:
+            self._update_vector_metadata(ids=ids,metadata=metadata)
+            if self.docstore is not None:
+                self.docstore.update_metadata(ids=ids,metadata=metadata)
+        except Exception as e:
+            raise Exception(f"{str(e)}")
+
+    def store(self,embeddings:np.array,texts:list,chunk_metadata:list)->None:
+        """
+        Description:
+            Method to rebuild the stores from scratch: truncates both databases and writes every vector
+        Arguments:
+            embeddings: embedding vectors
+            texts: corresponding texts of embedding vectors
+            chunk_metadata : metadata of corresponding vectors
+        """
+        ids = make_chunk_ids(texts, [each['source'] for each in chunk_metadata])
+        try:
+            self._sql().delete_all() # delete metadata
+            self.empty_index() # truncate vector database before adding vectors
+        except Exception as e:
+            raise Exception(f"{str(e)}")
+        self.upsert(ids=ids,embeddings=embeddings,texts=texts,chunk_metadata=chunk_metadata)
+
+    def _resolve(self,results:list[dict])->list[dict]:
+        """
+        Description:
+            Adds the texts of the docstore to the matches of a query
+        """
+        if self.docstore is None or not results:
+            return results
+        return self.docstore.resolve(results)
+
+    def _clear_docstore(self)->None:
+        if self.docstore is not None:
+            self.docstore.clear()
+
+    def empty_metadata(self)->None:
+        """
+        Description:
+            Method to truncate the sql metadata of the chunks, through the same Metadata object as the writes
+        """
+        self._sql().delete_all()
+
+    @abstractmethod
+    def query(self,vector:list,top_k:int)->list[dict]:
+        """
+        Description:
+            Method to search the nearest vectors
+        Arguments:
+            vector: query embedding
+            top_k: no. of top results to return
+        Return:
+            list of matches, each dictionary has "id", "score" and "metadata"
+        """
+
+    @abstractmethod
+    def empty_index(self)->None:
+        """
+        Description:
+            Method to truncate the vector database
+        """
+
+    @abstractmethod
+    def _upsert_vectors(self,ids:list,embeddings:np.array,vector_metadata:list)->None:
+        """
+        Description:
+            Backend specific write of the vectors
+        """
+
+    @abstractmethod
+    def _update_vector_metadata(self,ids:list,metadata:list)->None:
+        """
+        Description:
+            Backend specific metadata update of the vectors
+        """
+
+    @abstractmethod
+    def _delete_vectors(self,ids:list)->None:
+        """
+        Description:
+            Backend specific delete of the vectors
+        """
+
+
+class VectorStore(BaseVectorStore):
+    """
+    Pinecone implementation of the vector store
+    """
+    def __init__(self,pinecone_index=None,batch_size:int = 100,max_batch_bytes:int = 2_000_000,max_workers:int = 4,max_retries:int = 3,docstore:DocStore = None):
         """
         Description:
             Constructor to initialize vector database credentials
+        Arguments:
+            pinecone_index: already created index object (or a stand-in with the same upsert api). Connects to pinecone if not provided
+            batch_size: maximum no. of vectors per upsert request
+            max_batch_bytes: maximum (estimated) payload size of an upsert request
+            max_workers: no. of upsert requests sent concurrently
+            max_retries: no. of retries of a failed upsert request
+            docstore: DocStore object of the chunk texts, the texts are sent as vector metadata if not provided
         """
         self.PINECONE_API_KEY = os.getenv("PINECONE_API_KEY") # access variables
         self.PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
         self.PINECONE_HOST = os.getenv("PINECONE_HOST")
-        self.pinecone_index = self.create_connection()
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.docstore = docstore
+        self.pinecone_index = pinecone_index if pinecone_index is not None else self.create_connection()
         
     def create_connection(self) -> pinecone.Pinecone:
         """
@@ -131,46 +438,100 @@ class VectorStore:
             return pinecone_index
         except Exception as e :
             raise Exception(f"Error creating connection with vector database : {str(e)}")
-        
-    def store(self,embeddings:np.array,texts:list,chunk_metadata:list)->None:
+
+    def _iter_batches(self,ids:list,embeddings:np.array,vector_metadata:list):
         """
         Description:
-            Method to store embeddings,texts in vector database and metadata in sql database
-        Arguments:
-            embeddings: embedding vectors
-            texts: corresponding texts of embedding vectors
-            chunk_metadata : metadata of corresponding vectors
+            Generator of upsert batches bounded by no. of vectors and payload size. Vectors are converted
+            to lists only when their batch is built, so the whole payload never sits in memory
         """
-
-        vectors = []
-        metadata  = []
+        batch = []
+        batch_bytes = 0
         for i, embedding in enumerate(embeddings): # enumerate() lets you loop over items and get their index at the same time.
-            doc_id = f"doc_{uuid.uuid4().hex[:8]}_{i}"
-            vectors.append(
-               {
-                "id": doc_id,
+            vector = {
+                "id": ids[i],
                 "values": embedding.tolist(),
-                "metadata": {"text": texts[i]}
-                } 
-            )
-            metadata.append(
-                {
-                "id": doc_id,
-                "uploaded_time": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                "source": chunk_metadata[i]['source'] 
+                "metadata": vector_metadata[i]
                 }
-            )  
-        try:
-            print("writting the metadata in the database")
-            metadatadb = Metadata()
-            metadatadb.delete_all() # delete metadata
-            metadatadb.write(metadata=metadata)
-
-            print("writting the vectors in the vectorstore")
-            self.pinecone_index.delete(delete_all=True) # truncate vector database before adding vectors
-            self.pinecone_index.upsert(vectors=vectors)
-        except Exception as e:
-            raise Exception(f"{str(e)}")
+            # json size estimate: ~12 characters per float, plus id and metadata
+            size = 12*len(vector["values"]) + len(ids[i]) + len(json.dumps(vector_metadata[i]))
+            if batch and (len(batch) >= self.batch_size or batch_bytes + size > self.max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(vector)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _upsert_batch(self,batch:list)->int:
+        """
+        Description:
+            Sends one upsert request, retrying with exponential backoff and jitter
+        Return:
+            no. of vectors upserted
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.pinecone_index.upsert(vectors=batch)
+                return len(batch)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = 0.5 * (2 ** attempt) + random.uniform(0, 0.25)
+                print(f"upsert of {len(batch)} vectors failed ({str(e)}), retrying in {delay:.2f} seconds")
+                time.sleep(delay)
+
+    def _upsert_vectors(self,ids:list,embeddings:np.array,vector_metadata:list)->None:
+        total = len(ids)
+        done = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = set()
+            batches = self._iter_batches(ids,embeddings,vector_metadata)
+            while True:
+                # keep a bounded no. of batches in flight so that memory doesnot grow with the corpus
+                for batch in batches:
+                    pending.add(executor.submit(self._upsert_batch, batch))
+                    if len(pending) >= 2*self.max_workers:
+                        break
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        done += future.result()
+                        print(f"upserted {done}/{total} vectors")
+                    except Exception as e:
+                        failed.append(str(e))
+        if failed:
+            raise Exception(f"{len(failed)} upsert batches failed after {self.max_retries} retries, {done}/{total} vectors upserted. First error: {failed[0]}")
+
+    def _update_vector_metadata(self,ids:list,metadata:list)->None:
+        for i, each in enumerate(ids): # pinecone updates one vector per request
+            self.pinecone_index.update(id=each, set_metadata=metadata[i])
+
+    def _delete_vectors(self,ids:list)->None:
+        for start in range(0, len(ids), 1000): # pinecone accepts at most 1000 ids per delete
+            self.pinecone_index.delete(ids=ids[start:start+1000])
+
+    def query(self,vector:list,top_k:int)->list[dict]:
+        # with a docstore only the ids and scores come over the wire
+        results = self.pinecone_index.query(
+            vector=vector,
+            top_k=top_k,
+            include_metadata=self.docstore is None,
+            include_values=False
+        )
+        matches = self._resolve([{"id": each['id'], "score": each['score'], "metadata": each.get('metadata') or {}} for each in results['matches']])
+        if self.docstore is not None:
+            # vectors written before the docstore keep their text in the pinecone metadata, it is fetched for them only
+            missing = [each["id"] for each in matches if "text" not in each["metadata"]]
+            if missing:
+                vectors = self.pinecone_index.fetch(ids=missing)["vectors"]
+                matches = [{**each, "metadata": {**(vectors[each["id"]].get("metadata") or {}), **each["metadata"]}}
+                           if each["id"] in vectors else each for each in matches]
+        return matches
 
     def empty_index(self):
         """
@@ -178,9 +539,36 @@ class VectorStore:
             Method to truncate the vector database
         """
         self.pinecone_index.delete(delete_all=True)
+        self._clear_docstore()
         print("PineCone index is emptied")
 
 
+# the pinecone store under its explicit name
+PineconeVectorStore = VectorStore
+
+
+def create_vector_store(docstore:DocStore = None) -> BaseVectorStore:
+    """
+    Description:
+        Creates the vector store selected by the VECTOR_STORE_BACKEND variable. Supported backends = "pinecone","local"
+    Arguments:
+        docstore: DocStore object of the chunk texts, the texts are kept in the vector metadata if not provided
+    Return:
+        vector store object
+    """
+    backend = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+    if backend == "pinecone":
+        return VectorStore(docstore=docstore)
+    elif backend == "local":
+        from services.local_index import LocalVectorStore # imported here because local_index depends on this module
+        return LocalVectorStore(index_dir=os.getenv("LOCAL_INDEX_DIR", "data/vector_index"),
+                                compression=os.getenv("LOCAL_INDEX_COMPRESSION") or None,
+                                rescore=int(os.getenv("LOCAL_INDEX_RESCORE", "4")),
+                                docstore=docstore)
+    else:
+        raise Exception(f"{backend} vector store backend not supported!!!!")
+
+
 # if __name__ == "__main__":
 #     chunk_obj = Chunk()
 #     chunks = chunk_obj.create_chunk("recursive")